@@ -2,12 +2,36 @@ from flask import Flask, render_template, jsonify, request, Response, stream_wit
 import subprocess
 import os
 import json
+import copy
+import queue
+import sqlite3
+import atexit
+import gzip
+import re
+import uuid
 from datetime import datetime
 import threading
 import requests
 import time
 import paramiko
 import socket
+import signal
+import select
+import selectors
+import codecs
+import zlib
+import asyncio
+import shlex
+import posixpath
+import hmac
+import hashlib
+import base64
+import urllib.parse
+import http.client
+import io
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 
 app = Flask(__name__)
 
@@ -16,11 +40,153 @@ CONFIG_FILE = 'projects.json'
 SETTINGS_FILE = 'settings.json'
 LOGS_DIR = 'logs'
 
-def load_settings():
-    """加载系统设置"""
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+class ConfigFile:
+    """JSON 配置文件的内存缓存，只有文件的 mtime/inode/size 变化时才重新解析"""
+
+    def __init__(self, path, default_factory):
+        self.path = path
+        self.default_factory = default_factory
+        self._data = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def _on_load(self, data):
+        """子类可在重新加载后建立索引"""
+
+    def get(self):
+        """返回缓存的配置（调用方不得修改返回值）"""
+        signature = self._stat_signature()
+        with self._lock:
+            if self._data is not None and signature == self._signature:
+                return self._data
+            if signature is None:
+                data = self.default_factory()
+            else:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    # 文件正在被编辑或格式错误时继续使用上一次成功加载的配置
+                    print(f"加载配置文件失败 {self.path}: {e}")
+                    if self._data is not None:
+                        return self._data
+                    data = self.default_factory()
+            self._data = data
+            self._signature = signature
+            self._on_load(data)
+            return data
+
+    def store(self, data):
+        """写入配置文件（先写临时文件再替换，读取方不会看到写了一半的文件）"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._data = data
+            self._signature = self._stat_signature()
+            self._on_load(data)
+
+def new_project_id(existing=()):
+    """生成项目ID（8 位十六进制，不会是纯数字，避免与列表序号混淆）"""
+    while True:
+        project_id = uuid.uuid4().hex[:8]
+        if not project_id.isdigit() and project_id not in existing:
+            return project_id
+
+class ProjectRegistry(ConfigFile):
+    """项目配置缓存，按项目ID索引，额外维护 路径 -> 项目ID 和 (主机, compose 工作目录) -> 项目ID 的索引
+
+    项目ID保存在 projects.json 的 id 字段中，不随项目在列表中的位置变化；操作日志、输出文件和后台任务都以它为键。
+    旧版配置没有 id 字段，首次加载时生成并写回文件，同时把按列表序号保存的日志和输出文件迁移到新ID下。
+    """
+
+    def __init__(self, path):
+        super().__init__(path, list)
+        self._id_index = {}
+        self._path_index = {}
+        self._workdir_index = {}
+        self._unsaved_ids = False
+        self._migrate_lock = threading.Lock()
+
+    def _on_load(self, data):
+        seen = set()
+        for project in data:
+            # 缺少ID或ID重复（手动复制的配置）时生成新ID，随后写回文件
+            if not isinstance(project.get('id'), str) or not project['id'] or project['id'] in seen:
+                project['id'] = new_project_id(seen)
+                self._unsaved_ids = True
+            seen.add(project['id'])
+        self._id_index = {project['id']: project for project in data}
+        self._path_index = {}
+        self._workdir_index = {}
+        for project in data:
+            self._path_index.setdefault(project.get('path'), project['id'])
+            if project.get('path'):
+                # 同一主机同一目录配置了多个项目时，与按顺序查找一样取第一个
+                self._workdir_index.setdefault((job_host_key(project), posixpath.normpath(project['path'])), project['id'])
+
+    def get(self):
+        data = super().get()
+        if self._unsaved_ids:
+            self._store_generated_ids(data)
+        return data
+
+    def _store_generated_ids(self, data):
+        with self._migrate_lock:
+            if not self._unsaved_ids or self._data is not data:
+                return
+            # 此时项目顺序与旧版按序号保存日志时一致，据此迁移旧日志和输出文件
+            legacy_ids = {i: project['id'] for i, project in enumerate(data)}
+            try:
+                if operation_log_store.migrate_legacy_project_ids(legacy_ids):
+                    migrate_legacy_output_artifacts(legacy_ids)
+            except Exception as e:
+                print(f"迁移旧版日志失败: {e}")
+            try:
+                self.store(data)
+            except OSError as e:
+                print(f"保存项目ID失败: {e}")
+                return
+            self._unsaved_ids = False
+
+    def get_project(self, project_id):
+        self.get()
+        return self._id_index.get(project_id)
+
+    def resolve(self, project_ref):
+        """按项目ID查找项目，纯数字时兼容旧版的列表序号，返回 (项目ID, 项目)，不存在时返回 (None, None)"""
+        projects = self.get()
+        project = self._id_index.get(project_ref)
+        if project is None and str(project_ref).isdigit() and int(project_ref) < len(projects):
+            project = projects[int(project_ref)]
+        if project is None:
+            return None, None
+        return project['id'], project
+
+    def find_by_path(self, path):
+        """返回使用该路径的项目ID，不存在时返回 None"""
+        self.get()
+        return self._path_index.get(path)
+
+    def find_by_workdir(self, host, working_dir):
+        """根据主机和容器的 compose 工作目录标签找到项目，返回 (项目ID, 项目)，不存在时返回 (None, None)"""
+        self.get()
+        with self._lock:
+            project_id = self._workdir_index.get((host, working_dir))
+            project = self._id_index.get(project_id)
+        if project is None:
+            return None, None
+        return project_id, project
+
+def default_settings():
     return {
         'dingtalk': {
             'enabled': False,
@@ -29,25 +195,185 @@ def load_settings():
         }
     }
 
-def send_dingtalk_notification(title, message, is_success=True):
-    """发送钉钉通知"""
-    settings = load_settings()
-    dingtalk = settings.get('dingtalk', {})
-
-    if not dingtalk.get('enabled', False):
-        return
+project_registry = ProjectRegistry(CONFIG_FILE)
+settings_registry = ConfigFile(SETTINGS_FILE, default_settings)
 
-    webhook_url = dingtalk.get('webhook_url', '')
-    if not webhook_url:
-        return
-
-    # 钉钉消息格式
-    content = f"### {title}\n\n"
-    content += f"**状态**: {'✅ 成功' if is_success else '❌ 失败'}\n\n"
-    content += f"**时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    content += f"**详情**: {message}\n"
+def load_settings():
+    """加载系统设置（返回副本，可自由修改）"""
+    return copy.deepcopy(settings_registry.get())
+
+# ============ 监控指标 ============
+# 进程内的 Prometheus 指标，GET /metrics 以文本格式输出
+
+METRIC_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def format_metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def format_metric_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """只增不减的计数器，按标签值分别计数"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_metric_labels(self.labelnames, key)} {format_metric_value(value)}')
+        return lines
+
+class Histogram:
+    """直方图：按标签值统计落在各区间的次数、总和与总数，用于计算 p50/p95"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRIC_DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # 标签值 -> [各区间计数, 总和, 总数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_metric_labels(self.labelnames, key, [('le', format_metric_value(float(bound)))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_metric_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = format_metric_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {format_metric_value(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRIC_DURATION_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+STEP_DURATION = metrics.histogram(
+    'deploy_manager_step_duration_seconds', '操作中每个命令步骤的耗时', ('project', 'host', 'step'))
+STEP_OUTPUT_BYTES = metrics.counter(
+    'deploy_manager_step_output_bytes_total', '命令步骤输出的字节数', ('project', 'host', 'step'))
+STEP_RESULTS = metrics.counter(
+    'deploy_manager_steps_total', '命令步骤执行次数（按退出码）', ('project', 'host', 'step', 'exit_code'))
+OPERATION_DURATION = metrics.histogram(
+    'deploy_manager_operation_duration_seconds', '部署、重启等操作的总耗时', ('project', 'host', 'operation', 'result'))
+SSH_CONNECT_DURATION = metrics.histogram(
+    'deploy_manager_ssh_connect_duration_seconds', '建立SSH连接的耗时', ('host', 'result'))
+STATUS_PROBE_DURATION = metrics.histogram(
+    'deploy_manager_status_probe_duration_seconds', '项目状态探测的耗时', ('project', 'host', 'result'))
+HEALTH_PROBE_LATENCY = metrics.histogram(
+    'deploy_manager_health_probe_latency_seconds', '重启后健康检查从开始到通过的耗时', ('project', 'type'))
+HOST_PROBE_DURATION = metrics.histogram(
+    'deploy_manager_host_probe_duration_seconds', '远程主机系统信息探测的耗时', ('host', 'result'))
+NOTIFICATION_DURATION = metrics.histogram(
+    'deploy_manager_notification_duration_seconds', '发送通知的耗时', ('channel', 'result'))
+
+def metric_host(project):
+    """指标中的主机标签：SSH 项目为远程主机，本地项目为 local"""
+    ssh_config = project.get('ssh', {})
+    return ssh_config.get('host', '') if ssh_config.get('enabled', False) else 'local'
+
+def metric_step_name(step):
+    """把步骤名归并为有限的几类（去掉服务名、参数等），避免指标标签数量无限增长"""
+    words = step.split()
+    if words[:2] == ['docker', 'compose']:
+        return ' '.join(words[:3])
+    if words[:1] in (['git'], ['docker']):
+        return ' '.join(words[:2])
+    return words[0] if words else 'unknown'
+
+# ============ 钉钉通知 ============
+# 通知写入持久化队列后立即返回，由后台线程发送：
+# 短时间内的多条通知、以及受钉钉频率限制（每分钟 20 条）积压的通知合并为一条汇总消息，
+# 发送失败按指数退避重试，服务重启后继续发送队列中的通知。
+
+NOTIFY_QUEUE_FILE = os.path.join(LOGS_DIR, 'notify_queue.json')
+NOTIFY_COALESCE_WINDOW = 3      # 收到通知后等待的秒数，期间到达的通知合并发送
+NOTIFY_RATE_LIMIT = 20          # 钉钉机器人每分钟最多发送 20 条消息
+NOTIFY_RATE_WINDOW = 60
+NOTIFY_RETRY_BASE = 5           # 失败后的重试间隔（秒），每次翻倍
+NOTIFY_RETRY_MAX = 600
+NOTIFY_MAX_ATTEMPTS = 8         # 超过后放弃该通知
+NOTIFY_SEND_TIMEOUT = 5
+DINGTALK_RATE_LIMITED = 130101  # 钉钉返回的"发送速度太快"错误码
+
+def sign_dingtalk_webhook(webhook_url, secret):
+    """按钉钉加签规则在 webhook 地址上附加 timestamp 和 sign"""
+    timestamp = str(round(time.time() * 1000))
+    string_to_sign = f'{timestamp}\n{secret}'
+    digest = hmac.new(secret.encode('utf-8'), string_to_sign.encode('utf-8'), hashlib.sha256).digest()
+    sign = urllib.parse.quote_plus(base64.b64encode(digest))
+    separator = '&' if '?' in webhook_url else '?'
+    return f'{webhook_url}{separator}timestamp={timestamp}&sign={sign}'
+
+def build_dingtalk_message(items):
+    """把一条或多条通知组装为钉钉 markdown 消息"""
+    if len(items) == 1:
+        item = items[0]
+        title = item['title']
+        content = f"### {title}\n\n"
+        content += f"**状态**: {'✅ 成功' if item['is_success'] else '❌ 失败'}\n\n"
+        content += f"**时间**: {item['time']}\n\n"
+        content += f"**详情**: {item['message']}\n"
+    else:
+        succeeded = sum(1 for item in items if item['is_success'])
+        title = f'部署通知汇总：成功 {succeeded}，失败 {len(items) - succeeded}'
+        content = f"### {title}\n\n"
+        for item in items:
+            content += f"- {'✅' if item['is_success'] else '❌'} **{item['title']}** {item['time'][11:]}\n\n  {item['message']}\n\n"
 
-    data = {
+    return {
         "msgtype": "markdown",
         "markdown": {
             "title": title,
@@ -55,37 +381,480 @@ def send_dingtalk_notification(title, message, is_success=True):
         }
     }
 
-    try:
-        response = requests.post(webhook_url, json=data, timeout=5)
-        return response.status_code == 200
-    except Exception as e:
-        print(f"发送钉钉通知失败: {e}")
-        return False
+class DingTalkDispatcher:
+    """钉钉通知的后台发送队列
+
+    分组（group）中的通知在分组关闭前不会发送，用于批量部署结束后发送一条汇总消息。
+    """
+
+    def __init__(self, queue_file):
+        self.registry = ConfigFile(queue_file, list)
+        # 重启后上次未关闭的分组不会再被关闭，直接发送
+        self._items = [{**item, 'group': None} for item in self.registry.get()]
+        self._open_groups = set()
+        self._sent = deque()  # 最近一分钟内的发送时间，用于遵守频率限制（由 _cond 保护）
+        self._cond = threading.Condition()
+        self._flushing = False
+        self._worker = None
+        self._session = requests.Session()
+        self._session_lock = threading.Lock()
+        if self._items:
+            self._ensure_worker()
+
+    def notify(self, title, message, is_success=True, group=None):
+        """加入发送队列后立即返回；未启用钉钉通知时返回 False"""
+        dingtalk = settings_registry.get().get('dingtalk', {})
+        if not dingtalk.get('enabled', False) or not dingtalk.get('webhook_url', ''):
+            return False
+
+        now = time.time()
+        item = {
+            'id': uuid.uuid4().hex[:12],
+            'title': title,
+            'message': message,
+            'is_success': is_success,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'created': now,
+            'attempts': 0,
+            'next_attempt': now,
+            'group': group
+        }
+        with self._cond:
+            self._items.append(item)
+            self._persist()
+            self._ensure_worker()
+            self._cond.notify_all()
+        return True
+
+    def open_group(self):
+        group = uuid.uuid4().hex[:12]
+        with self._cond:
+            self._open_groups.add(group)
+        return group
+
+    def close_group(self, group):
+        """关闭分组，分组中的通知合并为一条消息发送"""
+        with self._cond:
+            self._open_groups.discard(group)
+            self._cond.notify_all()
+
+    def send_now(self, title, message, is_success=True):
+        """同步发送一条通知（用于测试配置），返回 (是否成功, 错误信息)"""
+        item = {'title': title, 'message': message, 'is_success': is_success,
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        success, error, _ = self._send([item])
+        return success, error
+
+    def flush(self, timeout):
+        """立即发送队列中可以发送的通知（不再等待合并），最多等待 timeout 秒，返回剩余未发送的数量"""
+        deadline = time.time() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._ready(time.time()) and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            self._flushing = False
+            return len(self._items)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._worker_loop, name='dingtalk-dispatcher', daemon=True)
+            self._worker.start()
+
+    def _persist(self):
+        try:
+            os.makedirs(LOGS_DIR, exist_ok=True)
+            self.registry.store(list(self._items))
+        except OSError as e:
+            print(f"保存通知队列失败: {e}")
+
+    def _ready(self, now):
+        return [item for item in self._items
+                if item['group'] not in self._open_groups and item['next_attempt'] <= now]
+
+    def _rate_available_at(self, now):
+        """下一次可以发送的时间（遵守每分钟的条数限制）"""
+        while self._sent and self._sent[0] <= now - NOTIFY_RATE_WINDOW:
+            self._sent.popleft()
+        if len(self._sent) < NOTIFY_RATE_LIMIT:
+            return now
+        return self._sent[0] + NOTIFY_RATE_WINDOW
+
+    def _wait_for_batch(self):
+        """等待到有可以发送的通知，返回本次合并发送的通知列表"""
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = self._ready(now)
+                if ready:
+                    # 等待合并窗口结束，并且不超过频率限制；等待期间到达的通知会一起发送
+                    window_end = now if self._flushing else min(item['created'] for item in ready) + NOTIFY_COALESCE_WINDOW
+                    wake_at = max(window_end, self._rate_available_at(now))
+                    if wake_at <= now:
+                        return ready
+                else:
+                    retries = [item['next_attempt'] for item in self._items if item['group'] not in self._open_groups]
+                    wake_at = min(retries) if retries else None
+                self._cond.wait(None if wake_at is None else max(0.05, wake_at - now))
+
+    def _worker_loop(self):
+        while True:
+            batch = self._wait_for_batch()
+            dingtalk = settings_registry.get().get('dingtalk', {})
+            if not dingtalk.get('enabled', False) or not dingtalk.get('webhook_url', ''):
+                # 入队后通知被关闭：不再发送，丢弃并记录数量
+                print(f"钉钉通知已关闭，丢弃队列中的 {len(batch)} 条通知: {', '.join(item['title'] for item in batch)}")
+                with self._cond:
+                    ids = {item['id'] for item in batch}
+                    self._items = [item for item in self._items if item['id'] not in ids]
+                    self._persist()
+                    self._cond.notify_all()
+                continue
+            success, error, retry_after = self._send(batch)
+            with self._cond:
+                ids = {item['id'] for item in batch}
+                if success:
+                    self._items = [item for item in self._items if item['id'] not in ids]
+                else:
+                    print(f"发送钉钉通知失败: {error}")
+                    now = time.time()
+                    for item in batch:
+                        item['attempts'] += 1
+                        backoff = min(NOTIFY_RETRY_BASE * 2 ** (item['attempts'] - 1), NOTIFY_RETRY_MAX)
+                        item['next_attempt'] = now + max(backoff, retry_after)
+                    dropped = [item for item in batch if item['attempts'] >= NOTIFY_MAX_ATTEMPTS]
+                    for item in dropped:
+                        print(f"钉钉通知重试 {NOTIFY_MAX_ATTEMPTS} 次后放弃: {item['title']}")
+                    self._items = [item for item in self._items if item not in dropped]
+                self._persist()
+                self._cond.notify_all()
+
+    def _send(self, items):
+        """发送一条（合并后的）消息，返回 (是否成功, 错误信息, 至少等待多久再重试)"""
+        dingtalk = settings_registry.get().get('dingtalk', {})
+        webhook_url = dingtalk.get('webhook_url', '')
+        if not dingtalk.get('enabled', False) or not webhook_url:
+            return False, '钉钉通知未启用', 0
+        if dingtalk.get('secret'):
+            webhook_url = sign_dingtalk_webhook(webhook_url, dingtalk['secret'])
+
+        started = time.monotonic()
+        retry_after = 0
+        try:
+            # 发送记录与 _rate_available_at 使用同一把锁（send_now 在请求线程中调用）
+            with self._cond:
+                self._sent.append(time.time())
+            with self._session_lock:
+                response = self._session.post(webhook_url, json=build_dingtalk_message(items),
+                                              timeout=NOTIFY_SEND_TIMEOUT)
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            errcode = body.get('errcode', 0)
+            success = response.status_code == 200 and errcode == 0
+            error = '' if success else f"HTTP {response.status_code} {body.get('errmsg', '')}".strip()
+            if errcode == DINGTALK_RATE_LIMITED:
+                retry_after = NOTIFY_RATE_WINDOW
+        except Exception as e:
+            success, error = False, str(e)
+        NOTIFICATION_DURATION.observe(time.monotonic() - started, channel='dingtalk',
+                                      result='success' if success else 'error')
+        return success, error, retry_after
+
+dingtalk_dispatcher = DingTalkDispatcher(NOTIFY_QUEUE_FILE)
+
+def send_dingtalk_notification(title, message, is_success=True, group=None):
+    """发送钉钉通知（加入后台发送队列，不等待发送结果）"""
+    return dingtalk_dispatcher.notify(title, message, is_success, group)
 
 def ensure_logs_dir():
     """确保日志目录存在"""
     if not os.path.exists(LOGS_DIR):
         os.makedirs(LOGS_DIR)
 
-def save_operation_log(project_id, project_name, operation_type, success, output='', ssh_mode=False, ssh_host=''):
-    """保存操作日志"""
-    try:
-        ensure_logs_dir()
+# 操作日志保留策略，可在 settings.json 的 log_retention 中覆盖
+LOG_RETENTION_DEFAULTS = {
+    'max_entries_per_project': 5000,  # 每个项目最多保留的日志条数
+    'max_age_days': 180,              # 日志最长保留天数
+    'max_db_mb': 512                  # 日志数据库最大体积（MB），超出后删除最旧的日志
+}
+LOG_MAX_OUTPUT_LENGTH = 10000         # 单条日志保存的最大输出长度
+LOG_RETENTION_CHECK_INTERVAL = 600    # 执行保留策略的间隔（秒）
+
+class OperationLogStore:
+    """操作日志存储：SQLite 文件，由单个后台线程顺序写入，按 (项目ID, 日志ID) 索引分页读取"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS operation_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            timestamp TEXT NOT NULL,
+            project_name TEXT,
+            operation TEXT,
+            success INTEGER,
+            output TEXT,
+            ssh_mode INTEGER,
+            ssh_host TEXT,
+            extra TEXT
+        )
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """初始化数据库并启动写线程（首次使用时调用）"""
+        with self._lock:
+            if self._writer is not None:
+                return
+            ensure_logs_dir()
+            # 先加载项目配置：旧版数据库（按列表序号保存日志）会在生成项目ID时迁移
+            projects = project_registry.get()
+            conn = self._connect()
+            try:
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(self.SCHEMA)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_operation_logs_project ON operation_logs (project_id, id)')
+                conn.commit()
+                self._migrate_json_logs(conn, [project['id'] for project in projects])
+            finally:
+                conn.close()
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def migrate_legacy_project_ids(self, legacy_ids):
+        """把按列表序号保存的旧版日志改为按项目ID保存
+
+        Args:
+            legacy_ids: {列表序号: 项目ID}，序号不在其中的日志（项目已删除）保留为 legacy-<序号>
+
+        Returns:
+            是否进行了迁移（数据库不存在或已是新格式时返回 False）
+        """
+        if not os.path.exists(self.db_path):
+            return False
+        conn = self._connect()
+        try:
+            columns = {row['name']: row['type'] for row in conn.execute('PRAGMA table_info(operation_logs)')}
+            if columns.get('project_id', '').upper() != 'INTEGER':
+                return False
+            conn.execute('BEGIN')
+            try:
+                conn.execute('ALTER TABLE operation_logs RENAME TO operation_logs_legacy')
+                conn.execute('DROP INDEX IF EXISTS idx_operation_logs_project')
+                conn.execute(self.SCHEMA)
+                conn.execute('CREATE TEMP TABLE legacy_project_ids (legacy INTEGER PRIMARY KEY, project_id TEXT NOT NULL)')
+                conn.executemany('INSERT INTO legacy_project_ids VALUES (?, ?)', legacy_ids.items())
+                conn.execute(
+                    'INSERT INTO operation_logs (id, project_id, created_at, timestamp, project_name, operation, success, output, ssh_mode, ssh_host, extra) '
+                    "SELECT l.id, COALESCE(m.project_id, 'legacy-' || l.project_id), l.created_at, l.timestamp, l.project_name, "
+                    'l.operation, l.success, l.output, l.ssh_mode, l.ssh_host, l.extra '
+                    'FROM operation_logs_legacy l LEFT JOIN legacy_project_ids m ON m.legacy = l.project_id'
+                )
+                conn.execute('DROP TABLE operation_logs_legacy')
+                conn.execute('CREATE INDEX idx_operation_logs_project ON operation_logs (project_id, id)')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return True
+        finally:
+            conn.close()
+
+    def _migrate_json_logs(self, conn, project_ids):
+        """导入旧版 logs/project_<序号>.json 日志，导入后重命名为 .migrated"""
+        for name in os.listdir(LOGS_DIR):
+            if not (name.startswith('project_') and name.endswith('.json')):
+                continue
+            path = os.path.join(LOGS_DIR, name)
+            try:
+                index = int(name[len('project_'):-len('.json')])
+                project_id = project_ids[index] if index < len(project_ids) else f'legacy-{index}'
+                with open(path, 'r', encoding='utf-8') as f:
+                    logs = json.load(f)
+                # 旧文件中最新的在前面，按时间顺序导入
+                for log in reversed(logs):
+                    try:
+                        created_at = datetime.strptime(log['timestamp'], '%Y-%m-%d %H:%M:%S').timestamp()
+                    except (KeyError, ValueError):
+                        created_at = time.time()
+                    self._insert(conn, project_id, created_at, log)
+                conn.commit()
+                os.rename(path, path + '.migrated')
+            except Exception as e:
+                print(f"迁移日志文件失败 {name}: {e}")
+
+    @staticmethod
+    def _insert(conn, project_id, created_at, entry):
+        known = ('id', 'timestamp', 'project_name', 'operation', 'success', 'output', 'ssh_mode', 'ssh_host')
+        extra = {k: v for k, v in entry.items() if k not in known}
+        conn.execute(
+            'INSERT INTO operation_logs (project_id, created_at, timestamp, project_name, operation, success, output, ssh_mode, ssh_host, extra) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                project_id, created_at, entry.get('timestamp', ''), entry.get('project_name', ''),
+                entry.get('operation', ''), int(bool(entry.get('success'))), entry.get('output', ''),
+                int(bool(entry.get('ssh_mode'))), entry.get('ssh_host', ''),
+                json.dumps(extra, ensure_ascii=False) if extra else None
+            )
+        )
+
+    def append(self, project_id, entry):
+        """追加一条日志（放入写队列后立即返回）"""
+        self.start()
+        self._queue.put((project_id, time.time(), entry))
 
-        log_file = os.path.join(LOGS_DIR, f'project_{project_id}.json')
+    def _write_loop(self):
+        conn = self._connect()
+        last_retention = 0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            # 把队列中已积压的日志合并到同一个事务中写入
+            batch = [item]
+            stop = False
+            while len(batch) < 100:
+                try:
+                    next_item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_item is None:
+                    stop = True
+                    break
+                batch.append(next_item)
 
-        # 加载现有日志
-        logs = []
-        if os.path.exists(log_file):
-            with open(log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
+            try:
+                for project_id, created_at, entry in batch:
+                    self._insert(conn, project_id, created_at, entry)
+                conn.commit()
 
-        # 添加新日志（限制输出长度）
-        max_output_length = 10000
-        truncated_output = output[:max_output_length] + '...(输出过长，已截断)' if len(output) > max_output_length else output
+                if time.time() - last_retention > LOG_RETENTION_CHECK_INTERVAL:
+                    self._apply_retention(conn)
+                    last_retention = time.time()
+            except Exception as e:
+                print(f"保存日志失败: {e}")
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+
+            if stop:
+                break
+        conn.close()
+
+    def _apply_retention(self, conn):
+        """按条数、时间和数据库体积清理旧日志"""
+        retention = dict(LOG_RETENTION_DEFAULTS)
+        retention.update(settings_registry.get().get('log_retention', {}))
+
+        conn.execute('DELETE FROM operation_logs WHERE created_at < ?',
+                     (time.time() - retention['max_age_days'] * 86400,))
+
+        max_entries = retention['max_entries_per_project']
+        for (project_id,) in conn.execute('SELECT DISTINCT project_id FROM operation_logs').fetchall():
+            conn.execute(
+                'DELETE FROM operation_logs WHERE project_id = ? AND id <= '
+                '(SELECT id FROM operation_logs WHERE project_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (project_id, project_id, max_entries)
+            )
+        conn.commit()
+
+        max_bytes = retention['max_db_mb'] * 1024 * 1024
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        while True:
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if (page_count - freelist) * page_size <= max_bytes:
+                break
+            # 每次删除最旧的 10%
+            total = conn.execute('SELECT COUNT(*) FROM operation_logs').fetchone()[0]
+            if total == 0:
+                break
+            conn.execute(
+                'DELETE FROM operation_logs WHERE id IN (SELECT id FROM operation_logs ORDER BY id LIMIT ?)',
+                (max(1, total // 10),)
+            )
+            conn.commit()
+        conn.execute('PRAGMA incremental_vacuum')
+        conn.commit()
+
+        cleanup_output_artifacts(retention['max_age_days'])
+
+    def query(self, project_id, limit=50, before_id=None):
+        """按日志ID倒序分页读取，before_id 为上一页最后一条的ID
+
+        Returns:
+            (日志列表, 该项目日志总数, 是否还有更早的日志)
+        """
+        self.start()
+        conn = self._connect()
+        try:
+            # 多取一条用于判断是否还有下一页
+            if before_id is None:
+                rows = conn.execute(
+                    'SELECT * FROM operation_logs WHERE project_id = ? ORDER BY id DESC LIMIT ?',
+                    (project_id, limit + 1)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    'SELECT * FROM operation_logs WHERE project_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                    (project_id, before_id, limit + 1)
+                ).fetchall()
+            total = conn.execute('SELECT COUNT(*) FROM operation_logs WHERE project_id = ?',
+                                 (project_id,)).fetchone()[0]
+        finally:
+            conn.close()
+        return [self._row_to_entry(row) for row in rows[:limit]], total, len(rows) > limit
+
+    @staticmethod
+    def _row_to_entry(row):
+        entry = {
+            'id': row['id'],
+            'timestamp': row['timestamp'],
+            'project_name': row['project_name'],
+            'operation': row['operation'],
+            'success': bool(row['success']),
+            'output': row['output'],
+            'ssh_mode': bool(row['ssh_mode']),
+            'ssh_host': row['ssh_host']
+        }
+        if row['extra']:
+            entry.update(json.loads(row['extra']))
+        return entry
+
+    def flush(self):
+        """等待队列中的日志全部写入"""
+        if self._writer is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=10)
+
+operation_log_store = OperationLogStore(os.path.join(LOGS_DIR, 'operations.db'))
+atexit.register(operation_log_store.close)
+
+def save_operation_log(project_id, project_name, operation_type, success, output='', ssh_mode=False, ssh_host='', extra=None):
+    """保存操作日志（写入队列，由后台线程落盘）"""
+    try:
+        # 限制输出长度
+        truncated_output = output[:LOG_MAX_OUTPUT_LENGTH] + '...(输出过长，已截断)' if len(output) > LOG_MAX_OUTPUT_LENGTH else output
 
         log_entry = {
-            'id': len(logs),
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'project_name': project_name,
             'operation': operation_type,
@@ -94,70 +863,245 @@ def save_operation_log(project_id, project_name, operation_type, success, output
             'ssh_mode': ssh_mode,
             'ssh_host': ssh_host if ssh_mode else ''
         }
+        if extra:
+            log_entry.update(extra)
 
-        logs.insert(0, log_entry)  # 最新的在前面
-
-        # 只保留最近100条日志
-        logs = logs[:100]
-
-        # 保存日志
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(logs, f, indent=2, ensure_ascii=False)
-
+        operation_log_store.append(project_id, log_entry)
         return True
     except Exception as e:
         print(f"保存日志失败: {e}")
         return False
 
-def load_operation_logs(project_id, limit=50):
-    """加载项目操作日志"""
+def load_operation_logs(project_id, limit=50, before_id=None):
+    """加载项目操作日志，返回 (日志列表, 总条数, 是否还有更早的日志)"""
     try:
-        ensure_logs_dir()
-        log_file = os.path.join(LOGS_DIR, f'project_{project_id}.json')
+        return operation_log_store.query(project_id, limit, before_id)
+    except Exception as e:
+        print(f"加载日志失败: {e}")
+        return [], 0, False
+
+# 完整输出文件：logs/runs/project_<项目ID>/<run_id>.log.gz
+RUNS_DIR = os.path.join(LOGS_DIR, 'runs')
+OUTPUT_MEMBER_SIZE = 256 * 1024     # 每个 gzip member 对应的原始数据大小
+OUTPUT_FLUSH_INTERVAL = 5           # 有输出时最长多久写出一个 member（秒），便于运行中查看
+OUTPUT_SUMMARY_LINES = 1000         # 操作日志中保留的输出行数
+RUN_ID_PATTERN = re.compile(r'^[0-9]{14}-[0-9a-f]{6}$')
+
+def new_run_id():
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+def output_artifact_paths(project_id, run_id):
+    """返回 (压缩输出文件, 索引文件) 路径"""
+    run_dir = os.path.join(RUNS_DIR, f'project_{project_id}')
+    return os.path.join(run_dir, f'{run_id}.log.gz'), os.path.join(run_dir, f'{run_id}.idx')
+
+def migrate_legacy_output_artifacts(legacy_ids):
+    """把旧版按列表序号保存的输出目录 project_<序号> 重命名为 project_<项目ID>"""
+    if not os.path.isdir(RUNS_DIR):
+        return
+    for name in os.listdir(RUNS_DIR):
+        index = name[len('project_'):]
+        if not (name.startswith('project_') and index.isdigit()):
+            continue
+        project_id = legacy_ids.get(int(index), f'legacy-{index}')
+        try:
+            os.rename(os.path.join(RUNS_DIR, name), os.path.join(RUNS_DIR, f'project_{project_id}'))
+        except OSError as e:
+            print(f"迁移输出目录失败 {name}: {e}")
 
-        if not os.path.exists(log_file):
-            return []
+class OutputArtifactWriter:
+    """把一次操作的完整输出流式写入 gzip 文件
 
-        with open(log_file, 'r', encoding='utf-8') as f:
-            logs = json.load(f)
+    输出按 OUTPUT_MEMBER_SIZE 切分为多个独立的 gzip member 顺序拼接（整体仍是合法的
+    gzip 文件，可直接 zcat），每个 member 的 "原始偏移 压缩偏移 原始长度" 记录在 .idx
+    索引中，读取任意范围时只需解压覆盖该范围的 member。内存占用不超过一个 member。
+    """
 
-        return logs[:limit]
-    except Exception as e:
-        print(f"加载日志失败: {e}")
-        return []
+    def __init__(self, project_id, run_id):
+        self.path, self.index_path = output_artifact_paths(project_id, run_id)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, 'wb')
+        self._index = open(self.index_path, 'w', encoding='utf-8')
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self.size = 0            # 已写出的原始字节数
+        self.closed = False
+
+    def write(self, text):
+        data = text.encode('utf-8', errors='replace')
+        with self._lock:
+            if self.closed:
+                return
+            self._buffer += data
+            if len(self._buffer) >= OUTPUT_MEMBER_SIZE or time.time() - self._last_flush > OUTPUT_FLUSH_INTERVAL:
+                self._flush_member()
+
+    def _flush_member(self):
+        if not self._buffer:
+            return
+        compressed = gzip.compress(bytes(self._buffer), compresslevel=6, mtime=0)
+        self._index.write(f"{self.size} {self._file.tell()} {len(self._buffer)}\n")
+        self._file.write(compressed)
+        self._file.flush()
+        self._index.flush()
+        self.size += len(self._buffer)
+        self._buffer = bytearray()
+        self._last_flush = time.time()
+
+    def flush(self):
+        """写出缓冲区中的数据（读取运行中的输出前调用）"""
+        with self._lock:
+            if not self.closed:
+                self._flush_member()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self._flush_member()
+            self._file.close()
+            self._index.close()
+            self.closed = True
+
+# 正在写入的输出文件，读取时先刷新缓冲区
+active_artifacts = {}
+active_artifacts_lock = threading.Lock()
+
+def read_output_index(index_path):
+    """读取 member 索引，返回 [(原始偏移, 压缩偏移, 原始长度)]"""
+    members = []
+    with open(index_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3:
+                members.append(tuple(int(x) for x in parts))
+    return members
+
+def read_output_range(project_id, run_id, start=0, end=None):
+    """读取完整输出中 [start, end) 范围的原始字节，只解压覆盖该范围的 member
+
+    Args:
+        start: 起始偏移，负数表示读取最后 -start 个字节
+        end: 结束偏移（不包含），None 表示读到末尾
+
+    Returns:
+        (数据, 实际起始偏移, 输出总长度)
+    """
+    with active_artifacts_lock:
+        writer = active_artifacts.get(run_id)
+    if writer:
+        writer.flush()
+
+    path, index_path = output_artifact_paths(project_id, run_id)
+    members = read_output_index(index_path)
+    total = members[-1][0] + members[-1][2] if members else 0
+
+    if start < 0:
+        start = max(0, total + start)
+    start = min(start, total)
+    end = total if end is None else max(start, min(end, total))
+
+    chunks = []
+    with open(path, 'rb') as f:
+        for i, (raw_offset, gz_offset, raw_length) in enumerate(members):
+            if raw_offset + raw_length <= start or raw_offset >= end:
+                continue
+            f.seek(gz_offset)
+            gz_length = members[i + 1][1] - gz_offset if i + 1 < len(members) else -1
+            data = gzip.decompress(f.read(gz_length))
+            chunks.append(data[max(0, start - raw_offset):end - raw_offset])
+    return b''.join(chunks), start, total
+
+def cleanup_output_artifacts(max_age_days):
+    """删除超过保留天数的完整输出文件"""
+    if not os.path.exists(RUNS_DIR):
+        return
+    cutoff = time.time() - max_age_days * 86400
+    for root, dirs, files in os.walk(RUNS_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class OperationRecorder:
+    """记录一次操作的输出：完整输出写入压缩文件，前若干行作为摘要保存到操作日志"""
+
+    def __init__(self, project_id, project):
+        self.project_id = project_id
+        self.project = project
+        self.run_id = new_run_id()
+        self.started = time.monotonic()
+        self.steps = []  # 每个命令步骤的耗时、输出字节数和退出码
+        self.artifact = OutputArtifactWriter(project_id, self.run_id)
+        self.summary = []
+        with active_artifacts_lock:
+            active_artifacts[self.run_id] = self.artifact
+
+    def write(self, content):
+        self.artifact.write(content)
+        if len(self.summary) < OUTPUT_SUMMARY_LINES:
+            self.summary.append(content)
+
+    def record_step(self, step, elapsed, output_bytes, return_code):
+        self.steps.append({'step': step, 'elapsed': round(elapsed, 3), 'output_bytes': output_bytes,
+                           'exit_code': return_code})
+
+    def close(self):
+        self.artifact.close()
+        with active_artifacts_lock:
+            active_artifacts.pop(self.run_id, None)
+
+    def finish(self, operation_type, success, extra=None):
+        """结束记录并保存操作日志，extra 为需要一并保存的附加字段"""
+        self.close()
+        duration = time.monotonic() - self.started
+        ssh_config = self.project.get('ssh', {})
+        ssh_mode = ssh_config.get('enabled', False)
+        # 自定义命令的日志类型包含命令本身，指标中归为一类
+        operation = '自定义命令' if operation_type.startswith('自定义命令') else operation_type
+        OPERATION_DURATION.observe(duration, project=self.project['name'], host=metric_host(self.project),
+                                   operation=operation, result='success' if success else 'error')
+        save_operation_log(
+            self.project_id, self.project['name'], operation_type, success, ''.join(self.summary),
+            ssh_mode, ssh_config.get('host', ''),
+            extra={**(extra or {}), 'run_id': self.run_id, 'output_size': self.artifact.size,
+                   'duration': round(duration, 3), 'steps': self.steps}
+        )
 
 def load_projects():
-    """加载项目配置"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    """加载项目配置（返回列表副本，项目字典本身与缓存共享，请勿原地修改）"""
+    return list(project_registry.get())
 
 def save_projects(projects):
     """保存项目配置"""
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(projects, f, indent=4, ensure_ascii=False)
+        project_registry.store(list(projects))
         return True
     except Exception as e:
         print(f"保存项目配置失败: {e}")
         return False
 
+def build_command_env():
+    """本地命令的环境变量"""
+    # 获取当前脚本目录（安装目录）
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return {
+        **os.environ,
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+        # 为 git 命令添加 safe.directory 配置，避免 dubious ownership 错误
+        'GIT_CONFIG_COUNT': '1',
+        'GIT_CONFIG_KEY_0': 'safe.directory',
+        'GIT_CONFIG_VALUE_0': script_dir
+    }
+
 def run_command(command, cwd=None):
     """执行命令并返回输出"""
     try:
-        # 获取当前脚本目录（安装目录）
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-
-        # 构建环境变量
-        env = {
-            **os.environ,
-            'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
-            # 为 git 命令添加 safe.directory 配置，避免 dubious ownership 错误
-            'GIT_CONFIG_COUNT': '1',
-            'GIT_CONFIG_KEY_0': 'safe.directory',
-            'GIT_CONFIG_VALUE_0': script_dir
-        }
+        env = build_command_env()
 
         # 使用 bash 并设置完整的环境
         result = subprocess.run(
@@ -191,57 +1135,225 @@ def run_command(command, cwd=None):
             'returncode': -1
         }
 
-def run_ssh_command(command, ssh_config, cwd=None):
-    """通过SSH执行命令并返回输出（非流式）"""
-    ssh_client = None
-    try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        host = ssh_config.get('host')
-        port = ssh_config.get('port', 22)
-        user = ssh_config.get('user', 'root')
-        key_file = ssh_config.get('key_file')
-        password = ssh_config.get('password')
-
-        if not host:
-            return {
-                'success': False,
-                'stdout': '',
-                'stderr': 'SSH host not configured',
-                'returncode': -1
-            }
+# SSH 连接池配置
+SSH_CONNECT_TIMEOUT = 10          # 建立连接超时（秒）
+SSH_KEEPALIVE_INTERVAL = 30       # transport keepalive 间隔（秒）
+SSH_POOL_IDLE_TIMEOUT = 300       # 连接空闲超过该时间后关闭（秒）
+SSH_MAX_SESSIONS_PER_HOST = 8     # 每个连接同时打开的最大会话数，需小于 sshd 的 MaxSessions（默认10）
+SSH_SESSION_WAIT_TIMEOUT = 30     # 等待空闲会话的最长时间（秒）
+SSH_STREAM_WAIT_MAX = 1.0         # 流式读取时单次等待的最长时间（秒）
+
+def build_ssh_connect_kwargs(ssh_config):
+    """根据项目SSH配置构建 paramiko connect 参数"""
+    connect_kwargs = {
+        'hostname': ssh_config.get('host'),
+        'port': ssh_config.get('port', 22),
+        'username': ssh_config.get('user', 'root'),
+        'timeout': SSH_CONNECT_TIMEOUT
+    }
 
-        # 连接参数
-        connect_kwargs = {
-            'hostname': host,
-            'port': port,
-            'username': user,
-            'timeout': 10
-        }
+    key_file = ssh_config.get('key_file')
+    password = ssh_config.get('password')
 
-        # 认证方式
-        if key_file and os.path.exists(key_file):
-            connect_kwargs['key_filename'] = key_file
-        elif password:
-            connect_kwargs['password'] = password
-        else:
-            # 尝试使用默认密钥
-            default_key = os.path.expanduser('~/.ssh/id_rsa')
-            if os.path.exists(default_key):
-                connect_kwargs['key_filename'] = default_key
+    # 认证方式
+    if key_file and os.path.exists(key_file):
+        connect_kwargs['key_filename'] = key_file
+    elif password:
+        connect_kwargs['password'] = password
+    else:
+        # 尝试使用默认密钥
+        default_keys = [
+            os.path.expanduser('~/.ssh/id_rsa'),
+            os.path.expanduser('~/.ssh/id_ed25519')
+        ]
+        for key in default_keys:
+            if os.path.exists(key):
+                connect_kwargs['key_filename'] = key
+                break
+
+    return connect_kwargs
+
+class SSHPoolExhausted(Exception):
+    """等待空闲SSH会话超时"""
+
+class PooledSSHConnection:
+    """连接池中的单个SSH连接，多个命令共享同一个 transport，各自使用独立 channel"""
+
+    def __init__(self, key, max_sessions):
+        self.key = key
+        self.client = None
+        self.lock = threading.Lock()
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.active = 0
+        self.last_used = time.time()
+        self.last_checked = 0
+
+    def is_alive(self):
+        """检查连接是否可用（transport 仍处于活动状态）"""
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+    def _connect(self, ssh_config):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        started = time.monotonic()
+        try:
+            client.connect(**build_ssh_connect_kwargs(ssh_config))
+        except Exception:
+            SSH_CONNECT_DURATION.observe(time.monotonic() - started, host=ssh_config.get('host', ''), result='error')
+            raise
+        SSH_CONNECT_DURATION.observe(time.monotonic() - started, host=ssh_config.get('host', ''), result='success')
+        client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        self.client = client
+        self.last_checked = time.time()
+
+    def _health_check(self):
+        """对空闲较久的连接发送 ignore 包，提前发现已断开的连接"""
+        if time.time() - self.last_checked < SSH_KEEPALIVE_INTERVAL:
+            return self.is_alive()
+        try:
+            self.client.get_transport().send_ignore()
+            self.last_checked = time.time()
+            return True
+        except Exception:
+            return False
+
+    def open_channel(self, ssh_config):
+        """打开一个新的会话 channel，必要时（重新）建立连接"""
+        with self.lock:
+            if self.client is None or not self.is_alive() or not self._health_check():
+                self.close()
+                self._connect(ssh_config)
+            try:
+                return self.client.get_transport().open_session(timeout=SSH_CONNECT_TIMEOUT)
+            except (paramiko.SSHException, EOFError, OSError):
+                # 连接已失效（服务器重启、网络中断等），重连一次后重试
+                self.close()
+                self._connect(ssh_config)
+                return self.client.get_transport().open_session(timeout=SSH_CONNECT_TIMEOUT)
+
+    def close(self):
+        if self.client:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+            self.client = None
+
+class SSHConnectionPool:
+    """SSH 连接池：按 (host, port, user, key) 复用连接，带 keepalive、空闲回收和会话数上限"""
+
+    def __init__(self, idle_timeout=SSH_POOL_IDLE_TIMEOUT, max_sessions=SSH_MAX_SESSIONS_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    @staticmethod
+    def make_key(ssh_config):
+        return (
+            ssh_config.get('host'),
+            int(ssh_config.get('port', 22)),
+            ssh_config.get('user', 'root'),
+            ssh_config.get('key_file') or ''
+        )
 
-        ssh_client.connect(**connect_kwargs)
+    def _get_connection(self, ssh_config):
+        """取出（或创建）连接并登记为使用中；active 由 self._lock 保护，
+        这样 evict_idle 不会在取出连接和开始使用之间把它回收掉"""
+        key = self.make_key(ssh_config)
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = PooledSSHConnection(key, self.max_sessions)
+                self._connections[key] = conn
+            conn.active += 1
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+                self._reaper.start()
+            return conn
+
+    def _release_connection(self, conn):
+        with self._lock:
+            conn.active -= 1
+            conn.last_used = time.time()
+
+    @contextmanager
+    def session(self, ssh_config, wait_timeout=SSH_SESSION_WAIT_TIMEOUT):
+        """获取一个独立的会话 channel，退出时关闭 channel 并归还会话名额"""
+        conn = self._get_connection(ssh_config)
+        if not conn.sessions.acquire(timeout=wait_timeout):
+            self._release_connection(conn)
+            raise SSHPoolExhausted(f"SSH会话数已达上限 ({self.max_sessions})，等待超时")
+
+        channel = None
+        try:
+            channel = conn.open_channel(ssh_config)
+            yield channel
+        finally:
+            if channel is not None:
+                try:
+                    channel.close()
+                except Exception:
+                    pass
+            self._release_connection(conn)
+            conn.sessions.release()
+
+    def _reap_loop(self):
+        """后台回收空闲或已断开的连接"""
+        while True:
+            time.sleep(min(60, self.idle_timeout))
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.time()
+        with self._lock:
+            for key, conn in list(self._connections.items()):
+                # open_channel 建立连接时会持有 conn.lock（最长 SSH_CONNECT_TIMEOUT），
+                # 此时连接正在使用，直接跳过，避免一个慢主机阻塞所有主机的 _get_connection
+                if not conn.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if conn.active:
+                        continue
+                    if now - conn.last_used > self.idle_timeout or (conn.client and not conn.is_alive()):
+                        conn.close()
+                        del self._connections[key]
+                finally:
+                    conn.lock.release()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections.values():
+                with conn.lock:
+                    conn.close()
+            self._connections.clear()
+
+ssh_pool = SSHConnectionPool()
+
+def run_ssh_command(command, ssh_config, cwd=None):
+    """通过SSH执行命令并返回输出（非流式）"""
+    if not ssh_config.get('host'):
+        return {
+            'success': False,
+            'stdout': '',
+            'stderr': 'SSH host not configured',
+            'returncode': -1
+        }
 
+    try:
         # 如果指定了工作目录，添加 cd 命令
         if cwd:
             command = f"cd {cwd} && {command}"
 
-        stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=False, timeout=30)
+        with ssh_pool.session(ssh_config) as channel:
+            channel.settimeout(30)
+            channel.exec_command(command)
 
-        stdout_data = stdout.read().decode('utf-8')
-        stderr_data = stderr.read().decode('utf-8')
-        return_code = stdout.channel.recv_exit_status()
+            stdout_data = channel.makefile('rb').read().decode('utf-8')
+            stderr_data = channel.makefile_stderr('rb').read().decode('utf-8')
+            return_code = channel.recv_exit_status()
 
         return {
             'success': return_code == 0,
@@ -271,9 +1383,6 @@ def run_ssh_command(command, ssh_config, cwd=None):
             'stderr': f'SSH error: {str(e)}',
             'returncode': -1
         }
-    finally:
-        if ssh_client:
-            ssh_client.close()
 
 def execute_command(command, project, cwd=None):
     """根据项目配置选择本地或SSH执行（非流式）"""
@@ -287,89 +1396,171 @@ def execute_command(command, project, cwd=None):
         # 本地模式
         return run_command(command, actual_cwd)
 
+# 流式输出读取配置
+STREAM_READ_SIZE = 64 * 1024        # 每次读取的最大字节数
+STREAM_MAX_LINE = 64 * 1024         # 超过该长度仍无换行时直接输出（如进度条）
+PROCESS_KILL_GRACE = 5              # 终止进程组时 SIGTERM 后等待的秒数
+
+class LineSplitter:
+    """把任意分块的字节流切分为文本行
+
+    使用增量解码器，多字节 UTF-8 字符被截断在两个块之间时也能正确解码；
+    未结束的行暂存在分片列表中，长行不会被反复拼接。
+    单独的 \r（git --progress、进度条等刷新同一行）不结束一行：完整的行只保留最后一次刷新的内容，
+    被刷新掉的片段单独作为 progress 返回，供实时进度解析使用，不会逐条写入输出和日志。\r\n 视为一个换行。
+    """
+
+    def __init__(self, max_line=STREAM_MAX_LINE):
+        self.max_line = max_line
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._parts = []
+        self._size = 0
+        self._pending_cr = False
+        self._last_redraw = ''
+
+    def feed(self, data):
+        """输入一块字节，返回 [(类型, 文本)]：output 为完整的行（含换行符），progress 为被 \r 刷新掉的片段"""
+        text = self._decoder.decode(data)
+        if self._pending_cr:
+            text = '\r' + text
+            self._pending_cr = False
+        if text.endswith('\r'):
+            # 块末尾的 \r 要等下一块才知道是否属于 \r\n
+            text = text[:-1]
+            self._pending_cr = True
+
+        items = []
+        for index, line in enumerate(text.replace('\r\n', '\n').split('\n')):
+            if index:
+                items.append(('output', self._end_line() + '\n'))
+            segments = line.split('\r')
+            for segment in segments[:-1]:
+                self._append(segment)
+                redraw = self._take()
+                if redraw:
+                    self._last_redraw = redraw
+                    items.append(('progress', redraw))
+            self._append(segments[-1])
+            if self._size >= self.max_line:
+                items.append(('output', self._end_line()))
+        return items
+
+    def flush(self):
+        """返回剩余未换行的内容"""
+        self._append(self._decoder.decode(b'', final=True))
+        self._pending_cr = False
+        return self._end_line()
+
+    def _append(self, text):
+        if text:
+            self._parts.append(text)
+            self._size += len(text)
+
+    def _end_line(self):
+        # 行尾的 \r 之后没有内容时，以最后一次刷新的内容作为这一行
+        text = self._take() or self._last_redraw
+        self._last_redraw = ''
+        return text
+
+    def _take(self):
+        text = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        return text
+
+def kill_process_group(process):
+    """终止进程及其所有子进程（如 docker compose 启动的子进程）"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=PROCESS_KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
 def run_command_stream(command, cwd=None, timeout=3600, idle_timeout=300):
     """执行命令并实时流式返回输出（生成器），最后一行返回退出码
 
+    命令在独立的进程组中运行，超时或调用方提前结束时整个进程组都会被终止。
+
     Args:
         command: 要执行的命令
         cwd: 工作目录
         timeout: 总超时时间（秒），默认1小时
         idle_timeout: 空闲超时时间（秒），默认5分钟无输出则超时
     """
-    return_code = -1
+    process = None
     try:
-        # 获取当前脚本目录（安装目录）
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-
-        # 构建环境变量
-        env = {
-            **os.environ,
-            'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
-            # 为 git 命令添加 safe.directory 配置，避免 dubious ownership 错误
-            'GIT_CONFIG_COUNT': '1',
-            'GIT_CONFIG_KEY_0': 'safe.directory',
-            'GIT_CONFIG_VALUE_0': script_dir
-        }
+        env = build_command_env()
 
-        # 使用 Popen 来实时获取输出
         process = subprocess.Popen(
             command,
             shell=True,
             cwd=cwd,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,  # 合并 stderr 到 stdout
-            text=True,
             executable='/bin/bash',
             env=env,
-            bufsize=1,  # 行缓冲
-            universal_newlines=True
+            start_new_session=True     # 独立进程组，便于整体终止
         )
 
-        # 记录开始时间和最后输出时间
-        start_time = time.time()
-        last_output_time = start_time
-
-        # 实时读取输出 - 添加超时检测
-        import select
-        while True:
-            # 检查总超时
-            if time.time() - start_time > timeout:
-                process.kill()
-                yield ('output', f"\n[超时] 命令执行超过 {timeout} 秒，已强制终止\n")
-                yield ('returncode', -1)
-                return
-
-            # 检查空闲超时
-            if time.time() - last_output_time > idle_timeout:
-                process.kill()
-                yield ('output', f"\n[空闲超时] 命令超过 {idle_timeout} 秒无输出，已强制终止\n")
-                yield ('output', f"提示: 可能是交互式命令等待输入，请使用非交互式参数（如: apt-get -y, docker build --no-cache）\n")
-                yield ('returncode', -1)
-                return
-
-            # 使用select检查是否有数据可读（超时0.1秒）
-            if process.stdout in select.select([process.stdout], [], [], 0.1)[0]:
-                line = process.stdout.readline()
-                if line:
-                    yield ('output', line)
-                    last_output_time = time.time()
-                else:
-                    # 没有更多数据，进程可能已结束
-                    break
-            else:
-                # 检查进程是否还在运行
-                if process.poll() is not None:
+        fd = process.stdout.fileno()
+        os.set_blocking(fd, False)
+        splitter = LineSplitter()
+        deadline = time.monotonic() + timeout
+        idle_deadline = time.monotonic() + idle_timeout
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                # 只在有数据或到达超时时间时唤醒
+                wait_time = min(deadline, idle_deadline) - time.monotonic()
+                if wait_time <= 0 or not selector.select(wait_time):
+                    now = time.monotonic()
+                    if now >= deadline:
+                        kill_process_group(process)
+                        yield ('output', f"\n[超时] 命令执行超过 {timeout} 秒，已强制终止\n")
+                        yield ('returncode', -1)
+                        return
+                    if now >= idle_deadline:
+                        kill_process_group(process)
+                        yield ('output', f"\n[空闲超时] 命令超过 {idle_timeout} 秒无输出，已强制终止\n")
+                        yield ('output', f"提示: 可能是交互式命令等待输入，请使用非交互式参数（如: apt-get -y, docker build --no-cache）\n")
+                        yield ('returncode', -1)
+                        return
+                    continue
+
+                try:
+                    data = os.read(fd, STREAM_READ_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
                     break
+                idle_deadline = time.monotonic() + idle_timeout
+                yield from splitter.feed(data)
 
-        process.stdout.close()
-        return_code = process.wait()
+        tail = splitter.flush()
+        if tail:
+            yield ('output', tail)
 
+        process.stdout.close()
         # 返回退出码
-        yield ('returncode', return_code)
+        yield ('returncode', process.wait())
 
     except Exception as e:
         yield ('output', f"\n[异常] {str(e)}\n")
         yield ('returncode', -1)
+    finally:
+        # 调用方提前结束（如任务被取消）时不留下孤儿进程
+        if process is not None and process.poll() is None:
+            kill_process_group(process)
+        if process is not None and not process.stdout.closed:
+            process.stdout.close()
 
 def run_ssh_command_stream(command, ssh_config, cwd=None, timeout=3600, idle_timeout=300):
     """通过SSH执行命令并实时流式返回输出（生成器）
@@ -381,118 +1572,72 @@ def run_ssh_command_stream(command, ssh_config, cwd=None, timeout=3600, idle_tim
         timeout: 总超时时间（秒），默认1小时
         idle_timeout: 空闲超时时间（秒），默认5分钟无输出则超时
     """
-    ssh_client = None
     return_code = -1
 
     try:
-        # 创建SSH客户端
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # 连接参数
-        host = ssh_config.get('host')
-        port = ssh_config.get('port', 22)
-        user = ssh_config.get('user', 'root')
-        key_file = ssh_config.get('key_file')
-        password = ssh_config.get('password')
-
-        # 连接到远程服务器
-        connect_kwargs = {
-            'hostname': host,
-            'port': port,
-            'username': user,
-            'timeout': 10
-        }
-
-        if key_file and os.path.exists(key_file):
-            connect_kwargs['key_filename'] = key_file
-        elif password:
-            connect_kwargs['password'] = password
-        else:
-            # 尝试使用默认密钥
-            default_keys = [
-                os.path.expanduser('~/.ssh/id_rsa'),
-                os.path.expanduser('~/.ssh/id_ed25519')
-            ]
-            for key in default_keys:
-                if os.path.exists(key):
-                    connect_kwargs['key_filename'] = key
-                    break
-
-        ssh_client.connect(**connect_kwargs)
-
         # 如果指定了工作目录，添加cd命令
         if cwd:
             command = f"cd {cwd} && {command}"
 
-        # 执行命令 - 不使用PTY，避免缓冲问题
-        stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=False)
-
-        # 设置channel为非阻塞模式
-        channel = stdout.channel
-        channel.setblocking(0)
-
-        # 实时读取输出 - 使用非阻塞读取，添加超时检测
-        buffer = b''
-        start_time = time.time()
-        last_output_time = start_time
-
-        while not channel.exit_status_ready() or channel.recv_ready() or channel.recv_stderr_ready():
-            # 检查总超时
-            if time.time() - start_time > timeout:
-                channel.close()
-                yield ('output', f"\n[超时] SSH命令执行超过 {timeout} 秒，已强制终止\n")
-                yield ('returncode', -1)
-                return
-
-            # 检查空闲超时
-            if time.time() - last_output_time > idle_timeout:
-                channel.close()
-                yield ('output', f"\n[空闲超时] SSH命令超过 {idle_timeout} 秒无输出，已强制终止\n")
-                yield ('output', f"提示: 可能是交互式命令等待输入，请使用非交互式参数\n")
-                yield ('returncode', -1)
-                return
-
-            # 读取stdout
-            if channel.recv_ready():
-                data = channel.recv(1024)
-                if data:
-                    buffer += data
-                    last_output_time = time.time()
-                    # 按行分割并输出
-                    while b'\n' in buffer:
-                        line, buffer = buffer.split(b'\n', 1)
-                        try:
-                            yield ('output', line.decode('utf-8', errors='replace') + '\n')
-                        except:
-                            yield ('output', line.decode('latin-1') + '\n')
-
-            # 读取stderr
-            if channel.recv_stderr_ready():
-                data = channel.recv_stderr(1024)
-                if data:
-                    buffer += data
-                    last_output_time = time.time()
-                    while b'\n' in buffer:
-                        line, buffer = buffer.split(b'\n', 1)
-                        try:
-                            yield ('output', line.decode('utf-8', errors='replace') + '\n')
-                        except:
-                            yield ('output', line.decode('latin-1') + '\n')
-
-            # 短暂休眠，避免CPU占用过高
-            time.sleep(0.01)
-
-        # 输出剩余的buffer
-        if buffer:
-            try:
-                yield ('output', buffer.decode('utf-8', errors='replace'))
-            except:
-                yield ('output', buffer.decode('latin-1'))
+        with ssh_pool.session(ssh_config) as channel:
+            # 执行命令 - 不使用PTY，避免缓冲问题
+            channel.exec_command(command)
+            channel.setblocking(0)
+
+            # channel.fileno() 在 stdout/stderr 有数据或通道关闭时可读；
+            # stdout 和 stderr 分别切分，交错输出时不会把两边的行拼在一起
+            fd = channel.fileno()
+            stdout_splitter = LineSplitter()
+            stderr_splitter = LineSplitter()
+            deadline = time.monotonic() + timeout
+            idle_deadline = time.monotonic() + idle_timeout
+
+            while True:
+                got_data = False
+                while channel.recv_ready():
+                    data = channel.recv(STREAM_READ_SIZE)
+                    if not data:
+                        break
+                    got_data = True
+                    yield from stdout_splitter.feed(data)
+                while channel.recv_stderr_ready():
+                    data = channel.recv_stderr(STREAM_READ_SIZE)
+                    if not data:
+                        break
+                    got_data = True
+                    yield from stderr_splitter.feed(data)
+
+                now = time.monotonic()
+                if got_data:
+                    idle_deadline = now + idle_timeout
+                elif channel.exit_status_ready() or channel.closed or channel.eof_received:
+                    # 退出状态在所有输出之后到达，此时缓冲区已读空
+                    break
 
-        # 获取退出码
-        return_code = channel.recv_exit_status()
-        yield ('returncode', return_code)
+                if now >= deadline:
+                    channel.close()
+                    yield ('output', f"\n[超时] SSH命令执行超过 {timeout} 秒，已强制终止\n")
+                    yield ('returncode', -1)
+                    return
+                if now >= idle_deadline:
+                    channel.close()
+                    yield ('output', f"\n[空闲超时] SSH命令超过 {idle_timeout} 秒无输出，已强制终止\n")
+                    yield ('output', f"提示: 可能是交互式命令等待输入，请使用非交互式参数\n")
+                    yield ('returncode', -1)
+                    return
+
+                # 等待新数据；退出状态到达不会唤醒 fileno，因此最长等待 SSH_STREAM_WAIT_MAX 秒
+                if not got_data:
+                    select.select([fd], [], [], min(deadline, idle_deadline, now + SSH_STREAM_WAIT_MAX) - now)
+
+            # 输出剩余的buffer
+            for tail in (stdout_splitter.flush(), stderr_splitter.flush()):
+                if tail:
+                    yield ('output', tail)
+
+            # 获取退出码
+            return_code = channel.recv_exit_status()
+            yield ('returncode', return_code)
 
     except paramiko.AuthenticationException:
         yield ('output', f"\n[SSH错误] 认证失败，请检查用户名、密码或密钥\n")
@@ -503,266 +1648,2054 @@ def run_ssh_command_stream(command, ssh_config, cwd=None, timeout=3600, idle_tim
     except socket.timeout:
         yield ('output', f"\n[SSH错误] 连接超时\n")
         yield ('returncode', -1)
+    except SSHPoolExhausted as e:
+        yield ('output', f"\n[SSH错误] {str(e)}\n")
+        yield ('returncode', -1)
     except Exception as e:
         yield ('output', f"\n[异常] {str(e)}\n")
         yield ('returncode', -1)
-    finally:
-        if ssh_client:
-            ssh_client.close()
 
-def execute_command_stream(command, project, cwd=None):
-    """根据项目配置选择本地或SSH执行（生成器）"""
+def execute_command_stream(command, project, cwd=None):
+    """根据项目配置选择本地或SSH执行（生成器）"""
+    ssh_config = project.get('ssh', {})
+
+    if ssh_config.get('enabled', False):
+        # SSH模式
+        actual_cwd = cwd if cwd else project.get('path')
+        for item in run_ssh_command_stream(command, ssh_config, actual_cwd):
+            yield item
+    else:
+        # 本地模式
+        actual_cwd = cwd if cwd else project.get('path')
+        for item in run_command_stream(command, actual_cwd):
+            yield item
+
+# ============ 异步执行层 ============
+# 与上面的同步接口一一对应，在 AsyncRuntime 的事件循环中运行：
+# 大量并发命令（如全部项目的状态探测）只占用一个线程，而不是每个命令一个线程。
+# 流式接口返回异步迭代器，取消迭代即终止命令；同步代码通过 async_runtime.iterate 使用。
+# 目前流式接口只用于自定义命令；部署、Pull & Build、重启、清理在各自的任务线程中执行，
+# 仍使用同步的 execute_command_stream（本身已是事件驱动读取，不轮询）。
+
+ASYNC_MAX_COMMANDS = 64   # 异步执行层同时运行的最大命令数
+
+class AsyncRuntime:
+    """在后台线程中运行的 asyncio 事件循环，同步代码通过 submit 提交协程"""
+
+    def __init__(self, max_commands=ASYNC_MAX_COMMANDS):
+        self.max_commands = max_commands
+        self.loop = None
+        self.limiter = None
+        self._host_limiters = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.limiter = asyncio.Semaphore(self.max_commands)
+                threading.Thread(target=self.loop.run_forever, name='async-runtime', daemon=True).start()
+        return self.loop
+
+    def submit(self, coro):
+        """提交协程，返回 concurrent.futures.Future；对其调用 cancel() 会取消协程"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def iterate(self, async_iterable):
+        """在调用线程中同步迭代异步迭代器；迭代提前结束（关闭生成器）时取消事件循环中的迭代"""
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in async_iterable:
+                    items.put(item)
+            finally:
+                items.put(done)
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    break
+                yield item
+            future.result()
+        finally:
+            future.cancel()
+
+    def host_limiter(self, ssh_config):
+        """每个SSH连接的会话数限制；在事件循环中等待，避免线程池线程阻塞在连接池的会话名额上"""
+        key = ssh_pool.make_key(ssh_config)
+        if key not in self._host_limiters:
+            self._host_limiters[key] = asyncio.Semaphore(SSH_MAX_SESSIONS_PER_HOST)
+        return self._host_limiters[key]
+
+async_runtime = AsyncRuntime()
+
+async def kill_process_group_async(process):
+    """异步终止进程及其所有子进程"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), PROCESS_KILL_GRACE)
+            return
+        except asyncio.TimeoutError:
+            pass
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+async def run_command_async(command, cwd=None, timeout=300):
+    """异步执行本地命令并返回输出，结果格式与 run_command 相同；被取消时终止整个进程组"""
+    async with async_runtime.limiter:
+        try:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                executable='/bin/bash',
+                env=build_command_env(),
+                start_new_session=True
+            )
+        except Exception as e:
+            return {'success': False, 'stdout': '', 'stderr': str(e), 'returncode': -1}
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            return {'success': False, 'stdout': '', 'stderr': f'命令执行超时（超过 {timeout} 秒）', 'returncode': -1}
+        finally:
+            if process.returncode is None:
+                await kill_process_group_async(process)
+
+        return {
+            'success': process.returncode == 0,
+            'stdout': stdout.decode('utf-8', errors='replace'),
+            'stderr': stderr.decode('utf-8', errors='replace'),
+            'returncode': process.returncode
+        }
+
+async def run_command_stream_async(command, cwd=None, timeout=3600, idle_timeout=300):
+    """run_command_stream 的异步版本：异步迭代 ('output'|'progress', 文本)，最后是 ('returncode', 退出码)
+
+    迭代被取消或提前关闭时终止整个进程组。
+    """
+    async with async_runtime.limiter:
+        try:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                executable='/bin/bash',
+                env=build_command_env(),
+                start_new_session=True
+            )
+        except Exception as e:
+            yield ('output', f"\n[异常] {str(e)}\n")
+            yield ('returncode', -1)
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            splitter = LineSplitter()
+            while True:
+                try:
+                    data = await asyncio.wait_for(process.stdout.read(STREAM_READ_SIZE),
+                                                  min(deadline - loop.time(), idle_timeout))
+                except asyncio.TimeoutError:
+                    await kill_process_group_async(process)
+                    if loop.time() >= deadline:
+                        yield ('output', f"\n[超时] 命令执行超过 {timeout} 秒，已强制终止\n")
+                    else:
+                        yield ('output', f"\n[空闲超时] 命令超过 {idle_timeout} 秒无输出，已强制终止\n")
+                    yield ('returncode', -1)
+                    return
+                if not data:
+                    break
+                for item in splitter.feed(data):
+                    yield item
+
+            tail = splitter.flush()
+            if tail:
+                yield ('output', tail)
+            yield ('returncode', await process.wait())
+        finally:
+            if process.returncode is None:
+                await kill_process_group_async(process)
+
+async def ssh_channel_chunks_async(command, ssh_config, cwd=None, timeout=3600, idle_timeout=300):
+    """在连接池的 SSH 会话中执行命令，异步迭代 ('stdout'|'stderr', 字节块)，最后是 ('returncode', 退出码)
+
+    channel.fileno() 注册到事件循环，有数据时才唤醒；超时产生 ('timeout', 说明) 后结束。
+    依次占用主机会话名额和执行层的全局名额，调用方不需要再获取。
+    连接建立和会话申请可能阻塞，放到线程池中执行。
+    """
+    loop = asyncio.get_running_loop()
+    if cwd:
+        command = f"cd {cwd} && {command}"
+
+    # 先等主机名额再占全局名额：等待繁忙主机的命令不会占住全局名额，影响其他主机
+    async with async_runtime.host_limiter(ssh_config), async_runtime.limiter:
+        session = ssh_pool.session(ssh_config)
+        entering = loop.run_in_executor(None, session.__enter__)
+        try:
+            channel = await asyncio.shield(entering)
+        except asyncio.CancelledError:
+            # 取消时会话可能仍在建立，建立完成后立即归还
+            def release(future):
+                if not future.cancelled() and future.exception() is None:
+                    session.__exit__(None, None, None)
+            entering.add_done_callback(release)
+            raise
+        fd = None
+        try:
+            await loop.run_in_executor(None, channel.exec_command, command)
+            channel.setblocking(0)
+
+            readable = asyncio.Event()
+            fd = channel.fileno()
+            loop.add_reader(fd, readable.set)
+            deadline = loop.time() + timeout
+            idle_deadline = loop.time() + idle_timeout
+
+            while True:
+                readable.clear()
+                # 每轮 stdout、stderr 各最多读一块，持续输出的命令也会检查超时并让出事件循环
+                got_data = False
+                if channel.recv_ready():
+                    data = channel.recv(STREAM_READ_SIZE)
+                    if data:
+                        got_data = True
+                        yield ('stdout', data)
+                if channel.recv_stderr_ready():
+                    data = channel.recv_stderr(STREAM_READ_SIZE)
+                    if data:
+                        got_data = True
+                        yield ('stderr', data)
+
+                now = loop.time()
+                if got_data:
+                    idle_deadline = now + idle_timeout
+                elif channel.exit_status_ready() or channel.closed or channel.eof_received:
+                    # 退出状态在所有输出之后到达，此时缓冲区已读空
+                    break
+                if now >= deadline:
+                    yield ('timeout', f"SSH命令执行超过 {timeout} 秒，已强制终止")
+                    return
+                if now >= idle_deadline:
+                    yield ('timeout', f"SSH命令超过 {idle_timeout} 秒无输出，已强制终止")
+                    return
+                if got_data:
+                    await asyncio.sleep(0)
+                    continue
+                # 退出状态到达不会唤醒 fileno，因此最长等待 SSH_STREAM_WAIT_MAX 秒
+                try:
+                    await asyncio.wait_for(readable.wait(), min(deadline, idle_deadline, now + SSH_STREAM_WAIT_MAX) - now)
+                except asyncio.TimeoutError:
+                    pass
+
+            yield ('returncode', await loop.run_in_executor(None, channel.recv_exit_status))
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+            # 关闭 channel（取消时远端命令随之结束）并归还会话名额
+            session.__exit__(None, None, None)
+
+def describe_ssh_error(e):
+    """SSH 异常的提示信息"""
+    if isinstance(e, paramiko.AuthenticationException):
+        return "认证失败，请检查用户名、密码或密钥"
+    if isinstance(e, (socket.timeout, asyncio.TimeoutError)):
+        return "连接超时"
+    if isinstance(e, paramiko.SSHException):
+        return f"SSH连接异常: {str(e)}"
+    return str(e)
+
+async def run_ssh_command_async(command, ssh_config, cwd=None, timeout=300):
+    """异步通过SSH执行命令并返回输出，结果格式与 run_ssh_command 相同"""
+    if not ssh_config.get('host'):
+        return {'success': False, 'stdout': '', 'stderr': 'SSH host not configured', 'returncode': -1}
+
+    stdout, stderr = [], []
+    return_code = -1
+    try:
+        async for kind, data in ssh_channel_chunks_async(command, ssh_config, cwd, timeout=timeout, idle_timeout=timeout):
+            if kind == 'stdout':
+                stdout.append(data)
+            elif kind == 'stderr':
+                stderr.append(data)
+            elif kind == 'timeout':
+                stderr.append(data.encode('utf-8'))
+            else:
+                return_code = data
+    except Exception as e:
+        return {'success': False, 'stdout': '', 'stderr': f'SSH error: {describe_ssh_error(e)}', 'returncode': -1}
+
+    return {
+        'success': return_code == 0,
+        'stdout': b''.join(stdout).decode('utf-8', errors='replace'),
+        'stderr': b''.join(stderr).decode('utf-8', errors='replace'),
+        'returncode': return_code
+    }
+
+async def run_ssh_command_stream_async(command, ssh_config, cwd=None, timeout=3600, idle_timeout=300):
+    """run_ssh_command_stream 的异步版本，stdout 和 stderr 分别按行切分"""
+    splitters = {'stdout': LineSplitter(), 'stderr': LineSplitter()}
+    try:
+        async for kind, data in ssh_channel_chunks_async(command, ssh_config, cwd, timeout, idle_timeout):
+            if kind in splitters:
+                for item in splitters[kind].feed(data):
+                    yield item
+                continue
+            for splitter in splitters.values():
+                tail = splitter.flush()
+                if tail:
+                    yield ('output', tail)
+            if kind == 'timeout':
+                yield ('output', f"\n[超时] {data}\n")
+                yield ('returncode', -1)
+            else:
+                yield ('returncode', data)
+    except Exception as e:
+        yield ('output', f"\n[SSH错误] {describe_ssh_error(e)}\n")
+        yield ('returncode', -1)
+
+async def execute_command_async(command, project, cwd=None, timeout=300):
+    """execute_command 的异步版本：根据项目配置选择本地或SSH执行"""
+    ssh_config = project.get('ssh', {})
+    actual_cwd = cwd if cwd else project.get('path')
+
+    if ssh_config.get('enabled', False):
+        return await run_ssh_command_async(command, ssh_config, actual_cwd, timeout)
+    return await run_command_async(command, actual_cwd, timeout)
+
+def execute_command_stream_async(command, project, cwd=None, timeout=3600, idle_timeout=300):
+    """execute_command_stream 的异步版本：返回输出事件的异步迭代器"""
+    ssh_config = project.get('ssh', {})
+    actual_cwd = cwd if cwd else project.get('path')
+
+    if ssh_config.get('enabled', False):
+        return run_ssh_command_stream_async(command, ssh_config, actual_cwd, timeout, idle_timeout)
+    return run_command_stream_async(command, actual_cwd, timeout, idle_timeout)
+
+# 后台任务配置
+JOB_MAX_WORKERS = 8           # 同时执行的最大任务数
+JOB_HEAVY_KINDS = {'deploy', 'pull-build', 'clean'}   # 占用主机构建名额的重操作
+JOB_COALESCE_KINDS = {'pull-build'}                    # 同一项目已在排队时直接合并的操作
+SCHEDULER_DEFAULTS = {
+    'max_heavy_per_host': 2   # 每台主机（SSH主机或本机）同时执行的重操作数，可在 settings.json 的 scheduler 中覆盖
+}
+JOB_BUFFER_EVENTS = 5000      # 每个任务在内存中保留的最近事件数
+JOB_HISTORY_LIMIT = 50        # 保留的已结束任务数
+JOB_HISTORY_TTL = 1800        # 已结束任务保留时间（秒）
+SSE_KEEPALIVE_INTERVAL = 15   # 无事件时发送心跳的间隔（秒）
+SSE_BATCH_INTERVAL = 0.05     # 输出行合并窗口（秒）
+SSE_BATCH_BYTES = 64 * 1024   # 单个批量输出事件的最大字节数
+SSE_DEFAULTS = {
+    'gzip': False             # 客户端支持时对事件流进行 gzip 压缩，可在 settings.json 的 sse 中开启
+}
+
+def sse_event(data, event_id=None):
+    """格式化一条 SSE 事件"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+class Job:
+    """一次后台操作：输出事件保存在环形缓冲区中，任意数量的客户端可随时接入或断线续传"""
+
+    def __init__(self, kind, project_id, project, operation, listener=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.project_id = project_id
+        self.project = project
+        self.operation = operation
+        self.state = 'queued'           # queued / running / finished
+        self.success = None
+        self.message = ''
+        self.result = {}                # complete 事件中的其他字段（耗时、健康检查结果等）
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.project_key = project_cache_key(project)
+        self.host_key = job_host_key(project)
+        self.heavy = kind in JOB_HEAVY_KINDS
+        self.queue_info = None          # 最近一次推送的排队信息
+        self.listener = listener        # listener(job, event)，每发布一个事件调用一次
+        self._events = deque(maxlen=JOB_BUFFER_EVENTS)
+        self._next_seq = 0
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.state == 'finished'
+
+    def publish(self, event):
+        with self._cond:
+            self._events.append((self._next_seq, event))
+            self._next_seq += 1
+            self._cond.notify_all()
+        if self.listener is not None:
+            self.listener(self, event)
+
+    def wait_events(self, from_seq, timeout):
+        """等待并返回序号 >= from_seq 的事件
+
+        Returns:
+            (事件列表 [(seq, event)], 因缓冲区溢出而丢失的事件数, 任务是否已结束)
+        """
+        with self._cond:
+            if from_seq >= self._next_seq and not self.done:
+                self._cond.wait(timeout)
+            first_seq = self._events[0][0] if self._events else self._next_seq
+            dropped = max(0, first_seq - from_seq)
+            events = [item for item in self._events if item[0] >= from_seq]
+            return events, dropped, self.done
+
+    def mark_running(self):
+        with self._cond:
+            self.state = 'running'
+            self.started_at = time.time()
+            self._cond.notify_all()
+
+    def mark_finished(self):
+        with self._cond:
+            self.state = 'finished'
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'project_id': self.project_id,
+            'project': self.project.get('name', ''),
+            'host': self.host_key,
+            'state': self.state,
+            'success': self.success,
+            'message': self.message,
+            'result': self.result,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'events': self._next_seq
+        }
+
+class JobManagerDraining(Exception):
+    """服务停止过程中提交任务"""
+
+def job_host_key(project):
+    """任务所在主机：SSH主机地址，本地项目为 local"""
+    ssh_config = project.get('ssh', {})
+    if ssh_config.get('enabled', False):
+        return f"{ssh_config.get('host')}:{ssh_config.get('port', 22)}"
+    return 'local'
+
+def get_scheduler_config():
+    config = dict(SCHEDULER_DEFAULTS)
+    config.update(settings_registry.get().get('scheduler', {}))
+    return config
+
+class JobManager:
+    """后台任务调度器
+
+    固定数量的工作线程按 FIFO 顺序从队列中取任务执行，并保证：
+    - 同一项目的操作串行执行；
+    - 每台主机同时执行的重操作（构建、部署、清理）不超过 max_heavy_per_host；
+    - 排队中的重复 Pull & Build 请求合并为同一个任务。
+    排队位置变化时向任务推送 queue 事件。
+    """
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._jobs = OrderedDict()     # job_id -> Job
+        self._queue = deque()
+        self._running = []
+        self._cond = threading.Condition()
+        self._workers = []
+        self.draining = False
+
+    def submit(self, kind, project_id, project, operation, listener=None):
+        """提交任务；operation 为返回事件生成器的无参函数。可合并时返回已在排队的任务"""
+        job = Job(kind, project_id, project, operation, listener)
+        with self._cond:
+            if self.draining:
+                raise JobManagerDraining('服务正在停止，暂不接受新任务')
+            if kind in JOB_COALESCE_KINDS:
+                for queued in self._queue:
+                    if queued.kind == kind and queued.project_key == job.project_key:
+                        return queued
+            self._ensure_workers()
+            self._prune_history()
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._publish_queue_positions()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def snapshot(self):
+        """返回 (执行中任务, 排队任务) 列表"""
+        with self._cond:
+            return list(self._running), list(self._queue)
+
+    def start_detached(self, kind, project, operation):
+        """在独立线程中执行任务，不占用工作线程也不参与调度（用于编排其他任务的批量操作）"""
+        job = Job(kind, None, project, operation)
+        with self._cond:
+            if self.draining:
+                raise JobManagerDraining('服务正在停止，暂不接受新任务')
+            self._prune_history()
+            self._jobs[job.id] = job
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def shutdown(self, timeout):
+        """停止接受新任务并取消排队任务，等待执行中的任务结束
+
+        Returns:
+            超时后仍在执行的任务数
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.draining = True
+            while self._queue:
+                job = self._queue.popleft()
+                job.success = False
+                job.message = '服务正在停止，任务已取消'
+                job.publish({'type': 'complete', 'success': False, 'message': job.message})
+                job.mark_finished()
+            while self._running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self._running)
+
+    def _ensure_workers(self):
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _prune_history(self):
+        """清理过期的已结束任务"""
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.done]
+        for i, job in enumerate(finished):
+            if len(finished) - i > JOB_HISTORY_LIMIT or now - job.finished_at > JOB_HISTORY_TTL:
+                del self._jobs[job.id]
+
+    def _blocked_reason(self, job, max_heavy):
+        """任务暂时不能执行的原因，可以执行时返回 None（需持有 self._cond）"""
+        if any(running.project_key == job.project_key for running in self._running):
+            return '等待该项目正在执行的操作完成'
+        for queued in self._queue:
+            if queued is job:
+                break
+            if queued.project_key == job.project_key:
+                return '等待该项目排在前面的操作'
+        if job.heavy:
+            heavy_running = sum(1 for running in self._running if running.heavy and running.host_key == job.host_key)
+            if heavy_running >= max_heavy:
+                return f'等待主机 {job.host_key} 的构建名额（最多同时 {max_heavy} 个）'
+        return None
+
+    def _next_runnable(self):
+        max_heavy = get_scheduler_config()['max_heavy_per_host']
+        for job in self._queue:
+            if self._blocked_reason(job, max_heavy) is None:
+                return job
+        return None
+
+    def _publish_queue_positions(self):
+        """向排队中的任务推送排队位置，位置或等待原因变化时才推送（需持有 self._cond）"""
+        max_heavy = get_scheduler_config()['max_heavy_per_host']
+        idle_workers = self.max_workers - len(self._running)
+        for position, job in enumerate(self._queue, 1):
+            reason = self._blocked_reason(job, max_heavy)
+            if reason is None:
+                if idle_workers > 0:
+                    continue          # 马上会被空闲线程取走
+                reason = '等待空闲执行线程'
+            if job.queue_info and (job.queue_info['position'], job.queue_info['reason']) == (position, reason):
+                continue
+            job.queue_info = {'type': 'queue', 'position': position, 'total': len(self._queue), 'reason': reason}
+            job.publish(job.queue_info)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_runnable()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_runnable()
+                self._queue.remove(job)
+                self._running.append(job)
+                self._publish_queue_positions()
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running.remove(job)
+                    self._publish_queue_positions()
+                    self._cond.notify_all()
+
+    def _run(self, job):
+        job.mark_running()
+        try:
+            for event in job.operation():
+                if event.get('type') == 'start':
+                    event = {**event, 'job_id': job.id}
+                elif event.get('type') == 'complete':
+                    job.success = event.get('success')
+                    job.message = event.get('message', '')
+                    job.result = {k: v for k, v in event.items() if k not in ('type', 'success', 'message')}
+                job.publish(event)
+        except Exception as e:
+            job.success = False
+            job.message = f'任务执行异常: {str(e)}'
+            job.publish({'type': 'complete', 'success': False, 'message': job.message})
+        finally:
+            status_cache.invalidate(job.project)
+            job.mark_finished()
+
+job_manager = JobManager()
+
+def parse_last_event_id(value):
+    """解析 Last-Event-ID（格式: <job_id>:<seq>）"""
+    if value and ':' in value:
+        job_id, _, seq = value.partition(':')
+        if seq.isdigit():
+            return job_id, int(seq)
+    return None, None
+
+def batch_output_events(events):
+    """把连续的同一项目、同一步骤 output 事件合并为 output_batch 事件
+
+    Returns:
+        [(批次中最后一个事件的序号, 事件)]
+    """
+    batches = []
+    batch_size = 0
+    for seq, event in events:
+        if event.get('type') != 'output':
+            batches.append((seq, event))
+            continue
+        line = event.get('line', '')
+        last = batches[-1][1] if batches else None
+        if (last is not None and last.get('type') == 'output_batch' and last['step'] == event.get('step')
+                and last.get('project_id') == event.get('project_id') and batch_size + len(line) <= SSE_BATCH_BYTES):
+            last['lines'].append(line)
+            batches[-1] = (seq, last)
+            batch_size += len(line)
+        else:
+            batch = {'type': 'output_batch', 'step': event.get('step', ''), 'lines': [line]}
+            if 'project_id' in event:
+                batch['project_id'] = event['project_id']
+            batches.append((seq, batch))
+            batch_size = len(line)
+    return batches
+
+def gzip_stream(chunks):
+    """逐块 gzip 压缩，每块后同步刷新，保证事件能实时到达客户端"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def stream_job(job, from_seq=0):
+    """把任务事件以 SSE 形式推送给客户端，客户端断开不影响任务执行
+
+    输出行按 SSE_BATCH_INTERVAL / SSE_BATCH_BYTES 合并为 output_batch 事件；
+    客户端读取过慢时任务照常执行，落后超过任务缓冲区的输出会被跳过并以 output_dropped 事件提示。
+    """
+    def generate():
+        seq = from_seq
+        # 建议浏览器断线后 3 秒重连
+        yield "retry: 3000\n\n"
+        while True:
+            events, dropped, done = job.wait_events(seq, SSE_KEEPALIVE_INTERVAL)
+            pending_bytes = sum(len(event.get('line', '')) for _, event in events)
+            if events and not done and events[-1][1].get('type') == 'output' and pending_bytes < SSE_BATCH_BYTES:
+                # 输出仍在持续且不足一批，等待一个合并窗口再一起发送
+                time.sleep(SSE_BATCH_INTERVAL)
+                more, more_dropped, done = job.wait_events(events[-1][0] + 1, 0)
+                if more_dropped:
+                    # 等待期间缓冲区已滚动，重新从头读取
+                    events, dropped, done = job.wait_events(seq, 0)
+                else:
+                    events += more
+            if dropped:
+                yield sse_event({'type': 'output_dropped', 'count': dropped})
+            chunk = []
+            for event_seq, event in batch_output_events(events):
+                chunk.append(sse_event(event, f"{job.id}:{event_seq}"))
+                seq = event_seq + 1
+            if chunk:
+                yield ''.join(chunk)
+            if done and not events:
+                return
+            if not events and not dropped:
+                yield ": keepalive\n\n"
+
+    sse_config = dict(SSE_DEFAULTS)
+    sse_config.update(settings_registry.get().get('sse', {}))
+    use_gzip = sse_config['gzip'] and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    body = stream_with_context(generate())
+    response = Response(gzip_stream(body) if use_gzip else body, mimetype='text/event-stream')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Job-Id'] = job.id
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def start_or_resume_job(kind, project_id, project, operation, detached=False):
+    """启动后台任务并返回事件流；浏览器断线重连（带 Last-Event-ID）时接回原任务，不会重复执行"""
+    job_id, seq = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    if job_id:
+        job = job_manager.get(job_id)
+        if job is None:
+            def expired():
+                yield sse_event({'type': 'complete', 'success': False, 'message': '任务不存在或已过期，请查看操作日志'})
+            return Response(stream_with_context(expired()), mimetype='text/event-stream')
+        return stream_job(job, seq + 1)
+
+    try:
+        if detached:
+            job = job_manager.start_detached(kind, project, operation)
+        else:
+            job = job_manager.submit(kind, project_id, project, operation)
+    except JobManagerDraining as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    return stream_job(job)
+
+@app.route('/')
+def index():
+    """首页"""
+    return render_template('index.html')
+
+@app.route('/api/projects', methods=['GET'])
+def get_projects():
+    """获取所有项目"""
+    projects = load_projects()
+    return jsonify(projects)
+
+@app.route('/api/deploy/<project_id>', methods=['POST'])
+def deploy_project(project_id):
+    """部署指定项目（等待完成后一次性返回）
+
+    与 /api/deploy-stream 提交同一个部署任务：同样按重启策略重启、执行健康检查并记录部署状态，
+    只是把任务事件整理为 logs 列表返回。full=1 时完整构建并重启。
+    async=1 时提交后立即返回任务ID（202，不含 success），结果通过 GET /api/jobs/<job_id> 查询
+    （结束后 result 中包含 timings 和 health），或通过 /api/jobs/<job_id>/stream 接收实时输出。
+    """
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
+        return jsonify({'success': False, 'message': '项目不存在'}), 404
+
+    project_path = project['path']
+
+    # SSH模式下不检查本地路径
+    if not project.get('ssh', {}).get('enabled', False):
+        if not os.path.exists(project_path):
+            return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
+
+    full = request.args.get('full', '0') == '1'
+    try:
+        job = job_manager.submit('deploy', project_id, project, lambda: deploy_operation(project_id, project, full))
+    except JobManagerDraining as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+
+    if request.args.get('async', '0') == '1':
+        # 只表示任务已排队，部署是否成功要等任务结束后查询
+        response = jsonify({
+            'queued': True,
+            'message': '部署任务已提交',
+            'job_id': job.id,
+            'job_url': f'/api/jobs/{job.id}',
+            'stream_url': f'/api/jobs/{job.id}/stream'
+        })
+        response.status_code = 202
+        response.headers['Location'] = f'/api/jobs/{job.id}'
+        return response
+
+    logs = []
+    outputs = {}    # 步骤 -> 输出行
+    complete = None
+    next_seq = 0
+    while complete is None:
+        events, dropped, done = job.wait_events(next_seq, SSE_KEEPALIVE_INTERVAL)
+        if dropped:
+            logs.append({'step': '输出', 'success': True, 'output': f'（{dropped} 条输出超出缓冲区，请查看操作日志）'})
+        for event_seq, event in events:
+            if event.get('type') == 'step' and event.get('status') == 'running':
+                outputs[event['step']] = []
+                logs.append({'step': event['step'], 'time': datetime.now().strftime('%H:%M:%S')})
+            elif event.get('type') == 'step':
+                logs.append({
+                    'step': event['step'],
+                    'success': event.get('status') == 'success',
+                    'output': '\n'.join(outputs.pop(event['step'], []))
+                })
+            elif event.get('type') == 'output':
+                outputs.setdefault(event.get('step'), []).append(event.get('line', ''))
+            elif event.get('type') == 'complete':
+                complete = event
+        next_seq = events[-1][0] + 1 if events else next_seq
+        if done and complete is None and not events:
+            complete = {'success': job.success, 'message': job.message or '部署任务已结束'}
+
+    return jsonify({
+        'success': bool(complete.get('success')),
+        'message': complete.get('message', ''),
+        'timings': complete.get('timings', []),
+        # 健康检查结果（含各探测的耗时 latency），同时记录在操作日志中
+        'health': complete.get('health', []),
+        'job_id': job.id,
+        'logs': logs
+    })
+
+# ============ 增量部署 ============
+# 记录每个项目最近一次成功构建/部署的提交，拉取代码后只构建受变更影响的服务
+
+DEPLOY_STATE_FILE = os.path.join(LOGS_DIR, 'deploy_state.json')
+COMPOSE_FILE_PATTERN = re.compile(r'^(docker-)?compose(\.[\w-]+)*\.ya?ml$|^\.env$')
+
+deploy_state_registry = ConfigFile(DEPLOY_STATE_FILE, dict)
+deploy_state_lock = threading.Lock()
+
+def get_deploy_state(project):
+    """返回项目的部署记录：{'built_commit', 'deployed_commit', ...}"""
+    return deploy_state_registry.get().get(project_cache_key(project), {})
+
+def update_deploy_state(project, **fields):
+    with deploy_state_lock:
+        state = copy.deepcopy(deploy_state_registry.get())
+        state.setdefault(project_cache_key(project), {}).update(fields, updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        deploy_state_registry.store(state)
+
+def read_git_revision(project):
+    """读取当前提交、项目目录在仓库中的前缀和实际路径，失败返回 None"""
+    result = execute_command('git rev-parse HEAD && git rev-parse --show-prefix && pwd -P', project)
+    lines = result['stdout'].split('\n')
+    if not result['success'] or len(lines) < 3:
+        return None
+    return {'head': lines[0].strip(), 'prefix': lines[1].strip(), 'physical_dir': lines[2].strip()}
+
+def build_context_in_repo(context, project_path, revision):
+    """把 compose 中的构建目录转换为相对仓库根目录的路径，不在仓库中时返回 None"""
+    if '://' in context or context.startswith('git@'):
+        return None
+    if posixpath.isabs(context):
+        root = project_path.rstrip('/')
+        physical = revision['physical_dir'].rstrip('/')
+        if context == physical or context.startswith(physical + '/'):
+            root = physical
+        context = posixpath.relpath(context, root)
+    path = posixpath.normpath(posixpath.join(revision['prefix'], context))
+    if path == '..' or path.startswith('../'):
+        return None
+    return path
+
+def plan_incremental_build(project, base, revision):
+    """根据两个提交之间的变更文件确定需要重新构建的服务
+
+    Returns:
+        (services, reason)：services 为 None 表示需要完整构建，空列表表示无需构建
+    """
+    diff = execute_command(f"git diff --name-only {shlex.quote(base)} {shlex.quote(revision['head'])}", project)
+    if not diff['success']:
+        return None, '无法比较提交差异（可能是强制推送），执行完整构建'
+    changed = [line.strip() for line in diff['stdout'].splitlines() if line.strip()]
+
+    config = execute_command('docker compose config --format json', project)
+    try:
+        services = json.loads(config['stdout']).get('services', {}) if config['success'] else None
+    except json.JSONDecodeError:
+        services = None
+    if not services:
+        return None, '无法读取 compose 配置，执行完整构建'
+
+    contexts = {}   # 服务名 -> 构建目录（相对仓库根目录）
+    for name, service in services.items():
+        build = service.get('build')
+        if not build:
+            continue
+        context = build.get('context', '.') if isinstance(build, dict) else build
+        path = build_context_in_repo(context, project['path'], revision)
+        if path is None:
+            return None, f'服务 {name} 的构建目录不在仓库中，执行完整构建'
+        contexts[name] = path
+
+    prefix = revision['prefix']
+    affected = set()
+    for path in changed:
+        directory, filename = posixpath.split(path)
+        if posixpath.join(directory, '') == prefix and COMPOSE_FILE_PATTERN.match(filename):
+            return None, f'{path} 已修改，执行完整部署'
+        owners = [name for name, context in contexts.items()
+                  if context == '.' or path == context or path.startswith(context + '/')]
+        if owners:
+            affected.update(owners)
+        elif path.startswith(prefix):
+            # 项目目录中不属于任何构建目录的文件（如挂载的配置文件），影响范围未知
+            return None, f'{path} 不属于任何服务的构建目录，执行完整部署'
+
+    if not affected:
+        return [], f'{len(changed)} 个变更文件都不影响本项目的服务'
+    return sorted(affected), f"{len(changed)} 个变更文件，涉及服务: {', '.join(sorted(affected))}"
+
+def run_step(step, command, project, recorder=None, metric_step=None, progress=None, stream=None):
+    """执行一个步骤的命令并产生 output 事件，返回退出码（通过 yield from 调用）
+
+    耗时、输出字节数和退出码记入监控指标和操作日志；metric_step 为指标中的步骤名，默认由 step 归并得到。
+    progress 为可选的进度解析函数：对进度行返回事件字典（不写入操作日志），其他行返回 None。
+    stream 为命令的输出迭代器，默认使用同步的 execute_command_stream(command, project)。
+    """
+    return_code = -1
+    output_bytes = 0
+    started = time.monotonic()
+    if stream is None:
+        stream = execute_command_stream(command, project)
+    for item_type, content in stream:
+        if item_type == 'progress':
+            # 同一行内被刷新掉的进度片段，只用于实时进度，不写入输出和操作日志
+            output_bytes += len(content.encode('utf-8'))
+            progress_event = progress(content) if progress else None
+            if progress_event is not None:
+                yield {**progress_event, 'step': step}
+        elif item_type == 'output':
+            output_bytes += len(content.encode('utf-8'))
+            progress_event = progress(content.rstrip()) if progress else None
+            if progress_event is not None:
+                yield {**progress_event, 'step': step}
+                continue
+            if recorder is not None:
+                recorder.write(content)
+            yield {'type': 'output', 'step': step, 'line': content.rstrip()}
+        elif item_type == 'returncode':
+            return_code = content
+
+    elapsed = time.monotonic() - started
+    labels = {'project': project['name'], 'host': metric_host(project), 'step': metric_step or metric_step_name(step)}
+    STEP_DURATION.observe(elapsed, **labels)
+    STEP_OUTPUT_BYTES.inc(output_bytes, **labels)
+    STEP_RESULTS.inc(exit_code=return_code, **labels)
+    if recorder is not None:
+        recorder.record_step(step, elapsed, output_bytes, return_code)
+    return return_code
+
+def analyze_changes(project, state_field, before, full, recorder, require_running=False):
+    """拉取代码后确定需要构建的服务（产生 分析变更 步骤的事件，通过 yield from 调用）
+
+    Args:
+        state_field: 作为比较基准的部署记录字段（built_commit / deployed_commit）
+        before: 拉取前的 read_git_revision 结果，没有部署记录时作为比较基准
+        require_running: 只有服务都在运行时才允许跳过（部署时使用）
+
+    Returns:
+        (当前提交, services)：services 为 None 表示完整构建，空列表表示无需构建
+    """
+    step = '分析变更'
+    yield {'type': 'step', 'step': step, 'status': 'running'}
+    revision = read_git_revision(project)
+    recorded = get_deploy_state(project).get(state_field)
+    base = recorded or (before['head'] if before else None)
+
+    if full:
+        services, reason = None, '已指定完整构建'
+    elif revision is None or base is None:
+        services, reason = None, '无法读取提交信息，执行完整构建'
+    elif base == revision['head'] and recorded is None:
+        # 首次部署（或记录丢失）时拉取没有新提交不代表已经部署过
+        services, reason = None, f"没有该提交的部署记录（{revision['head'][:8]}），执行完整构建"
+    elif base == revision['head']:
+        services, reason = [], f"没有新的提交（{revision['head'][:8]}）"
+    else:
+        services, reason = plan_incremental_build(project, base, revision)
+        reason = f"{base[:8]} -> {revision['head'][:8]}：{reason}"
+
+    if services == [] and require_running and not compose_services_running(project):
+        # 已部署的提交没有变化，但服务被停止（如 down、clean 之后），需要重新启动
+        services, reason = None, f'{reason}，但服务没有全部运行，执行完整部署'
+
+    recorder.write(reason + '\n')
+    yield {'type': 'output', 'step': step, 'line': reason}
+    yield {'type': 'step', 'step': step, 'status': 'success'}
+    return (revision['head'] if revision else None), services
+
+# ============ 代码更新策略 ============
+# 项目配置 git（可选），用于加快大仓库的拉取：
+# "git": {
+#     "mode": "pull",          pull: git pull（默认）；reset: git fetch 后 reset --hard 到 ref，不做合并
+#     "ref": "",               reset 模式下的目标分支、标签或提交，为空时使用当前分支的上游分支
+#     "depth": 0,              浅拉取的深度，0 表示不限制
+#     "filter": "",            部分克隆过滤器，如 blob:none（按需下载文件内容）
+#     "submodule_jobs": 0      大于 0 时更新子模块，并行拉取的数量
+# }
+
+GIT_DEFAULTS = {'mode': 'pull', 'ref': '', 'depth': 0, 'filter': '', 'submodule_jobs': 0}
+GIT_MODES = ('pull', 'reset')
+GIT_REF_PATTERN = re.compile(r'^[A-Za-z0-9._/-]+$')
+GIT_FILTER_PATTERN = re.compile(r'^(blob:none|blob:limit=\d+[kmg]?|tree:\d+)$')
+# git --progress 的进度行，如 "Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s"
+GIT_PROGRESS_PATTERN = re.compile(r'^(?:remote: )?([A-Za-z ]+):\s+(\d+)% \((\d+)/(\d+)\)(.*)$')
+GIT_TRANSFER_PATTERN = re.compile(r'([\d.]+) (bytes|KiB|MiB|GiB)')
+GIT_TOTAL_PATTERN = re.compile(r'^remote: Total (\d+)')
+GIT_SIZE_UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+def get_git_config(project):
+    return {**GIT_DEFAULTS, **(project.get('git') or {})}
+
+def validate_git_config(config):
+    """检查项目的 git 配置，合法时返回 None，否则返回错误信息"""
+    if config is None:
+        return None
+    if not isinstance(config, dict):
+        return 'git 配置必须是对象'
+    config = {**GIT_DEFAULTS, **config}
+    if config['mode'] not in GIT_MODES:
+        return f"git.mode 必须是 {', '.join(GIT_MODES)} 之一"
+    if config['ref'] and not GIT_REF_PATTERN.match(str(config['ref'])):
+        return 'git.ref 只能包含字母、数字和 . _ / -'
+    for field in ('depth', 'submodule_jobs'):
+        if isinstance(config[field], bool) or not isinstance(config[field], int) or config[field] < 0:
+            return f'git.{field} 必须是非负整数'
+    if config['filter'] and not GIT_FILTER_PATTERN.match(str(config['filter'])):
+        return 'git.filter 仅支持 blob:none、blob:limit=<大小>、tree:<深度>'
+    return None
+
+def build_git_update_command(project, progress=True):
+    """按项目的 git 配置生成更新代码的命令"""
+    config = get_git_config(project)
+    fetch_options = ['--progress'] if progress else []
+    if config['depth']:
+        fetch_options.append(f"--depth={config['depth']}")
+    if config['filter']:
+        fetch_options.append(f"--filter={config['filter']}")
+    options = ''.join(f' {option}' for option in fetch_options)
+
+    if config['mode'] == 'reset':
+        if config['ref']:
+            command = f"git fetch{options} origin {shlex.quote(config['ref'])} && git reset --hard FETCH_HEAD"
+        else:
+            command = f'git fetch{options} && git reset --hard @{{upstream}}'
+    elif config['filter']:
+        # git pull 不支持 --filter，拆成 fetch 和 merge
+        command = f'git fetch{options} && git merge --no-edit @{{upstream}}'
+    else:
+        command = f'git pull{options}'
+
+    if config['submodule_jobs']:
+        command += f" && git submodule update --init --recursive --jobs {config['submodule_jobs']}"
+        if config['depth']:
+            command += f" --depth {config['depth']}"
+    return command
+
+class GitProgressParser:
+    """解析 git --progress 输出：进度行转为 git_progress 事件，同时记录接收的数据量"""
+
+    def __init__(self):
+        self.transfer_bytes = 0
+        self.transfer_text = ''
+        self.objects = 0
+
+    def __call__(self, line):
+        match = GIT_PROGRESS_PATTERN.match(line)
+        if not match:
+            # 对象较少时 git 不输出接收进度，只能从服务端的汇总行得到对象数
+            total = GIT_TOTAL_PATTERN.match(line)
+            if total:
+                self.objects = max(self.objects, int(total.group(1)))
+            return None
+        phase, percent, current, total, detail = match.groups()
+        if phase in ('Receiving objects', 'Unpacking objects'):
+            size = GIT_TRANSFER_PATTERN.search(detail)
+            if size:
+                transfer_bytes = int(float(size.group(1)) * GIT_SIZE_UNITS[size.group(2)])
+                if transfer_bytes >= self.transfer_bytes:
+                    self.transfer_bytes, self.transfer_text = transfer_bytes, size.group(0)
+            self.objects = max(self.objects, int(total))
+        if detail.rstrip().endswith('done.'):
+            # 每个阶段完成的那一行作为普通输出保留在日志中
+            return None
+        return {'type': 'git_progress', 'phase': phase, 'percent': int(percent),
+                'current': int(current), 'total': int(total), 'detail': detail.strip(', ')}
+
+def git_update(project, recorder, timings):
+    """按项目的 git 配置更新代码（通过 yield from 调用），结束时报告传输量和耗时，返回 (退出码, 传输信息)"""
+    command = build_git_update_command(project)
+    step = command.replace(' --progress', '')
+    parser = GitProgressParser()
+
+    yield {'type': 'step', 'step': step, 'status': 'running'}
+    started = time.monotonic()
+    return_code = yield from run_step(step, command, project, recorder, progress=parser)
+    elapsed = round(time.monotonic() - started, 2)
+    timings.append({'step': step, 'elapsed': elapsed, 'success': return_code == 0})
+
+    transfer = {'transfer_bytes': parser.transfer_bytes, 'objects': parser.objects, 'elapsed': elapsed}
+    if parser.objects:
+        size_text = f'，{parser.transfer_text}' if parser.transfer_text else ''
+        line = f'接收 {parser.objects} 个对象{size_text}，耗时 {elapsed}s'
+    else:
+        line = f'没有需要下载的对象，耗时 {elapsed}s'
+    recorder.write(line + '\n')
+    yield {'type': 'output', 'step': step, 'line': line}
+    yield {'type': 'step', 'step': step, 'status': 'success' if return_code == 0 else 'error',
+           'elapsed': elapsed, **transfer}
+    return return_code, transfer
+
+# ============ Docker Engine API ============
+# 状态采集和容器检查直接调用 Docker Engine API，不再逐条启动 docker 命令并解析文本输出。
+# 本地连接 unix socket；SSH 项目在连接池的会话中执行 docker system dial-stdio，把会话当作 socket 使用
+# （与 docker 命令行的 ssh:// 上下文相同）。API 不可用时回退到命令行，并在一段时间内不再尝试。
+
+DOCKER_API_TIMEOUT = 30
+DOCKER_API_RETRY_INTERVAL = 300    # API 不可用的主机在此期间直接使用命令行（秒）
+DOCKER_DEFAULT_SOCKET = '/var/run/docker.sock'
+DOCKER_DIAL_STDIO_COMMAND = 'docker system dial-stdio'
+COMPOSE_WORKDIR_LABEL = 'com.docker.compose.project.working_dir'
+COMPOSE_SERVICE_LABEL = 'com.docker.compose.service'
+COMPOSE_PROJECT_LABEL = 'com.docker.compose.project'
+CONTAINER_HEALTH_PATTERN = re.compile(r'\((healthy|unhealthy|health: starting)\)')
+
+class DockerAPIError(Exception):
+    """Docker Engine API 不可用或返回错误"""
+    pass
+
+def local_docker_socket():
+    """与 docker 命令行一致，DOCKER_HOST 指定 unix socket 时使用该路径；指定其他地址时返回 None"""
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if not docker_host:
+        return DOCKER_DEFAULT_SOCKET
+    return docker_host[len('unix://'):] if docker_host.startswith('unix://') else None
+
+class ChannelReader(io.RawIOBase):
+    """channel 的原始读取接口，外面再套一层 BufferedReader（http.client 逐行读取分块响应时需要 peek）"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.channel.recv(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+class ChannelSocket:
+    """把执行 dial-stdio 的 SSH channel 包装成 http.client 使用的 socket 接口"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def sendall(self, data):
+        self.channel.sendall(data)
+
+    def makefile(self, mode='rb', *args, **kwargs):
+        return io.BufferedReader(ChannelReader(self.channel))
+
+    def close(self):
+        self.channel.close()
+
+class DockerAPIConnection(http.client.HTTPConnection):
+    """发往 Docker Engine API 的 HTTP 连接，底层是本地 unix socket 或执行 dial-stdio 的 SSH channel"""
+
+    def __init__(self, socket_path=None, channel=None, timeout=DOCKER_API_TIMEOUT):
+        super().__init__('docker', timeout=timeout)
+        self.socket_path = socket_path
+        self.channel = channel
+
+    def connect(self):
+        if self.channel is not None:
+            self.channel.settimeout(self.timeout)
+            self.sock = ChannelSocket(self.channel)
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+def docker_api_request(connection, path, missing_ok=False):
+    """在连接上发送一个 GET 请求并解析 JSON；missing_ok 时 404 返回 None"""
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    if response.status == 404 and missing_ok:
+        return None
+    if response.status != 200:
+        message = body[:200].decode('utf-8', errors='replace').strip()
+        raise DockerAPIError(f'{path.split("?")[0]} 返回 {response.status}: {message}')
+    return json.loads(body)
+
+def docker_api_exchange(connection, paths):
+    """在同一连接上依次 GET（keep-alive），返回解析后的 JSON 列表"""
+    return [docker_api_request(connection, path) for path in paths]
+
+@contextmanager
+def docker_api_connection(project, timeout=DOCKER_API_TIMEOUT):
+    """打开到项目所在主机 Engine API 的连接（SSH 项目占用连接池中的一个会话）
+
+    API 本身的错误统一抛出 DockerAPIError，SSH 连接错误原样抛出。
+    """
+    ssh_config = project.get('ssh', {})
+    if not ssh_config.get('enabled', False):
+        socket_path = local_docker_socket()
+        if not socket_path:
+            raise DockerAPIError('DOCKER_HOST 不是 unix socket')
+        connection = DockerAPIConnection(socket_path=socket_path, timeout=timeout)
+        try:
+            yield connection
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise DockerAPIError(str(e) or type(e).__name__) from e
+        finally:
+            connection.close()
+        return
+
+    with ssh_pool.session(ssh_config) as channel:
+        channel.exec_command(DOCKER_DIAL_STDIO_COMMAND)
+        connection = DockerAPIConnection(channel=channel, timeout=timeout)
+        try:
+            yield connection
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            # dial-stdio 无法启动时 channel 会直接关闭，原因在 stderr 中
+            stderr = channel.recv_stderr(4096).decode('utf-8', errors='replace').strip() if channel.recv_stderr_ready() else ''
+            raise DockerAPIError(stderr or str(e) or type(e).__name__) from e
+        finally:
+            connection.close()
+
+def docker_api_get(project, paths):
+    """向项目所在主机的 Engine API 依次发送 GET 请求，返回解析后的 JSON 列表"""
+    with docker_api_connection(project) as connection:
+        return docker_api_exchange(connection, paths)
+
+# 主机 -> 最近一次 API 调用失败的时间
+docker_api_failures = {}     # 主机 -> API 最近一次失败的时间
+docker_api_failures_lock = threading.Lock()
+
+def docker_api_enabled(project):
+    """settings.json 中 docker_backend 为 cli 时始终使用命令行"""
+    if settings_registry.get().get('docker_backend', 'api') != 'api':
+        return False
+    with docker_api_failures_lock:
+        failed_at = docker_api_failures.get(job_host_key(project))
+    return failed_at is None or time.time() - failed_at > DOCKER_API_RETRY_INTERVAL
+
+def mark_docker_api_failed(project, error):
+    host = job_host_key(project)
+    with docker_api_failures_lock:
+        docker_api_failures[host] = time.time()
+    print(f"Docker Engine API 不可用（{host}），{DOCKER_API_RETRY_INTERVAL} 秒内改用命令行: {error}")
+
+def compose_project_filters(project):
+    """容器过滤条件：先按 compose 写入的工作目录标签（自定义了 compose 项目名也适用），
+    再按默认的 compose 项目名（目录名），用于路径经过符号链接或用 -f 从其他目录启动的情况"""
+    path = posixpath.normpath(project['path'])
+    name = re.sub(r'[^a-z0-9_-]', '', posixpath.basename(path).lower()).lstrip('_-')
+    labels = [f'{COMPOSE_WORKDIR_LABEL}={path}'] + ([f'{COMPOSE_PROJECT_LABEL}={name}'] if name else [])
+    return [urllib.parse.quote(json.dumps({'label': [label]})) for label in labels]
+
+def container_health(status):
+    """从容器的 Status 文本（如 Up 3 minutes (healthy)）中取健康状态"""
+    match = CONTAINER_HEALTH_PATTERN.search(status or '')
+    if not match:
+        return ''
+    return 'starting' if match.group(1) == 'health: starting' else match.group(1)
+
+def format_container_ports(ports):
+    items = []
+    for port in sorted(ports, key=lambda p: (p.get('PrivatePort', 0), p.get('Type', ''))):
+        target = f"{port.get('PrivatePort')}/{port.get('Type', 'tcp')}"
+        if not port.get('PublicPort'):
+            items.append(target)
+            continue
+        ip = port.get('IP', '')
+        items.append(f"{f'[{ip}]' if ':' in ip else ip}:{port['PublicPort']}->{target}")
+    return ', '.join(dict.fromkeys(items))
+
+def summarize_container(container):
+    labels = container.get('Labels') or {}
+    return {
+        'id': container.get('Id', '')[:12],
+        'name': (container.get('Names') or [''])[0].lstrip('/'),
+        'service': labels.get(COMPOSE_SERVICE_LABEL, ''),
+        'image': container.get('Image', ''),
+        'state': container.get('State', ''),
+        'health': container_health(container.get('Status', '')),
+        'status': container.get('Status', ''),
+        'ports': format_container_ports(container.get('Ports') or [])
+    }
+
+def format_container_table(containers):
+    """生成与 docker compose ps 相近的文本表格"""
+    columns = (('NAME', 'name'), ('IMAGE', 'image'), ('SERVICE', 'service'), ('STATUS', 'status'), ('PORTS', 'ports'))
+    rows = [[title for title, _ in columns]] + [[c[key] for _, key in columns] for c in containers]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('   '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows) + '\n'
+
+# (主机, 镜像ID) -> 构建时间；镜像ID即内容哈希，构建时间不会变化，可以一直缓存
+DOCKER_IMAGE_CACHE_SIZE = 2000
+docker_image_created = OrderedDict()    # (主机, 镜像ID) -> 构建时间，按最近使用排序，超出容量时淘汰最久未用的
+docker_image_created_lock = threading.Lock()
+
+def fetch_compose_state(project):
+    """取得项目的全部容器（含已停止的）和镜像构建时间，结果格式与命令行探测一致
+
+    容器列表一次请求；镜像只查询缓存中没有的镜像ID。两种过滤条件都找不到容器时返回 None，
+    由调用方用 docker compose ps 确认（避免把标签不一致的运行中项目显示为已停止）。
+    """
+    host = job_host_key(project)
+    with docker_api_connection(project) as connection:
+        containers = []
+        for filters in compose_project_filters(project):
+            containers = docker_api_request(connection, f'/containers/json?all=1&filters={filters}')
+            if containers:
+                break
+        if not containers:
+            return None
+
+        # 多个项目的状态探测在不同线程中同时读写缓存，只在锁内访问，并把本次用到的结果复制出来
+        created_times = {}
+        with docker_image_created_lock:
+            for image_id in {c.get('ImageID') for c in containers if c.get('ImageID')}:
+                if (host, image_id) in docker_image_created:
+                    docker_image_created.move_to_end((host, image_id))
+                    created_times[image_id] = docker_image_created[(host, image_id)]
+                else:
+                    created_times[image_id] = None
+        missing = [image_id for image_id, created in created_times.items() if created is None]
+        for image_id in missing:
+            image = docker_api_request(connection, f'/images/{urllib.parse.quote(image_id)}/json', missing_ok=True)
+            if image and image.get('Created'):
+                created_times[image_id] = image['Created']
+                with docker_image_created_lock:
+                    docker_image_created[(host, image_id)] = image['Created']
+                    while len(docker_image_created) > DOCKER_IMAGE_CACHE_SIZE:
+                        docker_image_created.popitem(last=False)
+
+    containers.sort(key=lambda c: ((c.get('Labels') or {}).get(COMPOSE_SERVICE_LABEL, ''), c.get('Names') or []))
+    summaries = [summarize_container(container) for container in containers]
+
+    images_info, seen = [], set()
+    for container, summary in zip(containers, summaries):
+        created = created_times.get(container.get('ImageID'))
+        if created is None or (summary['service'], summary['image']) in seen:
+            continue
+        seen.add((summary['service'], summary['image']))
+        images_info.append({'service': summary['service'], 'image': summary['image'], 'created': created})
+
+    return {'containers': summaries, 'docker_status': format_container_table(summaries), 'images_info': images_info}
+
+async def fetch_compose_state_async(project):
+    """在线程池中调用 Engine API，失败或找不到容器时返回 None，由调用方回退到命令行"""
+    loop = asyncio.get_running_loop()
     ssh_config = project.get('ssh', {})
+    try:
+        if ssh_config.get('enabled', False):
+            # 与 SSH 命令相同，先等主机名额再占全局名额
+            async with async_runtime.host_limiter(ssh_config), async_runtime.limiter:
+                return await loop.run_in_executor(None, fetch_compose_state, project)
+        async with async_runtime.limiter:
+            return await loop.run_in_executor(None, fetch_compose_state, project)
+    except DockerAPIError as e:
+        mark_docker_api_failed(project, e)
+    except Exception as e:
+        print(f"通过 Engine API 获取容器状态失败 ({project['name']}): {e}")
+    return None
+
+# ============ 重启策略 ============
+# 项目配置 restart_strategy：
+#   down-up   先 down 再 up -d（默认，服务会中断）
+#   recreate  直接 up -d，compose 只重建配置或镜像有变化的容器
+#   rolling   逐个服务先扩容启动新容器，等待其健康后再删除旧容器
+
+RESTART_STRATEGIES = ('down-up', 'recreate', 'rolling')
+DEFAULT_RESTART_STRATEGY = 'down-up'
+ROLLING_HEALTH_TIMEOUT = 120    # 滚动更新时等待新容器健康的最长时间（秒）
+ROLLING_POLL_MAX_INTERVAL = 5   # 健康检查轮询的最大间隔（秒），从 1 秒开始逐渐增加
+
+def timed_step(step, command, project, recorder, timings):
+    """执行一个步骤并记录耗时（通过 yield from 调用），步骤结束事件带 elapsed，返回退出码"""
+    yield {'type': 'step', 'step': step, 'status': 'running'}
+    started = time.monotonic()
+    return_code = yield from run_step(step, command, project, recorder)
+    elapsed = round(time.monotonic() - started, 2)
+    timings.append({'step': step, 'elapsed': elapsed, 'success': return_code == 0})
+    yield {'type': 'step', 'step': step, 'status': 'success' if return_code == 0 else 'error', 'elapsed': elapsed}
+    return return_code
+
+def inspect_containers(container_ids, project):
+    """返回 {容器ID: (运行状态, 健康状态)}，没有配置 healthcheck 的容器健康状态为空"""
+    if docker_api_enabled(project):
+        filters = urllib.parse.quote(json.dumps({'id': list(container_ids)}))
+        try:
+            containers, = docker_api_get(project, [f'/containers/json?all=1&filters={filters}'])
+            return {c.get('Id', ''): (c.get('State', ''), container_health(c.get('Status', ''))) for c in containers}
+        except DockerAPIError as e:
+            mark_docker_api_failed(project, e)
+        except Exception as e:
+            print(f"通过 Engine API 检查容器失败 ({project['name']}): {e}")
+
+    result = execute_command(
+        "docker inspect --format '{{.Id}} {{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}{{end}}' "
+        + ' '.join(shlex.quote(c) for c in container_ids), project)
+    states = {}
+    for line in result['stdout'].splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            states[parts[0]] = (parts[1], parts[2] if len(parts) > 2 else '')
+    return states
+
+def wait_containers_healthy(container_ids, project, timeout):
+    """等待容器全部健康（没有 healthcheck 的容器处于 running 即可），返回 (是否成功, 说明)"""
+    deadline = time.monotonic() + timeout
+    interval = 1
+    while True:
+        states = inspect_containers(container_ids, project)
+        pending = []
+        for container_id in container_ids:
+            status, health = next((v for k, v in states.items() if k.startswith(container_id)), ('missing', ''))
+            if status in ('exited', 'dead', 'missing') or health == 'unhealthy':
+                return False, f'容器 {container_id[:12]} 状态异常: {status} {health}'.strip()
+            if status != 'running' or health not in ('', 'healthy'):
+                pending.append(f'{container_id[:12]}({health or status})')
+        if not pending:
+            return True, '新容器已就绪'
+        if time.monotonic() + interval > deadline:
+            return False, f"等待超时（{timeout} 秒）: {', '.join(pending)}"
+        time.sleep(interval)
+        interval = min(interval * 1.5, ROLLING_POLL_MAX_INTERVAL)
+
+def compose_services_running(project):
+    """compose 文件中的服务是否都有运行中的容器（无法判断时返回 False）"""
+    configured = execute_command('docker compose config --services', project)
+    running = execute_command('docker compose ps --services --status running', project)
+    if not configured['success'] or not running['success']:
+        return False
+    return set(configured['stdout'].split()) <= set(running['stdout'].split())
+
+def list_service_containers(service, project):
+    result = execute_command(f'docker compose ps -q {shlex.quote(service)}', project)
+    return result['stdout'].split()
+
+def rolling_update_service(service, project, recorder, timings):
+    """滚动更新单个服务（通过 yield from 调用），返回是否成功"""
+    step = f'滚动更新 {service}'
+    quoted = shlex.quote(service)
+    yield {'type': 'step', 'step': step, 'status': 'running'}
+    started = time.monotonic()
+
+    def phase(name, phase_started, success=True):
+        elapsed = round(time.monotonic() - phase_started, 2)
+        timings.append({'step': f'{service}: {name}', 'elapsed': elapsed, 'success': success})
+        line = f'[{name}] {elapsed}s'
+        recorder.write(line + '\n')
+        return {'type': 'output', 'step': step, 'line': line}
+
+    def finish(success):
+        elapsed = round(time.monotonic() - started, 2)
+        timings.append({'step': step, 'elapsed': elapsed, 'success': success})
+        return {'type': 'step', 'step': step, 'status': 'success' if success else 'error', 'elapsed': elapsed}
+
+    old = list_service_containers(service, project)
+    if not old:
+        # 服务当前没有运行，直接启动
+        phase_started = time.monotonic()
+        return_code = yield from run_step(step, f'docker compose up -d --no-deps {quoted}', project, recorder)
+        yield phase('启动', phase_started, return_code == 0)
+        yield finish(return_code == 0)
+        return return_code == 0
+
+    # 1. 扩容：在旧容器旁边启动同样数量的新容器
+    phase_started = time.monotonic()
+    return_code = yield from run_step(
+        step, f'docker compose up -d --no-deps --no-recreate --scale {quoted}={len(old) * 2} {quoted}', project, recorder)
+    new = [c for c in list_service_containers(service, project) if c not in old]
+    yield phase('启动新容器', phase_started, return_code == 0 and bool(new))
+
+    if return_code != 0 or not new:
+        # 设置了 container_name 或固定主机端口的服务无法同时运行两个副本
+        line = '无法启动新副本（服务可能设置了 container_name 或固定的主机端口），改为直接重建'
+        recorder.write(line + '\n')
+        yield {'type': 'output', 'step': step, 'line': line}
+        if new:
+            execute_command('docker rm -f ' + ' '.join(new), project)
+        phase_started = time.monotonic()
+        return_code = yield from run_step(
+            step, f'docker compose up -d --no-deps --force-recreate --scale {quoted}={len(old)} {quoted}', project, recorder)
+        yield phase('重建', phase_started, return_code == 0)
+        yield finish(return_code == 0)
+        return return_code == 0
+
+    # 2. 等待新容器健康，失败时删除新容器、保留旧容器
+    phase_started = time.monotonic()
+    healthy, detail = wait_containers_healthy(new, project, ROLLING_HEALTH_TIMEOUT)
+    recorder.write(detail + '\n')
+    yield {'type': 'output', 'step': step, 'line': detail}
+    yield phase('等待健康检查', phase_started, healthy)
+    if not healthy:
+        execute_command('docker rm -f ' + ' '.join(new), project)
+        line = '已删除新容器，旧容器继续运行'
+        recorder.write(line + '\n')
+        yield {'type': 'output', 'step': step, 'line': line}
+        yield finish(False)
+        return False
 
-    if ssh_config.get('enabled', False):
-        # SSH模式
-        actual_cwd = cwd if cwd else project.get('path')
-        for item in run_ssh_command_stream(command, ssh_config, actual_cwd):
-            yield item
-    else:
-        # 本地模式
-        actual_cwd = cwd if cwd else project.get('path')
-        for item in run_command_stream(command, actual_cwd):
-            yield item
+    # 3. 删除旧容器并恢复副本数
+    phase_started = time.monotonic()
+    old_ids = ' '.join(old)
+    return_code = yield from run_step(step, f'docker stop {old_ids} && docker rm {old_ids}', project, recorder)
+    if return_code == 0:
+        return_code = yield from run_step(
+            step, f'docker compose up -d --no-deps --no-recreate --scale {quoted}={len(old)} {quoted}', project, recorder)
+    yield phase('删除旧容器', phase_started, return_code == 0)
+    yield finish(return_code == 0)
+    return return_code == 0
 
-@app.route('/')
-def index():
-    """首页"""
-    return render_template('index.html')
+def restart_services(project, recorder, timings, services=None, force=False):
+    """按项目的 restart_strategy 重启服务（通过 yield from 调用），返回是否成功
 
-@app.route('/api/projects', methods=['GET'])
-def get_projects():
-    """获取所有项目"""
-    projects = load_projects()
-    return jsonify(projects)
+    Args:
+        services: 只重启这些服务（增量部署），None 表示全部服务
+        force: recreate 策略下即使没有变化也重建容器（用于手动重启）
+    """
+    strategy = project.get('restart_strategy', DEFAULT_RESTART_STRATEGY)
+    service_args = ''.join(f' {shlex.quote(name)}' for name in services or [])
+
+    if strategy == 'rolling':
+        if services is None:
+            result = execute_command('docker compose config --services', project)
+            if not result['success']:
+                yield {'type': 'output', 'step': '', 'line': f"读取服务列表失败: {result['stderr'].strip()}"}
+                return False
+            services = result['stdout'].split()
+        for service in services:
+            if not (yield from rolling_update_service(service, project, recorder, timings)):
+                return False
+        return True
 
-@app.route('/api/deploy/<int:project_id>', methods=['POST'])
-def deploy_project(project_id):
-    """部署指定项目"""
-    projects = load_projects()
+    if strategy == 'recreate' or services:
+        # 只重建受影响（或配置、镜像有变化）的服务，不影响其他服务和依赖
+        command = f"docker compose up -d{' --no-deps' if services else ''}{' --force-recreate' if force else ''}{service_args}"
+        return_code = yield from timed_step(command, command, project, recorder, timings)
+        return return_code == 0
+
+    down_return_code = yield from timed_step('docker compose down', 'docker compose down', project, recorder, timings)
+    up_return_code = yield from timed_step('docker compose up -d', 'docker compose up -d', project, recorder, timings)
+    return down_return_code == 0 and up_return_code == 0
+
+# ============ 健康检查 ============
+# 项目配置 health_check（可选），重启后并发执行所有探测，全部通过才算部署成功：
+# "health_check": {
+#     "timeout": 60,
+#     "probes": [
+#         {"type": "http", "url": "http://127.0.0.1:8080/health", "expect_status": 200},
+#         {"type": "tcp", "host": "127.0.0.1", "port": 5432},
+#         {"type": "docker", "service": "web"}
+#     ]
+# }
+# http / tcp 探测从部署管理服务所在主机发起；docker 探测在项目所在主机（本地或SSH）检查容器状态
+
+HEALTH_CHECK_TIMEOUT = 60         # 默认总超时（秒），所有探测共用同一个截止时间
+HEALTH_PROBE_TYPES = ('http', 'tcp', 'docker')
+HEALTH_PROBE_ATTEMPT_TIMEOUT = 5  # 单次探测的超时（秒）
+HEALTH_PROBE_MAX_INTERVAL = 5     # 重试间隔从 0.5 秒开始翻倍，最大 5 秒
+HEALTH_DOCKER_STABLE_SECONDS = 5  # 没有 healthcheck 的容器需要持续运行且未重启这么久才算通过
+
+def validate_health_check(config):
+    """检查项目的 health_check 配置，合法时返回 None，否则返回错误信息"""
+    if config is None:
+        return None
+    if not isinstance(config, dict) or not isinstance(config.get('probes', []), list):
+        return 'health_check 必须是包含 probes 列表的对象'
+    timeout = config.get('timeout', HEALTH_CHECK_TIMEOUT)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        return 'health_check.timeout 必须是正数'
+    for probe in config.get('probes', []):
+        if not isinstance(probe, dict) or probe.get('type') not in HEALTH_PROBE_TYPES:
+            return f"探测类型必须是 {', '.join(HEALTH_PROBE_TYPES)} 之一"
+        if probe['type'] == 'http' and not str(probe.get('url', '')).startswith(('http://', 'https://')):
+            return 'http 探测需要以 http:// 或 https:// 开头的 url'
+        if probe['type'] == 'tcp' and (not probe.get('host') or not str(probe.get('port', '')).isdigit()):
+            return 'tcp 探测需要 host 和 port'
+        if probe['type'] == 'docker' and not probe.get('service'):
+            return 'docker 探测需要 service'
+    return None
+
+def describe_probe(probe):
+    if probe['type'] == 'http':
+        return f"HTTP {probe['url']}"
+    if probe['type'] == 'tcp':
+        return f"TCP {probe['host']}:{probe['port']}"
+    return f"容器 {probe['service']}"
+
+async def probe_http_once(probe):
+    def request():
+        response = requests.get(probe['url'], timeout=HEALTH_PROBE_ATTEMPT_TIMEOUT, allow_redirects=False)
+        expect_status = probe.get('expect_status')
+        if expect_status:
+            return response.status_code == int(expect_status), f'HTTP {response.status_code}'
+        return response.status_code < 400, f'HTTP {response.status_code}'
+
+    return await asyncio.get_running_loop().run_in_executor(None, request)
+
+async def probe_tcp_once(probe):
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(probe['host'], int(probe['port'])), HEALTH_PROBE_ATTEMPT_TIMEOUT)
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), HEALTH_PROBE_ATTEMPT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        # 连接已经建立，关闭时对端重置或超时不影响探测结果
+        pass
+    return True, '端口可连接'
+
+async def probe_docker_once(probe, project, state):
+    """有 healthcheck 的容器要求 healthy；没有的要求持续运行且重启次数不变，避免把崩溃重启中的容器当成正常"""
+    result = await execute_command_async(
+        f"docker compose ps -q {shlex.quote(probe['service'])}", project, timeout=HEALTH_PROBE_ATTEMPT_TIMEOUT * 2)
+    container_ids = result['stdout'].split()
+    if not container_ids:
+        return False, '没有运行中的容器'
+
+    result = await execute_command_async(
+        "docker inspect --format '{{.State.Status}} {{.RestartCount}} {{if .State.Health}}{{.State.Health.Status}}{{end}}' "
+        + ' '.join(container_ids), project, timeout=HEALTH_PROBE_ATTEMPT_TIMEOUT * 2)
+    if not result['success']:
+        return False, result['stderr'].strip() or 'docker inspect 失败'
+
+    snapshot = []
+    for line in result['stdout'].splitlines():
+        parts = line.split()
+        status, restarts = parts[0], parts[1] if len(parts) > 1 else '0'
+        health = parts[2] if len(parts) > 2 else ''
+        if status != 'running':
+            return False, f'容器状态: {status}'
+        if health and health != 'healthy':
+            return False, f'健康状态: {health}'
+        if not health:
+            snapshot.append(restarts)
+    if not snapshot:
+        return True, 'healthy'
+
+    # 没有 healthcheck 时观察一段时间，容器 ID 和重启次数都没变才算稳定运行
+    snapshot = (tuple(container_ids), tuple(snapshot))
+    now = time.monotonic()
+    if state.get('snapshot') != snapshot:
+        state['snapshot'], state['since'] = snapshot, now
+    stable_seconds = probe.get('stable_seconds', HEALTH_DOCKER_STABLE_SECONDS)
+    if now - state['since'] >= stable_seconds:
+        return True, 'running'
+    return False, f'运行中，观察 {stable_seconds} 秒是否稳定'
+
+async def run_health_probe(probe, project, deadline):
+    """重复执行单个探测直到通过或到达截止时间，latency 为从开始到首次通过的耗时"""
+    started = time.monotonic()
+    interval = 0.5
+    attempts = 0
+    state = {}
+    while True:
+        attempts += 1
+        try:
+            if probe['type'] == 'http':
+                ok, detail = await probe_http_once(probe)
+            elif probe['type'] == 'tcp':
+                ok, detail = await probe_tcp_once(probe)
+            else:
+                ok, detail = await probe_docker_once(probe, project, state)
+        except Exception as e:
+            ok, detail = False, str(e) or type(e).__name__
+
+        result = {'name': describe_probe(probe), 'type': probe['type'], 'success': ok, 'attempts': attempts,
+                  'detail': detail}
+        if ok:
+            return {**result, 'latency': round(time.monotonic() - started, 2)}
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {**result, 'latency': None}
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, HEALTH_PROBE_MAX_INTERVAL)
+
+def verify_health(project, recorder, timings):
+    """并发执行项目配置的健康检查（通过 yield from 调用），返回 (是否全部通过, 各探测结果)；未配置时返回 (True, [])"""
+    config = project.get('health_check') or {}
+    probes = config.get('probes', [])
+    if not probes:
+        return True, []
+
+    step = '健康检查'
+    timeout = config.get('timeout', HEALTH_CHECK_TIMEOUT)
+    yield {'type': 'step', 'step': step, 'status': 'running'}
+    started = time.monotonic()
+    deadline = started + timeout
+    futures = {async_runtime.submit(run_health_probe(probe, project, deadline)): probe for probe in probes}
+
+    results = []
+    pending = set(futures)
+    while pending:
+        # 单次探测可能因SSH连接等原因超出截止时间，留出余量后放弃等待
+        done, pending = wait(pending, timeout=deadline - time.monotonic() + HEALTH_PROBE_ATTEMPT_TIMEOUT * 3,
+                             return_when=FIRST_COMPLETED)
+        finished = [future.result() for future in done]
+        if not done:
+            for future in pending:
+                future.cancel()
+                finished.append({'name': describe_probe(futures[future]), 'type': futures[future]['type'],
+                                 'success': False, 'attempts': 0, 'detail': '探测超时', 'latency': None})
+            pending = set()
+
+        for result in finished:
+            results.append(result)
+            if result['success']:
+                HEALTH_PROBE_LATENCY.observe(result['latency'], project=project['name'], type=result['type'])
+                line = f"✓ {result['name']}: {result['detail']}（{result['latency']}s，{result['attempts']} 次）"
+            else:
+                line = f"✗ {result['name']}: {result['detail']}（{result['attempts']} 次后超时）"
+            recorder.write(line + '\n')
+            yield {'type': 'output', 'step': step, 'line': line}
 
-    if project_id >= len(projects):
-        return jsonify({'success': False, 'message': '项目不存在'}), 404
+    success = all(result['success'] for result in results)
+    elapsed = round(time.monotonic() - started, 2)
+    timings.append({'step': step, 'elapsed': elapsed, 'success': success})
+    yield {'type': 'step', 'step': step, 'status': 'success' if success else 'error', 'elapsed': elapsed}
+    return success, results
 
-    project = projects[project_id]
-    project_path = project['path']
+def deploy_operation(project_id, project, full=False, notify_group=None):
+    """一键部署：git pull、build、down、up（生成事件字典，由后台任务执行）
 
-    if not os.path.exists(project_path):
-        return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
+    没有新提交时跳过构建和重启；只有部分服务受影响时只构建这些服务并用 up -d --no-deps 重建。
+    full=True 时总是完整构建并重启。notify_group 为钉钉通知分组（批量部署时合并为一条汇总消息）。
+    """
+    recorder = OperationRecorder(project_id, project)  # 记录完整输出和操作日志
+    timings = []  # 各步骤耗时，写入 complete 事件和操作日志
 
-    logs = []
+    # 发送开始信号
+    yield {'type': 'start', 'project': project['name']}
 
-    # 执行 git pull
-    logs.append({'step': 'git pull', 'time': datetime.now().strftime('%H:%M:%S')})
-    git_result = run_command('git pull', cwd=project_path)
-    logs.append({
-        'step': 'git pull',
-        'success': git_result['success'],
-        'output': git_result['stdout'] + git_result['stderr']
-    })
+    before = read_git_revision(project)
 
-    if not git_result['success']:
-        return jsonify({
-            'success': False,
-            'message': 'Git pull 失败',
-            'logs': logs
-        })
+    # 按项目的 git 配置拉取代码
+    git_return_code, transfer = yield from git_update(project, recorder, timings)
 
-    # 执行 docker compose build
-    logs.append({'step': 'docker compose build', 'time': datetime.now().strftime('%H:%M:%S')})
-    build_result = run_command('docker compose build', cwd=project_path)
-    logs.append({
-        'step': 'docker compose build',
-        'success': build_result['success'],
-        'output': build_result['stdout'] + build_result['stderr']
-    })
+    # 检查 git pull 是否成功
+    if git_return_code != 0:
+        error_message = f'Git pull 失败 (退出码: {git_return_code})'
+        yield {'type': 'complete', 'success': False, 'message': error_message, 'timings': timings}
+        recorder.finish('部署', False, extra={'timings': timings, 'git': transfer})
+        return
+
+    head, services = yield from analyze_changes(project, 'deployed_commit', before, full, recorder, require_running=True)
+    plan = {'commit': head, 'services': services if services is not None else 'all', 'timings': timings,
+            'git': transfer}
+
+    if services == []:
+        update_deploy_state(project, built_commit=head, deployed_commit=head)
+        yield {'type': 'complete', 'success': True, 'message': '代码没有影响服务的变化，已跳过构建和重启', 'timings': timings}
+        recorder.finish('部署', True, extra={**plan, 'skipped': True})
+        return
+
+    # 执行 docker compose build（只构建受影响的服务）
+    service_args = ''.join(f' {shlex.quote(name)}' for name in services or [])
+    build_step = f'docker compose build{service_args}'
+    build_return_code = yield from timed_step(build_step, build_step, project, recorder, timings)
 
-    if not build_result['success']:
+    # 验证 build 结果
+    if build_return_code != 0:
+        error_message = f'Docker compose build 失败 (退出码: {build_return_code})'
         send_dingtalk_notification(
             f"项目部署失败: {project['name']}",
-            f"Docker compose build 失败\n\n{build_result['stderr']}",
-            is_success=False
+            f"Docker compose build 失败",
+            is_success=False,
+            group=notify_group
         )
-        return jsonify({
-            'success': False,
-            'message': 'Docker compose build 失败',
-            'logs': logs
-        })
+        yield {'type': 'complete', 'success': False, 'message': error_message, 'timings': timings}
+        recorder.finish('部署', False, extra=plan)
+        return
 
-    # 执行 docker compose down && docker compose up -d（重启服务）
-    if project.get('auto_restart', True):
-        logs.append({'step': 'docker compose down', 'time': datetime.now().strftime('%H:%M:%S')})
-        down_result = run_command('docker compose down', cwd=project_path)
-        logs.append({
-            'step': 'docker compose down',
-            'success': down_result['success'],
-            'output': down_result['stdout'] + down_result['stderr']
-        })
+    update_deploy_state(project, built_commit=head)
 
-        if not down_result['success']:
+    if project.get('auto_restart', True):
+        # 按项目的重启策略重启（增量部署时只重启受影响的服务）
+        restarted = yield from restart_services(project, recorder, timings, services)
+        if not restarted:
             send_dingtalk_notification(
                 f"项目部署失败: {project['name']}",
-                f"Docker compose down 失败\n\n{down_result['stderr']}",
-                is_success=False
+                f"镜像已构建，但服务重启失败",
+                is_success=False,
+                group=notify_group
             )
-            return jsonify({
-                'success': False,
-                'message': 'Docker compose down 失败',
-                'logs': logs
-            })
-
-        logs.append({'step': 'docker compose up -d', 'time': datetime.now().strftime('%H:%M:%S')})
-        up_result = run_command('docker compose up -d', cwd=project_path)
-        logs.append({
-            'step': 'docker compose up -d',
-            'success': up_result['success'],
-            'output': up_result['stdout'] + up_result['stderr']
-        })
+            yield {'type': 'complete', 'success': False, 'message': '服务重启失败', 'timings': timings}
+            recorder.finish('部署', False, extra=plan)
+            return
 
-        if not up_result['success']:
+        # 健康检查全部通过才算部署成功（未配置时直接通过）
+        healthy, health = yield from verify_health(project, recorder, timings)
+        if health:
+            plan['health'] = health
+        if not healthy:
+            failed = ', '.join(result['name'] for result in health if not result['success'])
             send_dingtalk_notification(
                 f"项目部署失败: {project['name']}",
-                f"Docker compose up 失败\n\n{up_result['stderr']}",
-                is_success=False
+                f"服务已重启，但健康检查未通过: {failed}",
+                is_success=False,
+                group=notify_group
             )
-            return jsonify({
-                'success': False,
-                'message': 'Docker compose up 失败',
-                'logs': logs
-            })
+            yield {'type': 'complete', 'success': False, 'message': f'健康检查未通过: {failed}', 'timings': timings,
+                   'health': health}
+            recorder.finish('部署', False, extra=plan)
+            return
+
+    # 服务全部正常启动后才记录为已部署，否则下次部署会重新处理这些变更
+    update_deploy_state(project, deployed_commit=head)
 
     # 发送成功通知
     send_dingtalk_notification(
         f"项目部署成功: {project['name']}",
         f"项目已成功更新并重启",
-        is_success=True
+        is_success=True,
+        group=notify_group
     )
 
-    return jsonify({
-        'success': True,
-        'message': '部署成功',
-        'logs': logs
-    })
+    yield {'type': 'complete', 'success': True, 'message': '部署成功', 'timings': timings,
+           'health': plan.get('health', [])}
+    recorder.finish('部署', True, extra=plan)
 
-@app.route('/api/deploy-stream/<int:project_id>', methods=['GET', 'POST'])
+@app.route('/api/deploy-stream/<project_id>', methods=['GET', 'POST'])
 def deploy_project_stream(project_id):
     """部署指定项目（实时流式输出）"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
     project_path = project['path']
 
-    if not os.path.exists(project_path):
-        return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
+    # SSH模式下不检查本地路径
+    if not project.get('ssh', {}).get('enabled', False):
+        if not os.path.exists(project_path):
+            return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
 
-    def generate():
-        """生成器函数，用于流式输出"""
-        overall_success = True
-        error_message = ''
-
-        # 发送开始信号
-        yield f"data: {json.dumps({'type': 'start', 'project': project['name']})}\n\n"
-
-        # 执行 git pull
-        yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'running'})}\n\n"
-
-        git_return_code = 0
-        for item_type, content in run_command_stream('git pull', cwd=project_path):
-            if item_type == 'output':
-                yield f"data: {json.dumps({'type': 'output', 'step': 'git pull', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                git_return_code = content
-
-        # 检查 git pull 是否成功
-        if git_return_code != 0:
-            overall_success = False
-            error_message = f'Git pull 失败 (退出码: {git_return_code})'
-            yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': error_message})}\n\n"
-            return
+    # full=1 时忽略增量判断，完整构建并重启
+    full = request.args.get('full', '0') == '1'
+    return start_or_resume_job('deploy', project_id, project, lambda: deploy_operation(project_id, project, full))
+
+BATCH_MAX_PARALLEL = 4   # 批量部署默认同时部署的项目数（同一主机还受 scheduler.max_heavy_per_host 限制）
+
+def deploy_batch_operation(projects, project_ids, dependencies, max_parallel, full=False):
+    """批量部署：按依赖顺序提交 deploy 任务，转发各项目事件（带 project_id）并在最后汇总（生成事件字典）"""
+    start_time = time.time()
+    updates = queue.Queue()
+    pending = list(project_ids)
+    running = {}    # project_id -> Job
+    results = {}    # project_id -> 汇总信息
+
+    def finish(project_id, status, message, job=None):
+        now = time.time()
+        results[project_id] = {
+            'project_id': project_id,
+            'name': projects[project_id]['name'],
+            'host': job_host_key(projects[project_id]),
+            'status': status,
+            'message': message,
+            'job_id': job.id if job else None,
+            'wait': round(job.started_at - job.created_at, 2) if job and job.started_at else None,
+            'elapsed': round(now - job.started_at, 2) if job and job.started_at else None
+        }
+        return {'type': 'project', **results[project_id]}
 
-        yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'success'})}\n\n"
+    yield {
+        'type': 'start',
+        'project': f'批量部署 {len(project_ids)} 个项目',
+        'projects': [{'project_id': i, 'name': projects[i]['name'], 'host': job_host_key(projects[i])} for i in project_ids]
+    }
 
-        # 执行 docker compose build
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'running'})}\n\n"
+    # 各项目的钉钉通知在批量部署结束后合并为一条汇总消息
+    notify_group = dingtalk_dispatcher.open_group()
+    try:
+        while pending or running:
+            for project_id in list(pending):
+                deps = dependencies.get(project_id, [])
+                failed = [projects[d]['name'] for d in deps if d in results and results[d]['status'] != 'success']
+                if failed:
+                    pending.remove(project_id)
+                    yield finish(project_id, 'skipped', f"依赖的项目未部署成功: {', '.join(failed)}")
+                    continue
+                if len(running) >= max_parallel or any(d not in results for d in deps):
+                    continue
+
+                project = projects[project_id]
+                pending.remove(project_id)
+                try:
+                    job = job_manager.submit('deploy', project_id, project,
+                                             lambda project_id=project_id, project=project: deploy_operation(project_id, project, full, notify_group),
+                                             listener=lambda job, event: updates.put((job, event)))
+                except JobManagerDraining as e:
+                    yield finish(project_id, 'cancelled', str(e))
+                    continue
+                running[project_id] = job
+                yield {'type': 'project', 'project_id': project_id, 'status': 'queued', 'job_id': job.id}
+
+            if not running:
+                continue
+
+            job, event = updates.get()
+            project_id = job.project_id
+            if event.get('type') == 'start':
+                yield {'type': 'project', 'project_id': project_id, 'status': 'running', 'job_id': job.id}
+            elif event.get('type') == 'complete':
+                running.pop(project_id, None)
+                yield finish(project_id, 'success' if event.get('success') else 'failed', event.get('message', ''), job)
+            else:
+                yield {**event, 'project_id': project_id}
+    finally:
+        dingtalk_dispatcher.close_group(notify_group)
+
+    summary = [results[i] for i in project_ids]
+    counts = {status: sum(1 for r in summary if r['status'] == status) for status in ('success', 'failed', 'skipped', 'cancelled')}
+    yield {
+        'type': 'complete',
+        'success': counts['success'] == len(summary),
+        'message': f"批量部署完成: 成功 {counts['success']}，失败 {counts['failed']}，跳过 {counts['skipped'] + counts['cancelled']}",
+        'summary': summary,
+        'elapsed': round(time.time() - start_time, 2)
+    }
 
-        build_return_code = 0
-        for item_type, content in run_command_stream('docker compose build', cwd=project_path):
-            if item_type == 'output':
-                yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose build', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                build_return_code = content
+@app.route('/api/deploy-batch', methods=['POST'])
+def deploy_batch():
+    """批量部署多个项目（实时流式输出，各项目事件带 project_id）
 
-        # 验证 build 结果
-        if build_return_code != 0:
-            overall_success = False
-            error_message = f'Docker compose build 失败 (退出码: {build_return_code})'
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'error'})}\n\n"
-            send_dingtalk_notification(
-                f"项目部署失败: {project['name']}",
-                f"Docker compose build 失败",
-                is_success=False
-            )
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': error_message})}\n\n"
-            return
+    请求体: {"projects": ["a1b2c3d4", "e5f6a7b8"], "dependencies": {"e5f6a7b8": ["a1b2c3d4"]}, "max_parallel": 4, "full": false}
+    项目可用项目ID或列表序号指定；dependencies 表示项目需要等待哪些项目部署成功后才开始，依赖失败的项目会被跳过。
+    """
+    data = request.get_json(silent=True) or {}
+
+    refs = data.get('projects', [])
+    if not refs or not isinstance(refs, list) or not all(isinstance(i, (int, str)) for i in refs):
+        return jsonify({'success': False, 'message': '请提供要部署的项目ID列表'}), 400
+    projects = {}   # 项目ID -> 项目
+    for ref in refs:
+        project_id, project = project_registry.resolve(str(ref))
+        if project is None:
+            return jsonify({'success': False, 'message': f'项目不存在: {ref}'}), 404
+        if not project.get('ssh', {}).get('enabled', False) and not os.path.exists(project['path']):
+            return jsonify({'success': False, 'message': f"项目路径不存在: {project['path']}"}), 404
+        projects[project_id] = project
+    project_ids = list(projects)
+
+    dependencies = {}
+    try:
+        for key, deps in (data.get('dependencies') or {}).items():
+            dependencies[project_registry.resolve(str(key))[0]] = [project_registry.resolve(str(d))[0] for d in deps]
+    except (TypeError, AttributeError):
+        return jsonify({'success': False, 'message': 'dependencies 格式错误'}), 400
+    for project_id, deps in dependencies.items():
+        if project_id not in projects or any(d not in projects for d in deps):
+            return jsonify({'success': False, 'message': 'dependencies 只能引用本次部署的项目'}), 400
+
+    # 检查循环依赖
+    remaining = {i: set(dependencies.get(i, [])) for i in project_ids}
+    while remaining:
+        ready = [i for i, deps in remaining.items() if not deps & remaining.keys()]
+        if not ready:
+            return jsonify({'success': False, 'message': '项目之间存在循环依赖'}), 400
+        for i in ready:
+            del remaining[i]
 
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'success'})}\n\n"
+    try:
+        max_parallel = max(1, min(int(data.get('max_parallel', BATCH_MAX_PARALLEL)), JOB_MAX_WORKERS))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'max_parallel 必须是整数'}), 400
+    batch = {'name': f'批量部署 {len(project_ids)} 个项目', 'path': ''}
 
-        # 执行 docker compose down && docker compose up -d（重启服务）
-        if project.get('auto_restart', True):
-            # docker compose down
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'running'})}\n\n"
+    return start_or_resume_job('deploy-batch', None, batch,
+                               lambda: deploy_batch_operation(projects, project_ids, dependencies, max_parallel,
+                                                              bool(data.get('full', False))),
+                               detached=True)
 
-            down_return_code = 0
-            for item_type, content in run_command_stream('docker compose down', cwd=project_path):
-                if item_type == 'output':
-                    yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose down', 'line': content.rstrip()})}\n\n"
-                elif item_type == 'returncode':
-                    down_return_code = content
+def pull_build_operation(project_id, project, full=False):
+    """git pull 和 docker compose build（生成事件字典，由后台任务执行）
 
-            if down_return_code == 0:
-                yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'success'})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'error'})}\n\n"
+    与上次构建的提交相比没有变化时跳过构建，否则只构建受影响的服务。
+    """
+    ssh_mode = project.get('ssh', {}).get('enabled', False)
+    ssh_host = project.get('ssh', {}).get('host', '')
+    mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
 
-            # docker compose up -d
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'running'})}\n\n"
+    recorder = OperationRecorder(project_id, project)  # 记录完整输出和操作日志
 
-            up_return_code = 0
-            for item_type, content in run_command_stream('docker compose up -d', cwd=project_path):
-                if item_type == 'output':
-                    yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose up -d', 'line': content.rstrip()})}\n\n"
-                elif item_type == 'returncode':
-                    up_return_code = content
+    # 发送开始信号
+    yield {'type': 'start', 'project': project['name'] + mode_text}
 
-            if up_return_code == 0:
-                yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'success'})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'error'})}\n\n"
+    before = read_git_revision(project)
 
-        # 发送成功通知
-        send_dingtalk_notification(
-            f"项目部署成功: {project['name']}",
-            f"项目已成功更新并重启",
-            is_success=True
-        )
+    # 按项目的 git 配置拉取代码
+    git_return_code, transfer = yield from git_update(project, recorder, [])
 
-        yield f"data: {json.dumps({'type': 'complete', 'success': True, 'message': '部署成功'})}\n\n"
+    if git_return_code != 0:
+        error_message = f'Git pull 失败 (退出码: {git_return_code})'
+        yield {'type': 'complete', 'success': False, 'message': error_message}
+        # 保存日志（写入队列，不阻塞输出）
+        recorder.finish('Pull & Build', False, extra={'git': transfer})
+        return
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    head, services = yield from analyze_changes(project, 'built_commit', before, full, recorder)
+    plan = {'commit': head, 'services': services if services is not None else 'all', 'git': transfer}
+
+    if services == []:
+        update_deploy_state(project, built_commit=head)
+        yield {'type': 'complete', 'success': True, 'message': '代码没有影响服务的变化，已跳过构建'}
+        recorder.finish('Pull & Build', True, extra={**plan, 'skipped': True})
+        return
 
-@app.route('/api/pull-build/<int:project_id>', methods=['GET', 'POST'])
+    # 执行 docker compose build（只构建受影响的服务）
+    build_step = 'docker compose build' + ''.join(f' {shlex.quote(name)}' for name in services or [])
+    yield {'type': 'step', 'step': build_step, 'status': 'running'}
+    build_return_code = yield from run_step(build_step, build_step, project, recorder)
+
+    if build_return_code != 0:
+        error_message = f'Docker compose build 失败 (退出码: {build_return_code})'
+        yield {'type': 'step', 'step': build_step, 'status': 'error'}
+        yield {'type': 'complete', 'success': False, 'message': error_message}
+        # 保存日志（写入队列，不阻塞输出）
+        recorder.finish('Pull & Build', False, extra=plan)
+        return
+
+    update_deploy_state(project, built_commit=head)
+    yield {'type': 'step', 'step': build_step, 'status': 'success'}
+    yield {'type': 'complete', 'success': True, 'message': 'Pull & Build 完成'}
+
+    # 保存日志（写入队列，不阻塞输出）
+    recorder.finish('Pull & Build', True, extra=plan)
+
+@app.route('/api/pull-build/<project_id>', methods=['GET', 'POST'])
 def pull_build_project(project_id):
     """执行 git pull 和 docker compose build（实时流式输出）"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
     project_path = project['path']
 
     # SSH模式下不检查本地路径
@@ -770,80 +3703,45 @@ def pull_build_project(project_id):
         if not os.path.exists(project_path):
             return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
 
-    def generate():
-        """生成器函数，用于流式输出"""
-        ssh_mode = project.get('ssh', {}).get('enabled', False)
-        ssh_host = project.get('ssh', {}).get('host', '')
-        mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
-
-        output_log = []  # 收集输出用于日志
-        max_log_lines = 1000  # 限制日志行数，避免内存问题
-        line_count = 0
-
-        # 发送开始信号
-        yield f"data: {json.dumps({'type': 'start', 'project': project['name'] + mode_text})}\n\n"
-
-        # 执行 git pull
-        yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'running'})}\n\n"
-
-        git_return_code = 0
-        for item_type, content in execute_command_stream('git pull', project):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': 'git pull', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                git_return_code = content
-
-        if git_return_code != 0:
-            error_message = f'Git pull 失败 (退出码: {git_return_code})'
-            yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': error_message})}\n\n"
-            # 异步保存日志
-            threading.Thread(target=save_operation_log, args=(project_id, project['name'], 'Pull & Build', False, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
-            return
+    # full=1 时忽略增量判断，完整构建
+    full = request.args.get('full', '0') == '1'
+    return start_or_resume_job('pull-build', project_id, project, lambda: pull_build_operation(project_id, project, full))
 
-        yield f"data: {json.dumps({'type': 'step', 'step': 'git pull', 'status': 'success'})}\n\n"
-
-        # 执行 docker compose build
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'running'})}\n\n"
-
-        build_return_code = 0
-        for item_type, content in execute_command_stream('docker compose build', project):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose build', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                build_return_code = content
-
-        if build_return_code != 0:
-            error_message = f'Docker compose build 失败 (退出码: {build_return_code})'
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': error_message})}\n\n"
-            # 异步保存日志
-            threading.Thread(target=save_operation_log, args=(project_id, project['name'], 'Pull & Build', False, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
-            return
+def restart_operation(project_id, project):
+    """按项目的 restart_strategy 重启服务（生成事件字典，由后台任务执行）"""
+    ssh_mode = project.get('ssh', {}).get('enabled', False)
+    ssh_host = project.get('ssh', {}).get('host', '')
+    mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
+    strategy = project.get('restart_strategy', DEFAULT_RESTART_STRATEGY)
 
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose build', 'status': 'success'})}\n\n"
-        yield f"data: {json.dumps({'type': 'complete', 'success': True, 'message': 'Pull & Build 完成'})}\n\n"
+    recorder = OperationRecorder(project_id, project)  # 记录完整输出和操作日志
+    timings = []  # 各阶段耗时，写入 complete 事件和操作日志
 
-        # 异步保存日志
-        threading.Thread(target=save_operation_log, args=(project_id, project['name'], 'Pull & Build', True, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
+    # 发送开始信号
+    yield {'type': 'start', 'project': project['name'] + mode_text}
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    success = yield from restart_services(project, recorder, timings, force=True)
+    extra = {'strategy': strategy, 'timings': timings}
+    if success:
+        success, health = yield from verify_health(project, recorder, timings)
+        if health:
+            extra['health'] = health
 
-@app.route('/api/restart/<int:project_id>', methods=['GET', 'POST'])
-def restart_project(project_id):
-    """执行 docker compose down 和 up -d（实时流式输出）"""
-    projects = load_projects()
+    if success:
+        yield {'type': 'complete', 'success': True, 'message': '重启完成', 'timings': timings}
+    else:
+        yield {'type': 'complete', 'success': False, 'message': f'重启失败（策略: {strategy}）', 'timings': timings}
 
-    if project_id >= len(projects):
+    # 保存日志（写入队列，不阻塞输出）
+    recorder.finish('Down & Up' if strategy == 'down-up' else '重启', success, extra=extra)
+
+@app.route('/api/restart/<project_id>', methods=['GET', 'POST'])
+def restart_project(project_id):
+    """按项目的重启策略重启服务（实时流式输出）"""
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
     project_path = project['path']
 
     # SSH模式下不检查本地路径
@@ -851,73 +3749,43 @@ def restart_project(project_id):
         if not os.path.exists(project_path):
             return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
 
-    def generate():
-        """生成器函数，用于流式输出"""
-        ssh_mode = project.get('ssh', {}).get('enabled', False)
-        ssh_host = project.get('ssh', {}).get('host', '')
-        mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
-
-        output_log = []  # 收集输出用于日志
-        max_log_lines = 1000  # 限制日志行数
-        line_count = 0
-
-        # 发送开始信号
-        yield f"data: {json.dumps({'type': 'start', 'project': project['name'] + mode_text})}\n\n"
-
-        # docker compose down
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'running'})}\n\n"
-
-        down_return_code = 0
-        for item_type, content in execute_command_stream('docker compose down', project, cwd=project_path):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose down', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                down_return_code = content
-
-        if down_return_code == 0:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'success'})}\n\n"
-        else:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose down', 'status': 'error'})}\n\n"
-
-        # docker compose up -d
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'running'})}\n\n"
-
-        up_return_code = 0
-        for item_type, content in execute_command_stream('docker compose up -d', project, cwd=project_path):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': 'docker compose up -d', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                up_return_code = content
-
-        success = (down_return_code == 0 and up_return_code == 0)
-
-        if up_return_code == 0:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'success'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': True, 'message': '重启完成'})}\n\n"
-        else:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker compose up -d', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': 'docker compose up 失败'})}\n\n"
+    return start_or_resume_job('restart', project_id, project, lambda: restart_operation(project_id, project))
 
-        # 异步保存日志
-        threading.Thread(target=save_operation_log, args=(project_id, project['name'], 'Down & Up', success, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
+def clean_operation(project_id, project):
+    """docker system prune（生成事件字典，由后台任务执行）"""
+    ssh_mode = project.get('ssh', {}).get('enabled', False)
+    ssh_host = project.get('ssh', {}).get('host', '')
+    mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    recorder = OperationRecorder(project_id, project)  # 记录完整输出和操作日志
+
+    # 发送开始信号
+    yield {'type': 'start', 'project': project['name'] + mode_text}
+
+    # docker system prune
+    yield {'type': 'step', 'step': 'docker system prune -f', 'status': 'running'}
+
+    prune_return_code = yield from run_step('docker system prune -f', 'docker system prune -af', project, recorder)
 
-@app.route('/api/clean/<int:project_id>', methods=['GET', 'POST'])
+    success = (prune_return_code == 0)
+
+    if success:
+        yield {'type': 'step', 'step': 'docker system prune -f', 'status': 'success'}
+        yield {'type': 'complete', 'success': True, 'message': '清理完成'}
+    else:
+        yield {'type': 'step', 'step': 'docker system prune -f', 'status': 'error'}
+        yield {'type': 'complete', 'success': False, 'message': '清理失败'}
+
+    # 保存日志（写入队列，不阻塞输出）
+    recorder.finish('Clean', success)
+
+@app.route('/api/clean/<project_id>', methods=['GET', 'POST'])
 def clean_project(project_id):
     """执行 docker system prune（实时流式输出）"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
     project_path = project['path']
 
     # SSH模式下不检查本地路径
@@ -925,55 +3793,52 @@ def clean_project(project_id):
         if not os.path.exists(project_path):
             return jsonify({'success': False, 'message': f'项目路径不存在: {project_path}'}), 404
 
-    def generate():
-        """生成器函数，用于流式输出"""
-        ssh_mode = project.get('ssh', {}).get('enabled', False)
-        ssh_host = project.get('ssh', {}).get('host', '')
-        mode_text = f" (SSH: {ssh_host})" if ssh_mode else " (本地)"
-
-        output_log = []  # 收集输出用于日志
-        max_log_lines = 1000  # 限制日志行数
-        line_count = 0
-
-        # 发送开始信号
-        yield f"data: {json.dumps({'type': 'start', 'project': project['name'] + mode_text})}\n\n"
-
-        # docker system prune
-        yield f"data: {json.dumps({'type': 'step', 'step': 'docker system prune -f', 'status': 'running'})}\n\n"
-
-        prune_return_code = 0
-        for item_type, content in execute_command_stream('docker system prune -af', project, cwd=project_path):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': 'docker system prune -f', 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                prune_return_code = content
-
-        success = (prune_return_code == 0)
-
-        if success:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker system prune -f', 'status': 'success'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': True, 'message': '清理完成'})}\n\n"
-        else:
-            yield f"data: {json.dumps({'type': 'step', 'step': 'docker system prune -f', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': '清理失败'})}\n\n"
+    return start_or_resume_job('clean', project_id, project, lambda: clean_operation(project_id, project))
 
-        # 异步保存日志
-        threading.Thread(target=save_operation_log, args=(project_id, project['name'], 'Clean', success, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
+def custom_command_operation(project_id, project, custom_command, warning_message=None):
+    """执行用户自定义命令（生成事件字典，由后台任务执行）"""
+    ssh_mode = project.get('ssh', {}).get('enabled', False)
+    ssh_host = project.get('ssh', {}).get('host', '')
+    mode_text = f" SSH({ssh_host})" if ssh_mode else " 本地"
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    recorder = OperationRecorder(project_id, project)  # 记录完整输出和操作日志
+
+    # 发送开始信号
+    yield {'type': 'start', 'project': project['name'] + mode_text, 'command': custom_command}
+
+    # 如果有警告，先显示警告
+    if warning_message:
+        yield {'type': 'output', 'step': 'warning', 'line': warning_message}
+        yield {'type': 'output', 'step': 'warning', 'line': '命令将在5分钟无输出后自动超时'}
+        yield {'type': 'output', 'step': 'warning', 'line': ''}
+
+    # 执行自定义命令
+    yield {'type': 'step', 'step': f'执行: {custom_command}', 'status': 'running'}
+
+    # 自定义命令（如 docker logs -f）经异步执行层运行：任务被关闭时取消迭代，整个进程组随之终止
+    stream = async_runtime.iterate(execute_command_stream_async(custom_command, project))
+    cmd_return_code = yield from run_step(custom_command, custom_command, project, recorder, metric_step='custom',
+                                          stream=stream)
+
+    success = (cmd_return_code == 0)
+
+    if success:
+        yield {'type': 'step', 'step': custom_command, 'status': 'success'}
+        yield {'type': 'complete', 'success': True, 'message': '命令执行完成'}
+    else:
+        yield {'type': 'step', 'step': custom_command, 'status': 'error'}
+        yield {'type': 'complete', 'success': False, 'message': f'命令执行失败 (退出码: {cmd_return_code})'}
+
+    # 保存日志（写入队列，不阻塞输出）
+    recorder.finish(f'自定义命令: {custom_command}', success)
 
-@app.route('/api/custom-command/<int:project_id>', methods=['POST'])
+@app.route('/api/custom-command/<project_id>', methods=['POST'])
 def execute_custom_command(project_id):
     """执行用户自定义命令（实时流式输出）"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
     project_path = project['path']
 
     # SSH模式下不检查本地路径
@@ -1017,209 +3882,1040 @@ def execute_custom_command(project_id):
             warning_message = f"⚠️ 检测到可能的交互式命令: {suggestion}"
             break
 
-    def generate():
-        """生成器函数，用于流式输出"""
-        ssh_mode = project.get('ssh', {}).get('enabled', False)
-        ssh_host = project.get('ssh', {}).get('host', '')
-        mode_text = f" SSH({ssh_host})" if ssh_mode else " 本地"
-
-        output_log = []  # 收集输出用于日志
-        max_log_lines = 1000  # 限制日志行数
-        line_count = 0
-
-        # 发送开始信号
-        yield f"data: {json.dumps({'type': 'start', 'project': project['name'] + mode_text, 'command': custom_command})}\n\n"
-
-        # 如果有警告，先显示警告
-        if warning_message:
-            yield f"data: {json.dumps({'type': 'output', 'step': 'warning', 'line': warning_message})}\n\n"
-            yield f"data: {json.dumps({'type': 'output', 'step': 'warning', 'line': '命令将在5分钟无输出后自动超时'})}\n\n"
-            yield f"data: {json.dumps({'type': 'output', 'step': 'warning', 'line': ''})}\n\n"
-
-        # 执行自定义命令
-        yield f"data: {json.dumps({'type': 'step', 'step': f'执行: {custom_command}', 'status': 'running'})}\n\n"
-
-        cmd_return_code = 0
-        for item_type, content in execute_command_stream(custom_command, project, cwd=project_path):
-            if item_type == 'output':
-                if line_count < max_log_lines:
-                    output_log.append(content)
-                    line_count += 1
-                yield f"data: {json.dumps({'type': 'output', 'step': custom_command, 'line': content.rstrip()})}\n\n"
-            elif item_type == 'returncode':
-                cmd_return_code = content
-
-        success = (cmd_return_code == 0)
-
-        if success:
-            yield f"data: {json.dumps({'type': 'step', 'step': custom_command, 'status': 'success'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': True, 'message': '命令执行完成'})}\n\n"
+    return start_or_resume_job('custom', project_id, project, lambda: custom_command_operation(project_id, project, custom_command, warning_message))
+
+# 状态探测脚本：所有探测命令合并为一次执行，各段输出以分隔行区分
+STATUS_SECTION_MARKER = '__DEPLOY_MANAGER_SECTION__'
+
+STATUS_GIT_SCRIPT = """printf '%s git_status\\n' "$M"; git status --short 2>/dev/null
+printf '%s git_branch\\n' "$M"; git branch --show-current 2>/dev/null
+printf '%s git_log\\n' "$M"; git log -1 --pretty=format:"%h - %an, %ar : %s" 2>/dev/null; echo"""
+
+# Engine API 不可用时使用的命令行探测
+STATUS_DOCKER_SCRIPT = """printf '%s docker_ps\\n' "$M"; docker compose ps 2>/dev/null
+images=$(docker compose images --format json 2>/dev/null)
+printf '%s images_json\\n' "$M"; [ -n "$images" ] && echo "$images"
+ids=$(docker compose images -q 2>/dev/null | sort -u)
+if [ -z "$images" ]; then
+    printf '%s ps_json\\n' "$M"; docker compose ps --format json 2>/dev/null
+    ids=$(docker compose ps -q 2>/dev/null | xargs -r docker inspect --type container --format '{{.Image}}' 2>/dev/null | sort -u)
+fi
+printf '%s image_inspect\\n' "$M"
+[ -n "$ids" ] && docker inspect --type image --format '{{.Id}}|{{.Created}}|{{join .RepoTags ","}}' $ids 2>/dev/null"""
+
+def build_status_probe_command(git=True, docker=True):
+    """生成合并后的状态探测命令（整体放在 { } 中，SSH 模式下 cd 失败时不会执行）"""
+    script = '\n'.join(part for part, enabled in ((STATUS_GIT_SCRIPT, git), (STATUS_DOCKER_SCRIPT, docker)) if enabled)
+    return f"{{\nM={STATUS_SECTION_MARKER}\n{script}\ntrue; }}"
+
+def parse_probe_sections(output, marker=STATUS_SECTION_MARKER):
+    """按分隔行把合并脚本的输出拆分为 {段名: 文本}"""
+    sections = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith(marker + ' '):
+            current = line[len(marker) + 1:].strip()
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+    return {name: '\n'.join(lines) + '\n' if lines else '' for name, lines in sections.items()}
+
+def parse_json_lines(text):
+    """解析 docker --format json 输出（兼容每行一个对象和整体数组两种格式）"""
+    items = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, list):
+            items.extend(d for d in data if isinstance(d, dict))
+        elif isinstance(data, dict):
+            items.append(data)
+    return items
+
+def _normalize_image_id(image_id):
+    return image_id.split(':', 1)[1] if image_id.startswith('sha256:') else image_id
+
+def build_images_info(sections):
+    """根据 images_json / ps_json 和一次性 docker inspect 的结果生成镜像构建时间列表"""
+    # image_inspect 每行格式: <Id>|<Created>|<RepoTag1,RepoTag2>
+    inspected = []
+    for line in sections.get('image_inspect', '').splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 2 or not parts[1]:
+            continue
+        tags = [t for t in parts[2].split(',') if t] if len(parts) > 2 else []
+        inspected.append((_normalize_image_id(parts[0]), parts[1], tags))
+
+    def find_created(image_name, image_id=''):
+        image_id = _normalize_image_id(image_id)
+        for full_id, created, tags in inspected:
+            if image_name in tags or (':' not in image_name and f'{image_name}:latest' in tags):
+                return created
+            if image_id and len(image_id) >= 12 and full_id.startswith(image_id):
+                return created
+            if image_name and len(image_name) >= 12 and full_id.startswith(_normalize_image_id(image_name)):
+                return created
+        return None
+
+    images_info = []
+
+    for img_data in parse_json_lines(sections.get('images_json', '')):
+        service = img_data.get('Service') or img_data.get('Container') or img_data.get('ContainerName', '')
+        repository = img_data.get('Repository', '')
+        tag = img_data.get('Tag', '')
+
+        if repository and tag:
+            image_name = f"{repository}:{tag}"
+        elif repository:
+            image_name = repository
         else:
-            yield f"data: {json.dumps({'type': 'step', 'step': custom_command, 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'success': False, 'message': f'命令执行失败 (退出码: {cmd_return_code})'})}\n\n"
+            continue
+
+        created_time = find_created(image_name, img_data.get('ID', ''))
+        if created_time:
+            images_info.append({
+                'service': service,
+                'image': image_name,
+                'created': created_time
+            })
 
-        # 异步保存日志
-        threading.Thread(target=save_operation_log, args=(project_id, project['name'], f'自定义命令: {custom_command}', success, ''.join(output_log), ssh_mode, ssh_host), daemon=True).start()
+    # 如果docker compose images不可用，使用 docker compose ps 的结果
+    if not images_info:
+        processed_images = set()  # 避免重复
+        for container_data in parse_json_lines(sections.get('ps_json', '')):
+            service = container_data.get('Service', container_data.get('Name', ''))
+            image_name = container_data.get('Image', '')
+
+            if image_name and image_name not in processed_images:
+                processed_images.add(image_name)
+                created_time = find_created(image_name)
+                if created_time:
+                    images_info.append({
+                        'service': service,
+                        'image': image_name,
+                        'created': created_time
+                    })
+
+    return images_info
+
+async def collect_project_status_async(project):
+    """采集项目状态：git 探测合并为一次执行（本地一次进程 / SSH一次exec），容器和镜像通过 Engine API
+    两次请求获取，与 git 探测并发；API 不可用时 docker 探测合并到同一个脚本中"""
+    started = time.monotonic()
+    use_api = docker_api_enabled(project)
+    probe = execute_command_async(build_status_probe_command(docker=not use_api), project, cwd=project['path'],
+                                  timeout=STATUS_PROJECT_TIMEOUT)
+    if use_api:
+        result, docker_state = await asyncio.gather(probe, fetch_compose_state_async(project))
+    else:
+        result, docker_state = await probe, None
+    sections = parse_probe_sections(result['stdout'])
+
+    if use_api and docker_state is None and result['success']:
+        # API 调用失败，补一次命令行探测
+        fallback = await execute_command_async(build_status_probe_command(git=False), project, cwd=project['path'],
+                                               timeout=STATUS_PROJECT_TIMEOUT)
+        sections.update(parse_probe_sections(fallback['stdout']))
+    STATUS_PROBE_DURATION.observe(time.monotonic() - started, project=project['name'], host=metric_host(project),
+                                  result='success' if result['success'] else 'error')
+
+    status = {
+        'git_status': sections.get('git_status', ''),
+        'git_branch': sections.get('git_branch', '').strip(),
+        'git_log': sections.get('git_log', '').strip('\n'),
+        'docker_status': docker_state['docker_status'] if docker_state else sections.get('docker_ps', ''),
+        'images_info': docker_state['images_info'] if docker_state else build_images_info(sections)
+    }
+    if docker_state:
+        status['containers'] = docker_state['containers']
+
+    # 探测脚本以 true 结尾，非0退出码说明脚本本身未能执行（路径不存在、SSH连接失败等）
+    if not result['success']:
+        status['error'] = result['stderr'].strip() or f"退出码: {result['returncode']}"
+
+    return status
+
+# 单个项目状态采集超时（秒）；并发数由异步执行层的 ASYNC_MAX_COMMANDS 限制
+STATUS_PROJECT_TIMEOUT = 60
+
+# 状态缓存默认配置，可在 settings.json 的 status_cache 中覆盖
+STATUS_CACHE_DEFAULTS = {
+    'ttl': 30,                # 缓存有效期（秒），期间直接返回缓存
+    'stale_ttl': 300,         # 过期后仍可返回旧数据的时间（秒），同时后台刷新
+    'refresh_interval': 15,   # 后台刷新线程的检查间隔（秒）
+    'idle_timeout': 600       # 超过该时间无人读取的项目不再后台刷新（秒）
+}
+
+def get_status_cache_config():
+    """读取状态缓存配置"""
+    config = dict(STATUS_CACHE_DEFAULTS)
+    config.update(settings_registry.get().get('status_cache', {}))
+    return config
+
+def project_cache_key(project):
+    """项目缓存键：SSH主机 + 路径，不依赖项目在列表中的位置"""
+    ssh_config = project.get('ssh', {})
+    if ssh_config.get('enabled', False):
+        return f"ssh://{ssh_config.get('user', 'root')}@{ssh_config.get('host')}:{ssh_config.get('port', 22)}{project['path']}"
+    return f"local://{project['path']}"
+
+class StatusCache:
+    """项目状态缓存：TTL 内直接返回；过期后在 stale 窗口内先返回旧数据并后台刷新"""
+
+    def __init__(self):
+        self._entries = {}      # key -> {'status', 'updated', 'accessed', 'project'}
+        self._inflight = {}     # key -> Future，合并同一项目的并发刷新
+        self._generations = {}  # key -> 失效计数，避免失效前开始的刷新写回旧数据
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self, project, force=False):
+        """返回 (status, age, stale)"""
+        return self.get_future(project, force).result(timeout=STATUS_PROJECT_TIMEOUT + SSH_CONNECT_TIMEOUT)
+
+    def get_future(self, project, force=False):
+        """返回结果为 (status, age, stale) 的 Future，缓存命中时已经完成"""
+        self._ensure_refresher()
+        key = project_cache_key(project)
+        config = get_status_cache_config()
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry['accessed'] = now
+                entry['project'] = project
+
+        result = Future()
+        if entry and not force:
+            age = now - entry['updated']
+            if age < config['ttl']:
+                result.set_result((entry['status'], age, False))
+                return result
+            if age < config['ttl'] + config['stale_ttl']:
+                self.refresh_async(project)
+                result.set_result((entry['status'], age, True))
+                return result
+
+        def deliver(refreshed):
+            if refreshed.exception() is not None:
+                result.set_exception(refreshed.exception())
+            else:
+                result.set_result((refreshed.result(), 0, False))
+        self.refresh(project).add_done_callback(deliver)
+        return result
+
+    def peek(self, project):
+        """返回最近一次缓存的 (status, age)，不论是否过期；没有缓存时返回 None"""
+        with self._lock:
+            entry = self._entries.get(project_cache_key(project))
+            return (entry['status'], time.time() - entry['updated']) if entry else None
+
+    def refresh(self, project):
+        """在异步执行层中刷新项目状态，返回 Future；已有刷新在进行时直接复用"""
+        key = project_cache_key(project)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._inflight[key] = future
+            generation = self._generations.get(key, 0)
+
+        def store(task):
+            error = task.exception() if not task.cancelled() else RuntimeError('状态采集已取消')
+            now = time.time()
+            with self._lock:
+                self._inflight.pop(key, None)
+                if error is None and self._generations.get(key, 0) == generation:
+                    previous = self._entries.get(key)
+                    self._entries[key] = {
+                        'status': task.result(),
+                        'updated': now,
+                        'accessed': previous['accessed'] if previous else now,
+                        'project': project
+                    }
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result())
+
+        async_runtime.submit(collect_project_status_async(project)).add_done_callback(store)
+        return future
+
+    def refresh_async(self, project):
+        """后台刷新，不等待结果"""
+        self.refresh(project)
+
+    def invalidate(self, project):
+        """使项目缓存立即失效（部署、重启等操作完成后调用）"""
+        key = project_cache_key(project)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def _ensure_refresher(self):
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        """后台保持最近被读取过的项目缓存为最新，删除长期无人读取的过期缓存"""
+        while True:
+            config = get_status_cache_config()
+            time.sleep(config['refresh_interval'])
+            now = time.time()
+            to_refresh = []
+            with self._lock:
+                for key, entry in list(self._entries.items()):
+                    age = now - entry['updated']
+                    if now - entry['accessed'] > config['idle_timeout']:
+                        if age > config['ttl'] + config['stale_ttl']:
+                            del self._entries[key]
+                        continue
+                    # 在下一轮检查之前就会过期的项目提前刷新
+                    if age + config['refresh_interval'] >= config['ttl']:
+                        to_refresh.append(entry['project'])
+            for project in to_refresh:
+                self.refresh_async(project)
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+status_cache = StatusCache()
 
-@app.route('/api/status/<int:project_id>', methods=['GET'])
+@app.route('/api/status/<project_id>', methods=['GET'])
 def get_project_status(project_id):
     """获取项目状态"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    project = projects[project_id]
-    project_path = project['path']
-    ssh_config = project.get('ssh', {})
+    # refresh=1 时跳过缓存直接采集
+    force = request.args.get('refresh', '0') == '1'
+    try:
+        status, age, stale = status_cache.get(project, force=force)
+    except Exception as e:
+        if isinstance(e, FutureTimeoutError):
+            message, code = f'获取状态超时（超过 {STATUS_PROJECT_TIMEOUT + SSH_CONNECT_TIMEOUT} 秒）', 504
+        else:
+            message, code = f'获取状态失败: {str(e)}', 500
+        # 有旧数据时返回旧数据并标记为过期，没有时返回错误
+        cached = status_cache.peek(project)
+        if cached is None:
+            return jsonify({'success': False, 'message': message}), code
+        status, age = cached
+        return jsonify({'success': True, **status, 'cache_age': round(age, 1), 'stale': True, 'message': message})
+
+    return jsonify({'success': True, **status, 'cache_age': round(age, 1), 'stale': stale})
+
+@app.route('/api/status', methods=['GET'])
+def get_all_projects_status():
+    """并发获取所有项目状态（实时流式输出，每个项目采集完成即推送）"""
+    projects = load_projects()
 
-    # 使用 execute_command 支持本地和SSH模式
-    # 获取 git 状态
-    git_status = execute_command('git status --short', project, cwd=project_path)
-    git_branch = execute_command('git branch --show-current', project, cwd=project_path)
-    git_log = execute_command('git log -1 --pretty=format:"%h - %an, %ar : %s"', project, cwd=project_path)
+    def generate():
+        """生成器函数，用于流式输出"""
+        start_time = time.time()
+        force = request.args.get('refresh', '0') == '1'
+
+        # 所有项目同时提交到异步执行层，不再占用线程池。
+        # 每个项目的探测命令从真正开始执行时计算 STATUS_PROJECT_TIMEOUT，超时后以失败结果完成，
+        # 因此这里不再按整个请求的开始时间统一判定超时（排队靠后的项目不会被提前判为超时）
+        futures = {status_cache.get_future(p, force=force): p for p in projects}
+        pending = set(futures)
+        success_count = 0
+        failed_count = 0
+
+        yield f"data: {json.dumps({'type': 'start', 'total': len(projects)})}\n\n"
+
+        while pending:
+            done, pending = wait(pending, timeout=SSE_KEEPALIVE_INTERVAL, return_when=FIRST_COMPLETED)
+            if not done:
+                yield ": keepalive\n\n"
+
+            for future in done:
+                project = futures[future]
+                payload = {'type': 'status', 'project_id': project['id'], 'project': project['name']}
+                try:
+                    status, age, stale = future.result()
+                    payload.update({'success': 'error' not in status, **status,
+                                    'cache_age': round(age, 1), 'stale': stale})
+                    if 'error' in status:
+                        payload['message'] = f"获取状态失败: {status['error']}"
+                        failed_count += 1
+                    else:
+                        success_count += 1
+                except Exception as e:
+                    payload.update({'success': False, 'message': f'获取状态失败: {str(e)}'})
+                    failed_count += 1
+                yield f"data: {json.dumps(payload)}\n\n"
+
+        elapsed = round(time.time() - start_time, 2)
+        yield f"data: {json.dumps({'type': 'complete', 'success': failed_count == 0, 'total': len(projects), 'succeeded': success_count, 'failed': failed_count, 'elapsed': elapsed})}\n\n"
 
-    # 获取 docker 容器状态
-    docker_ps = execute_command('docker compose ps', project, cwd=project_path)
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
-    # 获取镜像构建时间 - 使用docker compose images命令更可靠
-    images_info = []
+# ============ 容器状态推送 ============
+# 后台订阅各主机的 docker events（Engine API 的 /events 长连接，过滤为 compose 容器），在内存中维护
+# projects.json 中项目的容器状态表；变化写入环形缓冲区，由 /api/containers/events 这一个 SSE 连接推送给浏览器。
+# 有浏览器订阅时才连接各主机，长时间无人订阅后断开。
+
+CONTAINER_EVENTS_BUFFER = 1000              # 保留的变化事件数，落后更多的客户端改为重新接收快照
+CONTAINER_EVENTS_IDLE_TIMEOUT = 600         # 无浏览器订阅超过该时间后断开所有主机（秒）
+CONTAINER_EVENTS_RECONCILE_INTERVAL = 30    # 按 projects.json 增减订阅主机的间隔（秒）
+CONTAINER_EVENTS_RETRY_MAX = 60             # 断线重连的最长等待（秒）
+CRASH_LOOP_WINDOW = 120                     # 该时间内退出次数达到阈值视为崩溃循环（秒）
+CRASH_LOOP_THRESHOLD = 3
+CONTAINER_EVENT_ACTIONS = ('create', 'start', 'restart', 'die', 'stop', 'kill', 'oom', 'pause', 'unpause',
+                           'destroy', 'health_status')
+CONTAINER_ACTION_STATES = {'create': 'created', 'start': 'running', 'restart': 'running', 'unpause': 'running',
+                           'pause': 'paused', 'die': 'exited', 'stop': 'exited'}
+
+class ContainerStateTable:
+    """各主机 compose 容器的当前状态，变化事件带递增序号，客户端按序号续读（与任务事件相同）"""
+
+    def __init__(self, size=CONTAINER_EVENTS_BUFFER):
+        self.containers = {}               # (主机, 容器ID) -> 状态
+        self.hosts = {}                    # 主机 -> 是否已连接
+        self.events = deque(maxlen=size)   # (序号, 事件)
+        self.seq = 0
+        self._deaths = {}                  # (主机, 容器ID) -> 最近退出时间，用于判断崩溃循环
+        self._cond = threading.Condition()
+
+    def _publish(self, event):
+        self.seq += 1
+        self.events.append((self.seq, event))
+        self._cond.notify_all()
+
+    def _make_record(self, host, container_id, labels, project_id, project):
+        return {
+            'host': host,
+            'id': container_id[:12],
+            'project_id': project_id,
+            'project': project['name'],
+            'service': labels.get(COMPOSE_SERVICE_LABEL, ''),
+            'name': '',
+            'image': '',
+            'state': '',
+            'health': '',
+            'exit_code': None,
+            'oom_killed': False,
+            'restarts': 0,
+            'crash_loop': False,
+            'updated_at': time.time()
+        }
 
-    # 尝试使用 docker compose images 命令获取镜像信息
-    # 不使用 2>/dev/null，因为在 SSH 的 cd && command 模式下可能有问题
-    images_cmd = 'docker compose images --format json'
-    images_result = execute_command(images_cmd, project, cwd=project_path)
-
-    # Debug logging
-    print(f"DEBUG: SSH mode: {ssh_config.get('enabled', False)}")
-    print(f"DEBUG: images command success: {images_result['success']}")
-    print(f"DEBUG: images stdout length: {len(images_result['stdout'])}")
-    print(f"DEBUG: images stdout preview: {images_result['stdout'][:200]}")
-    if images_result['stderr']:
-        print(f"DEBUG: images stderr: {images_result['stderr']}")
-
-    if images_result['success'] and images_result['stdout'].strip():
-        # 解析JSON输出
+    def replace_host(self, host, containers):
+        """（重新）连接后用 containers/json 的结果替换该主机的全部容器"""
+        records = []
+        for container in containers:
+            labels = container.get('Labels') or {}
+            project_id, project = project_registry.find_by_workdir(host, labels.get(COMPOSE_WORKDIR_LABEL, ''))
+            if project is None:
+                continue
+            record = self._make_record(host, container.get('Id', ''), labels, project_id, project)
+            summary = summarize_container(container)
+            record.update({key: summary[key] for key in ('name', 'image', 'state', 'health')})
+            records.append(record)
+
+        with self._cond:
+            for key in [key for key in self.containers if key[0] == host]:
+                del self.containers[key]
+            for record in records:
+                self.containers[(host, record['id'])] = record
+            self.hosts[host] = True
+            self._publish({'type': 'host', 'host': host, 'connected': True, 'containers': records})
+
+    def set_disconnected(self, host, error=''):
+        with self._cond:
+            if self.hosts.get(host) is not False:
+                self.hosts[host] = False
+                self._publish({'type': 'host', 'host': host, 'connected': False, 'error': error})
+
+    def remove_host(self, host):
+        with self._cond:
+            for key in [key for key in self.containers if key[0] == host]:
+                del self.containers[key]
+            if self.hosts.pop(host, None) is not None:
+                self._publish({'type': 'host', 'host': host, 'connected': False, 'containers': []})
+
+    def apply_event(self, host, event):
+        """应用一条 docker 容器事件，返回变化后的状态（与项目无关的容器返回 None）"""
+        action = event.get('Action') or event.get('status') or ''
+        actor = event.get('Actor') or {}
+        attributes = actor.get('Attributes') or {}
+        container_id = (actor.get('ID') or event.get('id') or '')[:12]
+        base_action, _, detail = action.partition(':')
+        if not container_id or base_action not in CONTAINER_EVENT_ACTIONS:
+            return None
+
+        project_id, project = project_registry.find_by_workdir(host, attributes.get(COMPOSE_WORKDIR_LABEL, ''))
+        key = (host, container_id)
+        with self._cond:
+            if base_action == 'destroy':
+                self._deaths.pop(key, None)
+                record = self.containers.pop(key, None)
+                if record is not None:
+                    self._publish({'type': 'removed', 'host': host, 'id': container_id,
+                                   'project_id': record['project_id']})
+                return record
+            if project is None:
+                return None
+
+            record = self.containers.get(key) or self._make_record(host, container_id, attributes, project_id, project)
+            record.update({'project_id': project_id, 'project': project['name'],
+                           'name': attributes.get('name', record['name']), 'image': attributes.get('image', record['image']),
+                           'updated_at': event.get('time', time.time())})
+            if base_action in CONTAINER_ACTION_STATES:
+                record['state'] = CONTAINER_ACTION_STATES[base_action]
+            if base_action == 'health_status':
+                record['health'] = detail.strip()
+            elif base_action == 'start':
+                record['oom_killed'] = False
+                record['health'] = 'starting' if record['health'] else ''
+            elif base_action == 'oom':
+                record['oom_killed'] = True
+            elif base_action == 'die':
+                record['exit_code'] = int(attributes['exitCode']) if attributes.get('exitCode', '').isdigit() else None
+                now = time.time()
+                deaths = [t for t in self._deaths.get(key, []) if now - t < CRASH_LOOP_WINDOW] + [now]
+                self._deaths[key] = deaths
+                record['restarts'] = len(deaths)
+                record['crash_loop'] = len(deaths) >= CRASH_LOOP_THRESHOLD
+            self.containers[key] = record
+            self._publish({'type': 'container', 'action': base_action, 'container': dict(record)})
+            return record
+
+    def snapshot(self):
+        """返回 (当前全部容器, 主机连接状态, 最新序号)"""
+        with self._cond:
+            return [dict(record) for record in self.containers.values()], dict(self.hosts), self.seq
+
+    def wait_events(self, seq, timeout):
+        """返回序号大于 seq 的事件和是否有事件已被挤出缓冲区；没有新事件时最多等待 timeout 秒"""
+        with self._cond:
+            if self.seq <= seq:
+                self._cond.wait(timeout)
+            events = [(event_seq, event) for event_seq, event in self.events if event_seq > seq]
+            dropped = bool(events) and events[0][0] > seq + 1
+            return events, dropped
+
+container_states = ContainerStateTable()
+
+class DockerEventSubscriber:
+    """订阅一台主机的 docker events：连接后先取一次容器快照，之后按事件更新状态表，断线后退避重连"""
+
+    def __init__(self, host, project, table):
+        self.host = host
+        self.project = project   # 该主机上任意一个项目，用于取得连接配置
+        self.table = table
+        self._stop = threading.Event()
+        self._connection = None
+        self._thread = threading.Thread(target=self._run, name=f'docker-events-{host}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        # 事件流没有超时，关闭底层连接让阻塞中的读取立即返回
+        connection = self._connection
+        sock = connection.sock if connection is not None else None
         try:
-            import json as json_lib
-            lines = images_result['stdout'].strip().split('\n')
-            for line in lines:
-                if line.strip():
-                    try:
-                        img_data = json_lib.loads(line)
-                        service = img_data.get('Service', img_data.get('Container', ''))
-                        repository = img_data.get('Repository', '')
-                        tag = img_data.get('Tag', '')
-
-                        if repository and tag:
-                            image_name = f"{repository}:{tag}"
-                        elif repository:
-                            image_name = repository
-                        else:
-                            continue
-
-                        # 获取镜像创建时间
-                        # 不使用 2>/dev/null，因为在 SSH 的 cd && command 模式下可能有问题
-                        inspect_cmd = f'docker inspect --format="{{{{.Created}}}}" "{image_name}"'
-                        inspect_result = execute_command(inspect_cmd, project, cwd=project_path)
-
-                        print(f"DEBUG: Inspect image: {image_name}")
-                        print(f"DEBUG: Inspect success: {inspect_result['success']}")
-                        print(f"DEBUG: Inspect stdout: {inspect_result['stdout']}")
-                        if inspect_result['stderr']:
-                            print(f"DEBUG: Inspect stderr: {inspect_result['stderr']}")
-
-                        if inspect_result['success'] and inspect_result['stdout'].strip():
-                            created_time = inspect_result['stdout'].strip()
-                            images_info.append({
-                                'service': service,
-                                'image': image_name,
-                                'created': created_time
-                            })
-                    except json_lib.JSONDecodeError:
-                        continue
-        except Exception as e:
+            if isinstance(sock, socket.socket):
+                sock.shutdown(socket.SHUT_RDWR)
+            elif sock is not None:
+                sock.close()
+        except OSError:
             pass
 
-    # 如果docker compose images不可用，使用备用方法
-    if not images_info:
-        docker_ps_cmd = 'docker compose ps --format json'
-        ps_result = execute_command(docker_ps_cmd, project, cwd=project_path)
-
-        print(f"DEBUG: Fallback to ps command")
-        print(f"DEBUG: ps command success: {ps_result['success']}")
-        print(f"DEBUG: ps stdout length: {len(ps_result['stdout'])}")
-
-        if ps_result['success'] and ps_result['stdout'].strip():
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            if not docker_api_enabled(self.project):
+                self.table.set_disconnected(self.host, 'Docker Engine API 不可用')
+                self._stop.wait(CONTAINER_EVENTS_RETRY_MAX)
+                continue
             try:
-                import json as json_lib
-                lines = ps_result['stdout'].strip().split('\n')
-                processed_images = set()  # 避免重复
-
-                for line in lines:
-                    if line.strip():
-                        try:
-                            container_data = json_lib.loads(line)
-                            service = container_data.get('Service', container_data.get('Name', ''))
-                            image_name = container_data.get('Image', '')
-
-                            if image_name and image_name not in processed_images:
-                                processed_images.add(image_name)
-
-                                # 获取镜像创建时间
-                                inspect_cmd = f'docker inspect --format="{{{{.Created}}}}" "{image_name}"'
-                                inspect_result = execute_command(inspect_cmd, project, cwd=project_path)
-
-                                if inspect_result['success'] and inspect_result['stdout'].strip():
-                                    created_time = inspect_result['stdout'].strip()
-                                    images_info.append({
-                                        'service': service,
-                                        'image': image_name,
-                                        'created': created_time
-                                    })
-                        except json_lib.JSONDecodeError:
-                            continue
+                self._subscribe()
+                error = '事件流已断开'
+            except DockerAPIError as e:
+                if self._stop.is_set():
+                    break
+                mark_docker_api_failed(self.project, e)
+                error = str(e)
             except Exception as e:
-                pass
+                error = describe_ssh_error(e)
+            if self._stop.is_set():
+                break
+            print(f"docker events 订阅中断（{self.host}），{delay} 秒后重连: {error}")
+            self.table.set_disconnected(self.host, error)
+            self._stop.wait(delay)
+            delay = min(delay * 2, CONTAINER_EVENTS_RETRY_MAX)
+
+    def _subscribe(self):
+        filters = urllib.parse.quote(json.dumps({'type': ['container'], 'label': [COMPOSE_PROJECT_LABEL],
+                                                 'event': list(CONTAINER_EVENT_ACTIONS)}))
+        with docker_api_connection(self.project, timeout=None) as connection:
+            self._connection = connection
+            try:
+                connection.request('GET', f'/events?filters={filters}')
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise DockerAPIError(f'/events 返回 {response.status}')
+                # 事件流建立后再取快照，取快照期间的变化会在之后的事件中补上
+                label_filter = urllib.parse.quote(json.dumps({'label': [COMPOSE_PROJECT_LABEL]}))
+                containers, = docker_api_get(self.project, [f'/containers/json?all=1&filters={label_filter}'])
+                self.table.replace_host(self.host, containers)
+
+                while not self._stop.is_set():
+                    line = response.readline()
+                    if not line:
+                        return
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    record = self.table.apply_event(self.host, event)
+                    # 容器启停后缓存的项目状态已过时
+                    if record is not None and (event.get('Action') or event.get('status')) in ('start', 'die', 'destroy'):
+                        project = project_registry.get_project(record['project_id'])
+                        if project is not None:
+                            status_cache.invalidate(project)
+            finally:
+                self._connection = None
+
+class ContainerEventHub:
+    """按 projects.json 管理各主机的事件订阅：有浏览器订阅时启动，无人订阅超过 CONTAINER_EVENTS_IDLE_TIMEOUT 后全部停止"""
+
+    def __init__(self, table):
+        self.table = table
+        self.clients = 0
+        self._subscribers = {}
+        self._last_client = time.time()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def attach(self):
+        with self._lock:
+            self.clients += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='docker-events-hub', daemon=True)
+                self._thread.start()
+        self.reconcile()
+
+    def detach(self):
+        with self._lock:
+            self.clients -= 1
+            self._last_client = time.time()
+
+    def _run(self):
+        while True:
+            time.sleep(CONTAINER_EVENTS_RECONCILE_INTERVAL)
+            try:
+                with self._lock:
+                    idle = self.clients == 0 and time.time() - self._last_client > CONTAINER_EVENTS_IDLE_TIMEOUT
+                if idle:
+                    self.stop_all()
+                else:
+                    self.reconcile()
+            except Exception as e:
+                print(f"更新 docker events 订阅失败: {e}")
+
+    def reconcile(self):
+        """为新增主机启动订阅，停止已没有项目的主机"""
+        hosts = {}
+        for project in load_projects():
+            hosts.setdefault(job_host_key(project), project)
+        with self._lock:
+            removed = [host for host in self._subscribers if host not in hosts]
+            for host in removed:
+                self._subscribers.pop(host).stop()
+            for host, project in hosts.items():
+                if host not in self._subscribers:
+                    subscriber = self._subscribers[host] = DockerEventSubscriber(host, project, self.table)
+                    subscriber.start()
+        for host in removed:
+            self.table.remove_host(host)
+
+    def stop_all(self):
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, {}
+        for host, subscriber in subscribers.items():
+            subscriber.stop()
+            self.table.remove_host(host)
+
+container_events = ContainerEventHub(container_states)
+
+@app.route('/api/containers/events', methods=['GET'])
+def stream_container_events():
+    """一个 SSE 连接推送所有项目的容器状态：先发送快照，之后只推送变化；断线重连（Last-Event-ID）时补发缺少的变化"""
+    last_event_id = request.headers.get('Last-Event-ID', '')
 
-    return jsonify({
-        'success': True,
-        'git_status': git_status['stdout'],
-        'git_branch': git_branch['stdout'].strip(),
-        'git_log': git_log['stdout'],
-        'docker_status': docker_ps['stdout'],
-        'images_info': images_info
-    })
+    def generate():
+        # 在生成器内订阅：响应在开始迭代前被关闭时不会订阅，也就不会漏掉对应的 detach
+        container_events.attach()
+        try:
+            yield "retry: 3000\n\n"
+            seq = int(last_event_id) if last_event_id.isdigit() else -1
+            while True:
+                if seq < 0 or seq > container_states.seq:
+                    # 首次连接、服务已重启或落后太多时发送完整快照
+                    containers, hosts, seq = container_states.snapshot()
+                    yield sse_event({'type': 'snapshot', 'containers': containers, 'hosts': hosts}, seq)
+                events, dropped = container_states.wait_events(seq, SSE_KEEPALIVE_INTERVAL)
+                if dropped:
+                    seq = -1
+                    continue
+                if events:
+                    seq = events[-1][0]
+                    yield ''.join(sse_event(event, event_seq) for event_seq, event in events)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            container_events.detach()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# ============ 系统信息 ============
+# 直接读取 /proc 和 statvfs，不再启动 df / free / top 等进程；后台定时采样保存最近一段时间的数据用于趋势图。
+# 解析函数只处理文本，远程主机的同名文件内容也可以直接交给它们解析。
+
+SYSTEM_SAMPLE_INTERVAL = 5     # 采样间隔（秒）
+SYSTEM_HISTORY_SIZE = 120      # 保留的采样数（默认 10 分钟）
+DOCKER_DF_TTL = 300            # docker system df 较慢，结果缓存的秒数
+DOCKER_DF_TIMEOUT = 60
+DOCKER_DF_COMMAND = "docker system df --format '{{json .}}'"
+DISK_FILESYSTEM_PREFIXES = ('/dev/',)   # 只统计块设备上的文件系统，忽略 tmpfs、overlay 等
+
+def parse_meminfo(text):
+    """解析 /proc/meminfo，返回字节数"""
+    values = {}
+    for line in text.splitlines():
+        name, _, rest = line.partition(':')
+        parts = rest.split()
+        if parts and parts[0].isdigit():
+            values[name] = int(parts[0]) * (1024 if len(parts) > 1 and parts[1] == 'kB' else 1)
+    total = values.get('MemTotal', 0)
+    available = values.get('MemAvailable', values.get('MemFree', 0))
+    swap_total = values.get('SwapTotal', 0)
+    return {
+        'total': total,
+        'available': available,
+        'used': total - available,
+        'percent': round((total - available) * 100 / total, 1) if total else 0,
+        'swap_total': swap_total,
+        'swap_used': swap_total - values.get('SwapFree', 0)
+    }
 
-@app.route('/api/system/info', methods=['GET'])
-def get_system_info():
-    """获取系统信息"""
-    # 磁盘使用情况
-    disk_result = run_command('df -h')
+def parse_loadavg(text):
+    """解析 /proc/loadavg"""
+    parts = text.split()
+    return {'load1': float(parts[0]), 'load5': float(parts[1]), 'load15': float(parts[2])} if len(parts) >= 3 else {}
+
+def parse_cpu_times(text):
+    """解析 /proc/stat 的总 cpu 行，返回 (忙碌时间, 总时间)，单位为 jiffies"""
+    for line in text.splitlines():
+        if line.startswith('cpu '):
+            values = [int(value) for value in line.split()[1:]]
+            idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+            total = sum(values[:8])  # guest 时间已包含在 user/nice 中
+            return total - idle, total
+    return None
+
+def cpu_percent(previous, current):
+    """由两次 parse_cpu_times 的结果计算期间的 CPU 使用率"""
+    if not previous or not current or current[1] <= previous[1]:
+        return None
+    return round((current[0] - previous[0]) * 100 / (current[1] - previous[1]), 1)
+
+def parse_uptime(text):
+    """解析 /proc/uptime，返回运行秒数"""
+    parts = text.split()
+    return int(float(parts[0])) if parts else None
+
+def parse_mounts(text):
+    """解析 /proc/mounts，返回需要统计的挂载点（同一设备只取第一个）"""
+    mounts, devices = [], set()
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].startswith(DISK_FILESYSTEM_PREFIXES) or parts[0] in devices:
+            continue
+        devices.add(parts[0])
+        # 挂载点中的空格等字符以八进制转义
+        mounts.append({'device': parts[0], 'mount': re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), parts[1]),
+                       'fstype': parts[2]})
+    return mounts
+
+def parse_df(text):
+    """解析 df -P -B1 的输出（远程主机没有 statvfs 可用）"""
+    disks = []
+    for line in text.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) < 6 or not parts[0].startswith(DISK_FILESYSTEM_PREFIXES) or not parts[1].isdigit():
+            continue
+        total, used, free = int(parts[1]), int(parts[2]), int(parts[3])
+        disks.append({'device': parts[0], 'mount': ' '.join(parts[5:]), 'total': total, 'used': used, 'free': free,
+                      'percent': round(used * 100 / (used + free), 1) if used + free else 0})
+    return disks
+
+def parse_docker_df(text):
+    """解析 docker system df --format '{{json .}}' 的输出"""
+    items = []
+    for line in text.splitlines():
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        items.append({'type': row.get('Type', ''), 'total': row.get('TotalCount', ''), 'active': row.get('Active', ''),
+                      'size': row.get('Size', ''), 'reclaimable': row.get('Reclaimable', '')})
+    return items
+
+def read_text_file(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+def collect_local_disks():
+    disks = []
+    for mount in parse_mounts(read_text_file('/proc/mounts')):
+        try:
+            st = os.statvfs(mount['mount'])
+        except OSError:
+            continue
+        total = st.f_blocks * st.f_frsize
+        free = st.f_bavail * st.f_frsize
+        used = total - st.f_bfree * st.f_frsize
+        if total == 0:
+            continue
+        disks.append({'device': mount['device'], 'mount': mount['mount'], 'total': total, 'used': used, 'free': free,
+                      'percent': round(used * 100 / (used + free), 1) if used + free else 0})
+    return disks
+
+class SystemSampler:
+    """后台定时采样本机的 CPU、内存和负载，保存在环形缓冲区中"""
+
+    def __init__(self, interval=SYSTEM_SAMPLE_INTERVAL, size=SYSTEM_HISTORY_SIZE):
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self._cpu_times = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._cpu_times = parse_cpu_times(read_text_file('/proc/stat'))
+                self._thread = threading.Thread(target=self._run, name='system-sampler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"采集系统信息失败: {e}")
+
+    def sample(self):
+        cpu_times = parse_cpu_times(read_text_file('/proc/stat'))
+        memory = parse_meminfo(read_text_file('/proc/meminfo'))
+        load = parse_loadavg(read_text_file('/proc/loadavg'))
+        with self._lock:
+            sample = {
+                'time': int(time.time()),
+                'cpu': cpu_percent(self._cpu_times, cpu_times),
+                'memory': memory['percent'],
+                'load1': load.get('load1')
+            }
+            self._cpu_times = cpu_times
+            self.samples.append(sample)
+        return sample
+
+    def history(self):
+        with self._lock:
+            return list(self.samples)
+
+system_sampler = SystemSampler()
+
+class RefreshingCache:
+    """缓存耗时较长的查询结果：过期后先返回旧值并在后台刷新，没有缓存时同步加载"""
+
+    def __init__(self, ttl, timeout):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._entries = {}    # key -> (值, 更新时间)
+        self._loading = {}    # key -> Future
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """返回 (值, 更新时间)；首次加载超时返回 (None, None)"""
+        return self.get_many({key: loader})[key]
+
+    def get_many(self, loaders, force=False):
+        """批量获取 {key: loader}：需要加载的 key 同时开始加载，再共用一个超时等待；force 时忽略已有缓存"""
+        results, pending = {}, {}
+        with self._lock:
+            for key, loader in loaders.items():
+                entry = None if force else self._entries.get(key)
+                if entry is not None and time.time() - entry[1] < self.ttl:
+                    results[key] = entry
+                    continue
+                future = self._loading.get(key)
+                if future is None:
+                    future = self._loading[key] = Future()
+                    threading.Thread(target=self._load, args=(key, loader, future), daemon=True).start()
+                if entry is not None:
+                    results[key] = entry
+                else:
+                    pending[key] = future
+        deadline = time.monotonic() + self.timeout
+        for key, future in pending.items():
+            try:
+                results[key] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception:
+                results[key] = (None, None)
+        return results
 
-    # 内存使用情况
-    memory_result = run_command('free -h')
+    def _load(self, key, loader, future):
+        try:
+            entry = (loader(), time.time())
+            with self._lock:
+                self._entries[key] = entry
+            future.set_result(entry)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
 
-    # CPU 使用情况
-    cpu_result = run_command('top -bn1 | grep "Cpu(s)"')
+docker_df_cache = RefreshingCache(DOCKER_DF_TTL, DOCKER_DF_TIMEOUT)
 
-    # 系统负载
-    uptime_result = run_command('uptime')
+def load_local_docker_df():
+    result = run_command(DOCKER_DF_COMMAND)
+    if not result['success']:
+        return {'items': [], 'error': result['stderr'].strip() or 'docker system df 执行失败'}
+    return {'items': parse_docker_df(result['stdout']), 'error': ''}
 
-    # Docker 使用情况
-    docker_disk_result = run_command('docker system df')
+@app.route('/api/system/info', methods=['GET'])
+def get_system_info():
+    """获取本机系统信息（数值），history 为最近的 CPU / 内存 / 负载采样"""
+    system_sampler.start()
+    history = system_sampler.history()
+    memory = parse_meminfo(read_text_file('/proc/meminfo'))
+    docker_df, docker_df_updated = docker_df_cache.get('local', load_local_docker_df)
 
     return jsonify({
         'success': True,
-        'disk': disk_result['stdout'] if disk_result['success'] else f"错误: {disk_result['stderr']}",
-        'memory': memory_result['stdout'] if memory_result['success'] else f"错误: {memory_result['stderr']}",
-        'cpu': cpu_result['stdout'] if cpu_result['success'] else f"错误: {cpu_result['stderr']}",
-        'uptime': uptime_result['stdout'] if uptime_result['success'] else f"错误: {uptime_result['stderr']}",
-        'docker_disk': docker_disk_result['stdout'] if docker_disk_result['success'] else f"错误: {docker_disk_result['stderr']}"
+        # 刚启动还没有两次采样时 CPU 使用率为 null
+        'cpu': {'percent': history[-1]['cpu'] if history else None, 'cores': os.cpu_count()},
+        'memory': memory,
+        'load': parse_loadavg(read_text_file('/proc/loadavg')),
+        'uptime': parse_uptime(read_text_file('/proc/uptime')),
+        'disks': collect_local_disks(),
+        'docker_disk': {
+            **(docker_df or {'items': [], 'error': '正在获取，请稍后刷新'}),
+            'updated_at': datetime.fromtimestamp(docker_df_updated).strftime('%Y-%m-%d %H:%M:%S') if docker_df_updated else None
+        },
+        'history': history,
+        'interval': system_sampler.interval
     })
 
+# ============ 远程主机信息 ============
+# SSH 项目所在主机的系统信息：一次 exec 执行合并的探测脚本，读取 /proc、df 和 docker system df，
+# 输出按分隔行拆分后交给上面的解析函数。多个项目共用的主机只探测一次。
+
+HOST_METRICS_TTL = 60         # 远程主机信息缓存的秒数
+HOST_METRICS_TIMEOUT = 30     # 单台主机探测超时（秒）
+HOST_CPU_SAMPLE_SECONDS = 1   # 两次读取 /proc/stat 的间隔，用于计算 CPU 使用率
+
+HOST_PROBE_SCRIPT = f"""printf '%s stat1\\n' "$M"; head -n 1 /proc/stat
+sleep {HOST_CPU_SAMPLE_SECONDS}
+printf '%s stat2\\n' "$M"; head -n 1 /proc/stat
+printf '%s cpus\\n' "$M"; grep -c '^processor' /proc/cpuinfo
+printf '%s meminfo\\n' "$M"; cat /proc/meminfo
+printf '%s loadavg\\n' "$M"; cat /proc/loadavg
+printf '%s uptime\\n' "$M"; cat /proc/uptime
+printf '%s df\\n' "$M"; df -P -B1 2>/dev/null
+printf '%s docker_df\\n' "$M"; {DOCKER_DF_COMMAND} 2>&1"""
+
+def build_host_probe_command():
+    """生成远程主机探测命令（与状态探测一样整体放在 { } 中）"""
+    return f"{{\nM={STATUS_SECTION_MARKER}\n{HOST_PROBE_SCRIPT}\ntrue; }}"
+
+def parse_host_probe(output):
+    """把主机探测脚本的输出解析为与 /api/system/info 相同结构的数值"""
+    sections = parse_probe_sections(output)
+    docker_text = sections.get('docker_df', '')
+    docker_items = parse_docker_df(docker_text)
+    # docker 的错误信息合并在同一段输出中，非 JSON 行即为错误
+    docker_error = '' if docker_items else next(
+        (line.strip() for line in docker_text.splitlines() if line.strip() and not line.lstrip().startswith('{')),
+        'docker system df 无输出')
+    cpus = sections.get('cpus', '').strip()
+    return {
+        'cpu': {
+            'percent': cpu_percent(parse_cpu_times(sections.get('stat1', '')), parse_cpu_times(sections.get('stat2', ''))),
+            'cores': int(cpus) if cpus.isdigit() else None
+        },
+        'memory': parse_meminfo(sections.get('meminfo', '')),
+        'load': parse_loadavg(sections.get('loadavg', '')),
+        'uptime': parse_uptime(sections.get('uptime', '')),
+        'disks': parse_df(sections.get('df', '')),
+        'docker_disk': {'items': docker_items, 'error': docker_error}
+    }
+
+async def collect_host_metrics_async(project):
+    """在项目所在的 SSH 主机上执行一次探测脚本（复用连接池中的连接）"""
+    started = time.monotonic()
+    result = await execute_command_async(build_host_probe_command(), project, cwd='/', timeout=HOST_METRICS_TIMEOUT)
+    HOST_PROBE_DURATION.observe(time.monotonic() - started, host=metric_host(project),
+                                result='success' if result['success'] else 'error')
+    if not result['success']:
+        return {'error': result['stderr'].strip() or f"退出码: {result['returncode']}"}
+    return {**parse_host_probe(result['stdout']), 'error': ''}
+
+def group_projects_by_host():
+    """按 SSH 主机分组启用 SSH 的项目，返回 {主机: [项目, ...]}"""
+    hosts = {}
+    for project in load_projects():
+        if project.get('ssh', {}).get('enabled', False):
+            hosts.setdefault(job_host_key(project), []).append(project)
+    return hosts
+
+# 超时按所有主机共用计算，留出建立 SSH 连接的时间
+host_metrics_cache = RefreshingCache(HOST_METRICS_TTL, HOST_METRICS_TIMEOUT + 10)
+
+@app.route('/api/system/hosts', methods=['GET'])
+def get_hosts_info():
+    """获取所有 SSH 项目所在主机的系统信息，refresh=1 时忽略缓存重新探测"""
+    hosts = group_projects_by_host()
+    # 同一主机的项目共用连接，取第一个项目的 SSH 配置探测
+    loaders = {
+        host: lambda project=projects[0]: async_runtime.submit(collect_host_metrics_async(project)).result()
+        for host, projects in hosts.items()
+    }
+    entries = host_metrics_cache.get_many(loaders, force=request.args.get('refresh') == '1')
+
+    result = []
+    for host, projects in hosts.items():
+        metrics_data, updated = entries.get(host, (None, None))
+        result.append({
+            'host': host,
+            'projects': [project['name'] for project in projects],
+            **(metrics_data or {'error': '探测超时，请稍后刷新'}),
+            'updated_at': datetime.fromtimestamp(updated).strftime('%Y-%m-%d %H:%M:%S') if updated else None
+        })
+    return jsonify({'success': True, 'hosts': result})
+
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
     """获取系统设置"""
@@ -1236,17 +4932,24 @@ def update_settings():
     """更新系统设置"""
     data = request.json
 
+    # 与现有设置合并，避免覆盖页面上没有的配置项（如 status_cache）
+    settings = load_settings()
+    settings.update(data)
+
     try:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        settings_registry.store(settings)
         return jsonify({'success': True, 'message': '设置已保存'})
     except Exception as e:
         return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
 @app.route('/api/test-dingtalk', methods=['POST'])
 def test_dingtalk():
-    """测试钉钉通知"""
-    result = send_dingtalk_notification(
+    """测试钉钉通知（同步发送，直接返回发送结果）"""
+    dingtalk = load_settings().get('dingtalk', {})
+    if not dingtalk.get('enabled', False) or not dingtalk.get('webhook_url', ''):
+        return jsonify({'success': False, 'message': '钉钉通知未启用或未配置 Webhook'}), 400
+
+    result, error = dingtalk_dispatcher.send_now(
         "测试通知",
         "这是一条测试消息，如果您收到此消息，说明钉钉通知配置成功！",
         is_success=True
@@ -1255,7 +4958,7 @@ def test_dingtalk():
     if result:
         return jsonify({'success': True, 'message': '测试消息已发送'})
     else:
-        return jsonify({'success': False, 'message': '发送失败，请检查配置'}), 500
+        return jsonify({'success': False, 'message': f'发送失败，请检查配置: {error}'}), 500
 
 @app.route('/api/projects', methods=['POST'])
 def add_project():
@@ -1269,18 +4972,35 @@ def add_project():
     projects = load_projects()
 
     # 检查路径是否已存在
-    for project in projects:
-        if project['path'] == data['path']:
-            return jsonify({'success': False, 'message': '该路径已存在'}), 400
+    if project_registry.find_by_path(data['path']) is not None:
+        return jsonify({'success': False, 'message': '该路径已存在'}), 400
+
+    if data.get('restart_strategy', DEFAULT_RESTART_STRATEGY) not in RESTART_STRATEGIES:
+        return jsonify({'success': False, 'message': f"重启策略必须是 {', '.join(RESTART_STRATEGIES)} 之一"}), 400
+
+    health_check_error = validate_health_check(data.get('health_check'))
+    if health_check_error:
+        return jsonify({'success': False, 'message': health_check_error}), 400
+
+    git_config_error = validate_git_config(data.get('git'))
+    if git_config_error:
+        return jsonify({'success': False, 'message': git_config_error}), 400
 
     # 添加新项目
     new_project = {
+        'id': new_project_id({project['id'] for project in projects}),
         'name': data.get('name'),
         'description': data.get('description', ''),
         'path': data.get('path'),
-        'auto_restart': data.get('auto_restart', True)
+        'auto_restart': data.get('auto_restart', True),
+        'restart_strategy': data.get('restart_strategy', DEFAULT_RESTART_STRATEGY)
     }
 
+    # 健康检查和代码更新配置（如果有）
+    for field in ('health_check', 'git'):
+        if data.get(field):
+            new_project[field] = data[field]
+
     # 添加SSH配置（如果有）
     if 'ssh' in data:
         new_project['ssh'] = data['ssh']
@@ -1292,13 +5012,12 @@ def add_project():
     else:
         return jsonify({'success': False, 'message': '保存失败'}), 500
 
-@app.route('/api/projects/<int:project_id>', methods=['PUT'])
+@app.route('/api/projects/<project_id>', methods=['PUT'])
 def update_project(project_id):
     """更新项目配置"""
     data = request.json
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
     # 验证必需字段
@@ -1306,39 +5025,58 @@ def update_project(project_id):
         return jsonify({'success': False, 'message': '项目名称和路径不能为空'}), 400
 
     # 检查路径是否与其他项目冲突
-    for i, project in enumerate(projects):
-        if i != project_id and project['path'] == data['path']:
-            return jsonify({'success': False, 'message': '该路径已被其他项目使用'}), 400
+    existing_id = project_registry.find_by_path(data['path'])
+    if existing_id is not None and existing_id != project_id:
+        return jsonify({'success': False, 'message': '该路径已被其他项目使用'}), 400
+
+    if data.get('restart_strategy', DEFAULT_RESTART_STRATEGY) not in RESTART_STRATEGIES:
+        return jsonify({'success': False, 'message': f"重启策略必须是 {', '.join(RESTART_STRATEGIES)} 之一"}), 400
 
-    # 更新项目
-    projects[project_id] = {
+    health_check_error = validate_health_check(data.get('health_check'))
+    if health_check_error:
+        return jsonify({'success': False, 'message': health_check_error}), 400
+
+    git_config_error = validate_git_config(data.get('git'))
+    if git_config_error:
+        return jsonify({'success': False, 'message': git_config_error}), 400
+
+    # 更新项目（保留项目ID）
+    updated_project = {
+        'id': project_id,
         'name': data.get('name'),
         'description': data.get('description', ''),
         'path': data.get('path'),
-        'auto_restart': data.get('auto_restart', True)
+        'auto_restart': data.get('auto_restart', True),
+        'restart_strategy': data.get('restart_strategy', DEFAULT_RESTART_STRATEGY)
     }
 
+    # 健康检查和代码更新配置（如果有）
+    for field in ('health_check', 'git'):
+        if data.get(field):
+            updated_project[field] = data[field]
+
     # 添加SSH配置（如果有）
     if 'ssh' in data:
-        projects[project_id]['ssh'] = data['ssh']
+        updated_project['ssh'] = data['ssh']
 
+    projects = [updated_project if p['id'] == project_id else p for p in load_projects()]
     if save_projects(projects):
         return jsonify({'success': True, 'message': '项目更新成功', 'projects': projects})
     else:
         return jsonify({'success': False, 'message': '保存失败'}), 500
 
-@app.route('/api/projects/<int:project_id>', methods=['DELETE'])
+@app.route('/api/projects/<project_id>', methods=['DELETE'])
 def delete_project(project_id):
     """删除项目"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    deleted_project = projects.pop(project_id)
+    # 操作日志和输出文件以项目ID为键，删除后不会转移到其他项目，由保留策略清理
+    projects = [p for p in load_projects() if p['id'] != project_id]
 
     if save_projects(projects):
-        return jsonify({'success': True, 'message': f'项目 "{deleted_project["name"]}" 已删除', 'projects': projects})
+        return jsonify({'success': True, 'message': f'项目 "{project["name"]}" 已删除', 'projects': projects})
     else:
         return jsonify({'success': False, 'message': '保存失败'}), 500
 
@@ -1398,25 +5136,160 @@ def get_version():
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取版本信息失败: {str(e)}'}), 500
 
-@app.route('/api/logs/<int:project_id>', methods=['GET'])
+@app.route('/api/logs/<project_id>', methods=['GET'])
 def get_project_logs(project_id):
     """获取项目操作日志"""
-    projects = load_projects()
-
-    if project_id >= len(projects):
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
         return jsonify({'success': False, 'message': '项目不存在'}), 404
 
-    # 获取limit参数，默认50条
+    # 获取分页参数，默认50条；before 为上一页最后一条日志的ID
     limit = request.args.get('limit', 50, type=int)
-    limit = min(limit, 100)  # 最多100条
+    limit = max(1, min(limit, 200))  # 最多200条
+    before_id = request.args.get('before', None, type=int)
 
-    logs = load_operation_logs(project_id, limit)
+    logs, total_count, has_more = load_operation_logs(project_id, limit, before_id)
 
     return jsonify({
         'success': True,
         'logs': logs,
-        'total': len(logs)
+        'total': len(logs),
+        'total_count': total_count,
+        'has_more': has_more,
+        'next_before': logs[-1]['id'] if has_more else None
+    })
+
+@app.route('/api/logs/<project_id>/<run_id>/output', methods=['GET'])
+def get_run_output(project_id, run_id):
+    """读取某次操作的完整输出
+
+    支持 Range: bytes=a-b / bytes=-N 请求头，或 ?offset=&length= / ?tail=N 参数。
+    """
+    if not RUN_ID_PATTERN.match(run_id):
+        return jsonify({'success': False, 'message': '无效的运行ID'}), 400
+    project_id, project = project_registry.resolve(project_id)
+    if project is None:
+        return jsonify({'success': False, 'message': '项目不存在'}), 404
+
+    path, index_path = output_artifact_paths(project_id, run_id)
+    if not os.path.exists(index_path):
+        return jsonify({'success': False, 'message': '输出文件不存在'}), 404
+
+    with active_artifacts_lock:
+        running = run_id in active_artifacts
+
+    start, end = 0, None
+    range_start = None
+    invalid_range = False
+    range_match = re.match(r'^bytes=(\d*)-(\d*)$', request.headers.get('Range', '').strip())
+    if range_match and (range_match.group(1) or range_match.group(2)):
+        if range_match.group(1):
+            start = range_start = int(range_match.group(1))
+            end = int(range_match.group(2)) + 1 if range_match.group(2) else None
+            # bytes=10-5：结束位置在起始位置之前
+            invalid_range = end is not None and end <= start
+        else:
+            start = -int(range_match.group(2))
+            # bytes=-0：长度为 0 的后缀范围
+            invalid_range = start == 0
+    elif 'tail' in request.args:
+        start = -max(0, request.args.get('tail', 65536, type=int))
+    elif 'offset' in request.args:
+        start = max(0, request.args.get('offset', 0, type=int))
+        length = request.args.get('length', None, type=int)
+        end = start + length if length is not None else None
+
+    try:
+        # 无效范围只读取总长度，用于 416 响应的 Content-Range
+        data, start, total = read_output_range(project_id, run_id, 0 if invalid_range else start, 0 if invalid_range else end)
+    except FileNotFoundError:
+        # 只剩索引文件（输出文件被删除或清理到一半）
+        return jsonify({'success': False, 'message': '输出文件不存在'}), 404
+
+    if invalid_range or (range_start is not None and range_start >= total and not running):
+        # 范围无效，或输出已完整且起始位置超出长度（RFC 9110: 416）；运行中的输出之后还会增长，仍返回空的 206
+        response = jsonify({'success': False, 'message': '请求的范围无效或超出输出长度'})
+        response.status_code = 416
+        response.headers['Content-Range'] = f"bytes */{total}"
+        response.headers['X-Output-Size'] = str(total)
+        return response
+
+    partial = start > 0 or start + len(data) < total
+    response = Response(data, status=206 if partial else 200, mimetype='text/plain')
+    response.charset = 'utf-8'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['X-Output-Size'] = str(total)
+    response.headers['X-Output-Complete'] = 'false' if running else 'true'
+    if partial:
+        response.headers['Content-Range'] = f"bytes {start}-{start + len(data) - 1}/{total}" if data else f"bytes */{total}"
+    return response
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """获取后台任务列表（可按 project_id 过滤）"""
+    project_id = request.args.get('project_id')
+    if project_id is not None:
+        project_id = project_registry.resolve(project_id)[0]
+    jobs = [job.to_dict() for job in job_manager.list()
+            if project_id is None or job.project_id == project_id]
+    return jsonify({'success': True, 'jobs': jobs})
+
+@app.route('/api/queue', methods=['GET'])
+def get_job_queue():
+    """获取任务队列：正在执行的任务和按顺序排队的任务"""
+    running, queued = job_manager.snapshot()
+    queue = []
+    for position, job in enumerate(queued, 1):
+        item = job.to_dict()
+        item['position'] = position
+        item['reason'] = (job.queue_info or {}).get('reason', '')
+        queue.append(item)
+    return jsonify({
+        'success': True,
+        'running': [job.to_dict() for job in running],
+        'queued': queue,
+        'max_workers': job_manager.max_workers,
+        'max_heavy_per_host': get_scheduler_config()['max_heavy_per_host']
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式的监控指标"""
+    running, queued = job_manager.snapshot()
+    gauges = [
+        '# HELP deploy_manager_jobs_running 正在执行的后台任务数',
+        '# TYPE deploy_manager_jobs_running gauge',
+        f'deploy_manager_jobs_running {len(running)}',
+        '# HELP deploy_manager_jobs_queued 排队中的后台任务数',
+        '# TYPE deploy_manager_jobs_queued gauge',
+        f'deploy_manager_jobs_queued {len(queued)}'
+    ]
+    return Response(metrics.render() + '\n'.join(gauges) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """获取后台任务信息"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job_events(job_id):
+    """接入后台任务的实时输出，支持 Last-Event-ID 或 ?from=<seq> 续传"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+
+    _, seq = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    from_seq = seq + 1 if seq is not None else request.args.get('from', 0, type=int)
+    return stream_job(job, from_seq)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6666, debug=True)
+    # 开发调试用；生产环境请使用 gunicorn -c gunicorn.conf.py app:app
+    app.run(
+        host='0.0.0.0',
+        port=int(os.environ.get('DEPLOY_MANAGER_PORT', '6666')),
+        debug=os.environ.get('DEPLOY_MANAGER_DEBUG', '') == '1',
+        threaded=True
+    )
@@ -214,7 +214,10 @@ Type=simple
 User=$ACTUAL_USER
 WorkingDirectory=$INSTALL_DIR
 Environment="PATH=$INSTALL_DIR/venv/bin"
-ExecStart=$INSTALL_DIR/venv/bin/python $INSTALL_DIR/app.py
+Environment="DEPLOY_MANAGER_PORT=$SERVICE_PORT"
+ExecStart=$INSTALL_DIR/venv/bin/gunicorn -c gunicorn.conf.py app:app
+KillMode=mixed
+TimeoutStopSec=660
 Restart=always
 RestartSec=10
 
@@ -0,0 +1,36 @@
+# Deploy Manager 的 gunicorn 配置
+# 启动: gunicorn -c gunicorn.conf.py app:app
+#
+# 后台任务、状态缓存、SSH 连接池都保存在进程内，因此只使用 1 个 worker 进程，
+# 并发由线程数决定。SSE 连接在等待事件时不占用 CPU，几百个线程即可支撑数百个并发连接。
+import os
+
+bind = os.environ.get('DEPLOY_MANAGER_BIND', f"0.0.0.0:{os.environ.get('DEPLOY_MANAGER_PORT', '6666')}")
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('DEPLOY_MANAGER_THREADS', '256'))                  # 同时处理的请求数（含 SSE 长连接）
+worker_connections = int(os.environ.get('DEPLOY_MANAGER_MAX_CONNECTIONS', '1000'))  # 最大并发连接数
+
+# gthread worker 的心跳由主线程负责，长时间的 SSE 请求不会触发超时
+timeout = 120
+keepalive = 5
+
+# 停止时等待执行中的任务结束的最长时间（秒），systemd 的 TimeoutStopSec 应大于该值
+graceful_timeout = int(os.environ.get('DEPLOY_MANAGER_GRACEFUL_TIMEOUT', '600'))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('DEPLOY_MANAGER_LOG_LEVEL', 'info')
+
+
+def worker_exit(server, worker):
+    """worker 退出前等待后台任务完成，排队中的任务会被取消"""
+    from app import job_manager, operation_log_store, dingtalk_dispatcher
+
+    server.log.info('等待执行中的任务完成...')
+    remaining = job_manager.shutdown(graceful_timeout)
+    if remaining:
+        server.log.warning(f'仍有 {remaining} 个任务未完成，强制退出')
+    operation_log_store.flush()
+    # 未发送完的通知保存在 logs/notify_queue.json 中，重启后继续发送
+    dingtalk_dispatcher.flush(10)
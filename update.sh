@@ -119,6 +119,14 @@ if [ -f "$INSTALL_DIR/requirements.txt" ]; then
     echo "  依赖已更新"
 fi
 
+# 旧版本的服务直接运行 app.py（开发服务器），切换为 gunicorn
+SERVICE_FILE="/etc/systemd/system/deploy-manager.service"
+if [ -f "$SERVICE_FILE" ] && grep -q "app.py" "$SERVICE_FILE"; then
+    sed -i "s|^ExecStart=.*|ExecStart=$INSTALL_DIR/venv/bin/gunicorn -c gunicorn.conf.py app:app\nKillMode=mixed\nTimeoutStopSec=660|" "$SERVICE_FILE"
+    systemctl daemon-reload
+    echo "  服务已切换为 gunicorn 启动"
+fi
+
 # 启动服务
 echo ""
 echo "[5/5] 启动服务..."